@@ -0,0 +1,218 @@
+import threading
+
+import numpy as np
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+# Allele calls that are not real alleles. Loci with one of these calls are ignored when counting differences.
+IGNORED_ALLELE_VALUES = ["NIPH", "NIPHEM", "LNF", "PLNF", "PLOT3", "PLOT5", "LOTSC", "PAMA", "ASM", "ALM"]
+
+# Code 0 is reserved for missing calls and codes 1..len(IGNORED_ALLELE_VALUES) for the ignored allele values,
+# so that encoding is lossless. Real alleles get codes from FIRST_ALLELE_CODE and up.
+# Like in NearestNeighbors.pipeline_prod(), a missing call is compared like any other value (it differs from
+# a real allele, but not from another missing call), and only the ignored allele values are not compared.
+MISSING_CODE = 0
+RESERVED_VALUES = [None] + IGNORED_ALLELE_VALUES
+FIRST_ALLELE_CODE = len(RESERVED_VALUES)
+_reserved_codes = {value: code for code, value in enumerate(RESERVED_VALUES) if value is not None}
+
+CODEBOOK_COLLECTION = 'allele_codebooks'
+
+
+def smallest_uint_dtype(max_value: int):
+    "Return the smallest unsigned integer dtype that can hold max_value"
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def normalize_allele(value):
+    "Return an allele call as a string, or None if the call is missing (None or NaN)"
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    # An empty call is a value of its own, which differs from a missing call like in the aggregation pipeline
+    return str(value)
+
+
+def compared_calls(codes: np.ndarray):
+    "Return a mask of the encoded calls that are compared when counting differences: all but the ignored allele values"
+    return (codes == MISSING_CODE) | (codes >= FIRST_ALLELE_CODE)
+
+
+def profile_loci(profiles: list):
+    """
+    Return the loci (columns) for a list of allele profiles.
+    Profiles can be dicts ({locus: allele}) or lists (the 'allele_array' shape), in which case the loci are
+    the positions in the list. Loci are always returned as strings as they are used as keys in MongoDB.
+    """
+    if profiles and isinstance(profiles[0], dict):
+        loci = dict()
+        for profile in profiles:
+            loci.update(dict.fromkeys(profile))
+        return [str(locus) for locus in loci]
+    length = max((len(profile) for profile in profiles), default=0)
+    return [str(i) for i in range(length)]
+
+
+def profile_value_matrix(profiles: list, loci: list):
+    "Return the raw allele calls as a 2D object array with one row per profile and one column per locus"
+    values = np.full((len(profiles), len(loci)), None, dtype=object)
+    for row, profile in enumerate(profiles):
+        if isinstance(profile, dict):
+            values[row] = [profile.get(locus) for locus in loci]
+        else:
+            profile = profile[:len(loci)]
+            values[row, :len(profile)] = profile
+    return values
+
+
+class LocusCodebook:
+    """
+    Maps the allele calls for a single locus to integer codes.
+
+    The persisted allele list is append-only and the code of an allele is FIRST_ALLELE_CODE plus its
+    position in the list. If two writers append the same allele concurrently, the first occurrence wins.
+    """
+    def __init__(self):
+        self.alleles = list()
+        self.codes = dict()
+
+    def sync(self, persisted_alleles: list):
+        "Catch up with the persisted allele list"
+        for index in range(len(self.alleles), len(persisted_alleles)):
+            allele = persisted_alleles[index]
+            self.alleles.append(allele)
+            self.codes.setdefault(allele, FIRST_ALLELE_CODE + index)
+
+    def code(self, allele: str | None):
+        "Return the code for an allele, or None if the allele is not in the codebook"
+        if allele is None:
+            return MISSING_CODE
+        reserved = _reserved_codes.get(allele)
+        if reserved is not None:
+            return reserved
+        return self.codes.get(allele)
+
+    def decode(self, code: int):
+        if code < FIRST_ALLELE_CODE:
+            return RESERVED_VALUES[code]
+        return self.alleles[code - FIRST_ALLELE_CODE]
+
+    @property
+    def dtype(self):
+        return smallest_uint_dtype(FIRST_ALLELE_CODE + len(self.alleles))
+
+
+class AlleleCodebook:
+    """
+    Per-schema codebook that encodes allele calls as small integers, one LocusCodebook per locus.
+
+    The codebook is persisted in MongoDB with one document per (schema, locus) so that codes are stable
+    across requests and processes, and so that all engines (nearest neighbors, distance matrices and
+    profile caches) encode the same allele with the same code.
+    Calculations encode in worker threads, so loading and encoding is serialized with a lock.
+    """
+    def __init__(self, db, schema):
+        self.db = db
+        self.schema = str(schema)
+        self.loci = dict()
+        self._index_created = False
+        self._lock = threading.RLock()
+
+    @property
+    def collection(self):
+        return self.db[CODEBOOK_COLLECTION]
+
+    def load(self, loci: list | None = None):
+        "Load (or refresh) the persisted codebooks for the given loci, or for all loci in the schema"
+        filter = {'schema': self.schema}
+        if loci is not None:
+            filter['locus'] = {'$in': list(loci)}
+        with self._lock:
+            for doc in self.collection.find(filter, {'locus': True, 'alleles': True}):
+                self.loci.setdefault(doc['locus'], LocusCodebook()).sync(doc['alleles'])
+
+    def register(self, new_alleles: dict):
+        "Persist alleles that are not yet in the codebook ({locus: [allele, ...]}) and refresh the affected loci"
+        if not new_alleles:
+            return
+        if not self._index_created:
+            self.collection.create_index([('schema', 1), ('locus', 1)], unique=True)
+            self._index_created = True
+        operations = [
+            UpdateOne({'schema': self.schema, 'locus': locus}, {'$push': {'alleles': {'$each': alleles}}}, upsert=True)
+            for locus, alleles in new_alleles.items()
+        ]
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError:
+            # Another process created one of the locus documents at the same time. Pushing the same
+            # alleles twice is harmless as the first occurrence of an allele defines its code.
+            self.collection.bulk_write(operations, ordered=False)
+        self.load(list(new_alleles))
+
+    def locus(self, locus: str):
+        return self.loci.setdefault(locus, LocusCodebook())
+
+    @property
+    def dtype(self):
+        "The smallest dtype that can hold the codes of all loci"
+        return max((c.dtype for c in self.loci.values()), default=np.dtype(np.uint8), key=lambda d: d.itemsize)
+
+    def encode(self, profiles: list, loci: list | None = None):
+        """
+        Encode a list of allele profiles as a 2D integer array with one row per profile and one column per locus.
+        Alleles that have not been seen before are added to the codebook.
+        Returns the array, using the smallest sufficient unsigned integer dtype.
+        """
+        if loci is None:
+            loci = profile_loci(profiles)
+        from pandas import factorize  # Imported here to keep pandas out of the API's startup time
+
+        values = profile_value_matrix(profiles, loci)
+        row_count, locus_count = values.shape
+        if values.size == 0:
+            return np.zeros(values.shape, dtype=np.uint8)
+
+        # Factorize all calls at once, then factorize (locus, call) pairs, so that we only have to look up
+        # each distinct allele per locus once in Python.
+        value_ids, uniques = factorize(values.ravel())
+        alleles = [normalize_allele(u) for u in uniques] + [None]  # value_id -1 (missing) maps to the last element
+        value_count = len(alleles)
+        keys = np.tile(np.arange(locus_count, dtype=np.int64), row_count) * value_count + (value_ids % value_count)
+        pair_ids, pair_keys = factorize(keys)
+        pair_loci, pair_values = np.divmod(pair_keys, value_count)
+
+        with self._lock:
+            self.load([locus for locus in loci if locus not in self.loci])
+            new_alleles = dict()
+            for locus_index, value_index in zip(pair_loci.tolist(), pair_values.tolist()):
+                allele = alleles[value_index]
+                locus = loci[locus_index]
+                if self.locus(locus).code(allele) is None:
+                    new_alleles.setdefault(locus, dict())[allele] = None
+            self.register({locus: list(a) for locus, a in new_alleles.items()})
+
+            lookup = np.array([
+                self.loci[loci[locus_index]].code(alleles[value_index])
+                for locus_index, value_index in zip(pair_loci.tolist(), pair_values.tolist())
+            ], dtype=np.uint64)
+            dtype = self.dtype
+        return lookup[pair_ids].reshape(row_count, locus_count).astype(dtype)
+
+    def decode(self, codes: np.ndarray, loci: list):
+        "Turn an encoded profile back into a {locus: allele} dict"
+        return {locus: self.loci[locus].decode(int(code)) for locus, code in zip(loci, codes)}
+
+
+_codebooks = dict()
+
+def get_codebook(db, schema):
+    "Return the (cached) codebook for a schema"
+    key = (db.name, str(schema))
+    codebook = _codebooks.get(key)
+    if codebook is None or codebook.db is not db:
+        codebook = AlleleCodebook(db, schema)
+        _codebooks[key] = codebook
+    return codebook
@@ -0,0 +1,84 @@
+import os
+import shutil
+from dataclasses import dataclass
+from os import getenv
+from pathlib import Path
+
+# Total size of the job folders in DMX_DIR that triggers eviction of the least recently used folders (0: no limit)
+DMX_DIR_QUOTA_MB = int(getenv('DMX_DIR_QUOTA_MB', 0))
+# Keep the allele matrix TSV file (the input for cgmlst-dists) after the distances have been calculated
+KEEP_ALLELE_MATRIX = int(getenv('KEEP_ALLELE_MATRIX', 0))
+
+# Touched whenever a job folder is read. Its mtime is the last access time of the folder, which does not
+# depend on the filesystem being mounted with atime updates.
+ACCESS_MARKER = '.last_access'
+
+
+@dataclass
+class ArtifactUsage:
+    job_id: str
+    path: Path
+    size: int
+    last_access: float
+
+
+def touch(folder: Path):
+    "Record that a job folder has been used"
+    try:
+        Path(folder, ACCESS_MARKER).touch()
+    except FileNotFoundError:
+        pass
+
+
+def folder_usage(folder: Path):
+    "Return the size and last access time of a job folder"
+    size = 0
+    last_access = os.stat(folder).st_mtime
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            stat = entry.stat()
+            if entry.name == ACCESS_MARKER:
+                last_access = max(last_access, stat.st_mtime)
+            elif entry.is_file():
+                size += stat.st_size
+    return ArtifactUsage(Path(folder).name, Path(folder), size, last_access)
+
+
+def usage(directory: Path):
+    "Return the usage of all job folders in a directory, least recently used first"
+    folders = list()
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    try:
+                        folders.append(folder_usage(entry.path))
+                    except FileNotFoundError:
+                        pass  # Evicted by another process
+    except FileNotFoundError:
+        return folders
+    return sorted(folders, key=lambda folder: folder.last_access)
+
+
+def evict_lru(directory: Path, quota_bytes: int, protect: set = frozenset()):
+    """
+    Delete the least recently used job folders until the total size is below quota_bytes.
+    Folders of jobs in protect (e.g. jobs that are still running) are never deleted.
+    Returns the job ids of the evicted folders.
+    """
+    if quota_bytes <= 0:
+        return []
+    folders = usage(directory)
+    total = sum(folder.size for folder in folders)
+    evicted = list()
+    for folder in folders:
+        if total <= quota_bytes:
+            break
+        if folder.job_id in protect:
+            continue
+        shutil.rmtree(folder.path, ignore_errors=True)
+        total -= folder.size
+        evicted.append(folder.job_id)
+    if evicted:
+        print(f"Evicted {len(evicted)} job folders from {directory}. {total} bytes in use.")
+    return evicted
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+In-process load test for the Bio API endpoints.
+
+The FastAPI app in main.py is driven directly through httpx.AsyncClient (no network, no uvicorn)
+against mongomock (default) or a throwaway MongoDB database. A configurable mix of simulated
+clients runs concurrently for a fixed duration:
+
+- pollers:          poll the status of existing jobs, fetching the full result every --full-every polls
+- nn clients:       POST a nearest neighbors job, poll until it is finished, then GET the full result
+- distance clients: POST a distance calculation, poll until it is finished, then GET the full result
+
+This is the POST-and-poll pattern produced by the SOFI frontend. The report contains p50/p95/p99 latency
+per endpoint and how long the event loop was blocked (measured as the scheduling lag of a monitor task).
+
+Unlike httpx's own ASGITransport, the transport used here returns the response as soon as it is
+complete and lets FastAPI background tasks continue afterwards, like uvicorn does. Otherwise the
+POST latency would include the whole calculation.
+
+Example:
+    python -m benchmarks.load_test --pollers 50 --distance-clients 5 --duration 30
+"""
+
+import argparse
+import asyncio
+import datetime
+import random
+import sys
+import time
+from json import dump
+from pathlib import Path
+
+import httpx
+import numpy as np
+
+from benchmarks.run_benchmarks import (
+    RESULTS_DIR,
+    add_profile_arguments,
+    benchmark_mongo_api,
+    git_commit,
+    quiet,
+    seed_database,
+    spec_from_args,
+)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=1000, help="Number of synthetic samples in the database")
+    add_profile_arguments(parser)
+    parser.add_argument('--pollers', type=int, default=50)
+    parser.add_argument('--nn-clients', type=int, default=0)
+    parser.add_argument('--distance-clients', type=int, default=5)
+    parser.add_argument('--dmx-size', type=int, default=100, help="Number of samples per distance calculation")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds to run the load")
+    parser.add_argument('--poll-interval', type=float, default=0.1)
+    parser.add_argument('--poll-timeout', type=float, default=60, help="Give up on a job after this many seconds")
+    parser.add_argument('--full-every', type=int, default=10, help="Pollers fetch the full result every N polls")
+    parser.add_argument('--monitor-interval', type=float, default=0.01, help="Event loop monitor tick in seconds")
+    parser.add_argument('--output', type=Path, help="Report file (default: bench_results/load_<timestamp>.json)")
+    parser.set_defaults(loci=1000)
+    return parser.parse_args()
+
+
+class DetachedASGITransport(httpx.AsyncBaseTransport):
+    """
+    Minimal ASGI transport that returns as soon as the response body is complete and lets the app
+    continue (FastAPI runs background tasks after the response has been sent).
+    """
+    def __init__(self, app):
+        self.app = app
+        self.background = set()
+        self.background_errors = list()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = b"".join([chunk async for chunk in request.stream])
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': request.method,
+            'headers': [(k.lower(), v) for (k, v) in request.headers.raw],
+            'scheme': request.url.scheme,
+            'path': request.url.path,
+            'raw_path': request.url.raw_path.split(b'?')[0],
+            'query_string': request.url.query,
+            'server': (request.url.host, request.url.port),
+            'client': ('127.0.0.1', 123),
+            'root_path': '',
+        }
+        request_sent = False
+        response = {'status': None, 'headers': [], 'body': list()}
+        response_complete = asyncio.Event()
+
+        async def receive():
+            nonlocal request_sent
+            if request_sent:
+                await response_complete.wait()
+                return {'type': 'http.disconnect'}
+            request_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['headers'] = message.get('headers', [])
+            elif message['type'] == 'http.response.body':
+                response['body'].append(message.get('body', b''))
+                if not message.get('more_body', False):
+                    response_complete.set()
+
+        async def run_app():
+            try:
+                await self.app(scope, receive, send)
+            except Exception as e:
+                self.background_errors.append(f"{request.method} {request.url.path}: {type(e).__name__}: {e}")
+                if response['status'] is None:
+                    response['status'] = 500
+                response_complete.set()
+
+        task = asyncio.create_task(run_app())
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+        await response_complete.wait()
+        return httpx.Response(response['status'], headers=response['headers'], content=b"".join(response['body']))
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.samples = dict()
+        self.errors = dict()
+
+    async def request(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs):
+        "Send a request and record its latency under the endpoint name"
+        start = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        self.samples.setdefault(endpoint, list()).append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        return response
+
+    def report(self, duration: float):
+        report = dict()
+        for endpoint, latencies in sorted(self.samples.items()):
+            a = np.array(latencies) * 1000
+            report[endpoint] = {
+                'count': len(a),
+                'errors': self.errors.get(endpoint, 0),
+                'throughput_rps': len(a) / duration,
+                'mean_ms': float(a.mean()),
+                'p50_ms': float(np.percentile(a, 50)),
+                'p95_ms': float(np.percentile(a, 95)),
+                'p99_ms': float(np.percentile(a, 99)),
+                'max_ms': float(a.max()),
+            }
+        return report
+
+
+class LoopMonitor:
+    """
+    Measures event loop blocking: a task that sleeps for a fixed interval should wake up on time,
+    so any extra delay means that something else held the loop.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.lags = list()
+
+    async def run(self, stop_at: float):
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def report(self):
+        lags = np.array(self.lags or [0.0]) * 1000
+        return {
+            'ticks': len(self.lags),
+            'blocked_ms_total': float(lags.sum()),
+            'lag_p50_ms': float(np.percentile(lags, 50)),
+            'lag_p99_ms': float(np.percentile(lags, 99)),
+            'lag_max_ms': float(lags.max()),
+        }
+
+
+async def poll_until_finished(client, recorder, kind: str, job_id: str, args):
+    "Poll a job with level=status until it is no longer 'init'. Returns the final status or None on timeout."
+    give_up_at = time.perf_counter() + args.poll_timeout
+    while time.perf_counter() < give_up_at:
+        response = await recorder.request(client, f"GET /v1/{kind}/{{id}}?level=status", 'GET', f"/v1/{kind}/{job_id}", params={'level': 'status'})
+        if response.status_code != 200:
+            return None
+        status = response.json()['status']
+        if status != 'init':
+            return status
+        await asyncio.sleep(args.poll_interval)
+    return None
+
+
+async def job_client(client, recorder, kind: str, make_body, stop_at: float, args, stats: dict):
+    "POST a job, poll until it has finished, fetch the full result, repeat."
+    while time.perf_counter() < stop_at:
+        response = await recorder.request(client, f"POST /v1/{kind}", 'POST', f"/v1/{kind}", json=make_body())
+        if response.status_code != 201:
+            stats['rejected'] += 1
+            continue
+        job_id = response.json()['job_id']
+        status = await poll_until_finished(client, recorder, kind, job_id, args)
+        if status is None:
+            stats['poll_timeouts'] += 1
+            continue
+        stats[status] = stats.get(status, 0) + 1
+        await recorder.request(client, f"GET /v1/{kind}/{{id}}", 'GET', f"/v1/{kind}/{job_id}")
+
+
+async def poller(client, recorder, kind: str, job_ids: list, stop_at: float, args):
+    "Poll existing jobs like a browser tab that keeps refreshing."
+    polls = 0
+    while time.perf_counter() < stop_at:
+        job_id = random.choice(job_ids)
+        polls += 1
+        if polls % args.full_every == 0:
+            await recorder.request(client, f"GET /v1/{kind}/{{id}}", 'GET', f"/v1/{kind}/{job_id}")
+        else:
+            await recorder.request(client, f"GET /v1/{kind}/{{id}}?level=status", 'GET', f"/v1/{kind}/{job_id}", params={'level': 'status'})
+        await asyncio.sleep(args.poll_interval)
+
+
+async def seed_polled_jobs(sample_ids: list, count: int = 10, neighbors: int = 100):
+    "Create some completed nearest neighbors jobs for the pollers to poll"
+    import calculations
+    job_ids = list()
+    for i in range(count):
+        nn = calculations.NearestNeighbors(input_mongo_id=str(sample_ids[i]))
+        with quiet():
+            await nn.insert_document()
+            await nn.store_result([{'_id': _id, 'diff_count': j % 15} for j, _id in enumerate(sample_ids[:neighbors])])
+        job_ids.append(str(nn._id))
+    return job_ids
+
+
+async def run_load(args):
+    import main
+    import calculations
+    import tempfile
+
+    mongo_api = benchmark_mongo_api(args.mongo)
+    sample_ids = seed_database(mongo_api, spec_from_args(args, args.samples), args.cutoff)
+    sample_id_strs = [str(_id) for _id in sample_ids]
+    polled_jobs = await seed_polled_jobs(sample_ids)
+
+    recorder = LatencyRecorder()
+    monitor = LoopMonitor(args.monitor_interval)
+    stats = {'rejected': 0, 'poll_timeouts': 0}
+    transport = DetachedASGITransport(main.app)
+
+    with tempfile.TemporaryDirectory(prefix='bio_api_load_') as dmx_dir:
+        calculations.DMX_DIR = dmx_dir
+        async with httpx.AsyncClient(transport=transport, base_url="http://load", timeout=None) as client:
+            start = time.perf_counter()
+            stop_at = start + args.duration
+            clients = [monitor.run(stop_at)]
+            clients += [poller(client, recorder, 'nearest_neighbors', polled_jobs, stop_at, args) for _ in range(args.pollers)]
+            clients += [
+                job_client(client, recorder, 'nearest_neighbors',
+                    lambda: {'input_mongo_id': random.choice(sample_id_strs)}, stop_at, args, stats)
+                for _ in range(args.nn_clients)
+            ]
+            clients += [
+                job_client(client, recorder, 'distance_calculations',
+                    lambda: {'seq_mongo_ids': random.sample(sample_id_strs, min(args.dmx_size, len(sample_id_strs)))}, stop_at, args, stats)
+                for _ in range(args.distance_clients)
+            ]
+            with quiet():
+                await asyncio.gather(*clients)
+            duration = time.perf_counter() - start
+            # Let running calculations finish before the DMX_DIR is removed
+            if transport.background:
+                await asyncio.wait(transport.background)
+
+    return {
+        'duration_s': duration,
+        'endpoints': recorder.report(duration),
+        'event_loop': monitor.report(),
+        'jobs': stats,
+        'background_errors': sorted(set(transport.background_errors)),
+    }
+
+
+def print_report(report: dict):
+    print(f"{'endpoint':<52}{'count':>7}{'err':>5}{'rps':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for endpoint, r in report['endpoints'].items():
+        print(f"{endpoint:<52}{r['count']:>7}{r['errors']:>5}{r['throughput_rps']:>8.1f}{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}")
+    loop = report['event_loop']
+    print(f"Event loop blocked {loop['blocked_ms_total']:.0f} ms in total, max lag {loop['lag_max_ms']:.1f} ms, p99 lag {loop['lag_p99_ms']:.1f} ms")
+    print(f"Jobs: {report['jobs']}")
+    for error in report['background_errors']:
+        print(f"Background error: {error}", file=sys.stderr)
+
+
+def main():
+    args = parse_arguments()
+    report = asyncio.run(run_load(args))
+    print_report(report)
+    output = args.output
+    if output is None:
+        timestamp = datetime.datetime.now(tz=datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        output = RESULTS_DIR.joinpath(f'load_{timestamp}.json')
+    output.parent.mkdir(parents=True, exist_ok=True)
+    report.update({
+        'created_at': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        'git_commit': git_commit(),
+        'backend': 'mongodb' if args.mongo else 'mongomock',
+        'parameters': {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items()},
+    })
+    with open(output, 'w') as f:
+        dump(report, f, indent=2)
+    print(f"Report written to {output}")
+
+
+if __name__ == '__main__':
+    main()
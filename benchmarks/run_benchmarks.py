@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+Reproducible performance benchmarks for Bio API.
+
+Synthetic sample documents (see synthetic_profiles.py) are inserted into mongomock (default) or a
+throwaway MongoDB database, and the following code paths are timed at each requested scale:
+
+- nearest_neighbors:     NearestNeighbors.calculate() with the aggregation pipeline
+- nearest_neighbors_numpy: NearestNeighbors.calculate() with the integer encoded 'numpy' engine
+- nearest_neighbors_bitslice_build: first NearestNeighbors.calculate() with the 'bitslice' engine (builds the index)
+- nearest_neighbors_bitslice: NearestNeighbors.calculate() with the cached bit-sliced index
+- dmx_tsv:               DistanceCalculation profile fetch + allele matrix TSV build
+- dmx_distances:         DistanceCalculation distance step (cgmlst-dists) + saving the distance matrix array
+- dmx_numpy:             DistanceCalculation profile fetch + encoding + distances with the 'numpy' engine
+- tree_<method>:         make_tree_from_array() on the resulting distance matrix
+- get_nearest_neighbors: GET /v1/nearest_neighbors/{id} for a large stored neighbor list
+- get_distance_matrix:   GET /v1/distance_calculations/{id} with the full matrix embedded
+- startup:               cold import of the API (python -c 'import main') in a new process, checked against --startup-budget
+
+Results are written as JSON so that two runs can be compared with --compare.
+
+Examples:
+    python -m benchmarks.run_benchmarks --scales 1000 10000
+    python -m benchmarks.run_benchmarks --mongo mongodb://localhost:27017/bio_api_bench --scales 100000
+    python -m benchmarks.run_benchmarks --compare bench_results/old.json bench_results/new.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from json import dump, load
+from pathlib import Path
+from statistics import mean, median
+
+import numpy as np
+from pandas import DataFrame
+
+from benchmarks.synthetic_profiles import ProfileSpec, insert_samples, config_sections
+
+RESULTS_DIR = Path('bench_results')
+# Modules that must not be imported when the API starts; they are imported by the calculations that use them
+LAZY_MODULES = ('pandas', 'scipy', 'pyarrow', 'aio_pika')
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    "Arguments for the synthetic data and the database backend, shared with the load test"
+    parser.add_argument('--loci', type=int, default=ProfileSpec.locus_count)
+    parser.add_argument('--cardinality', type=int, default=ProfileSpec.allele_cardinality)
+    parser.add_argument('--missing-rate', type=float, default=ProfileSpec.missing_rate)
+    parser.add_argument('--clusters', type=int, default=ProfileSpec.cluster_count)
+    parser.add_argument('--mutation-rate', type=float, default=ProfileSpec.cluster_mutation_rate)
+    parser.add_argument('--hashed-rate', type=float, default=ProfileSpec.hashed_allele_rate)
+    parser.add_argument('--digests', nargs='+', default=['schema_digest_1', 'schema_digest_2'])
+    parser.add_argument('--seed', type=int, default=ProfileSpec.seed)
+    parser.add_argument('--cutoff', type=int, default=15, help="Nearest neighbors cutoff")
+    parser.add_argument('--mongo', help="Connection string for a throwaway MongoDB database (default: mongomock)")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 100000], help="Sample counts to benchmark")
+    add_profile_arguments(parser)
+    parser.add_argument('--dmx-max', type=int, default=2000, help="Max number of samples in distance matrix and tree benchmarks")
+    parser.add_argument('--tree-methods', nargs='+', default=['single', 'average'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--startup-budget', type=float, default=1.0, help="Max seconds for a cold import of the API")
+    parser.add_argument('--only', nargs='+', help="Only run benchmarks whose name starts with one of these prefixes")
+    parser.add_argument('--output', type=Path, help="Result file (default: bench_results/bench_<timestamp>.json)")
+    parser.add_argument('--compare', type=Path, nargs=2, metavar=('BASELINE', 'CANDIDATE'), help="Compare two result files and exit")
+    return parser.parse_args()
+
+
+def quiet():
+    "The calculations print a lot of diagnostics; this swallows them"
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class BenchmarkRun:
+    def __init__(self, repeat: int, only: list | None):
+        self.repeat = repeat
+        self.only = only
+        self.results = list()
+
+    def wanted(self, name: str):
+        return self.only is None or any(name.startswith(prefix) for prefix in self.only)
+
+    async def measure(self, name: str, scale: int, n: int, fn, setup=None, **extra):
+        """
+        Run the coroutine function fn() self.repeat times and record the timings.
+        setup() (if given) is run before each repetition and is not timed.
+        The return value of the last repetition is returned.
+        """
+        if not self.wanted(name):
+            return None
+        timings = list()
+        value = None
+        for _ in range(self.repeat):
+            if setup:
+                await setup()
+            with quiet():
+                start = time.perf_counter()
+                try:
+                    value = await fn()
+                except NotImplementedError as e:
+                    # mongomock does not implement all aggregation operators (e.g. $zip)
+                    print(f"{name:<28} scale={scale:<8} skipped: {e}", file=sys.stderr)
+                    return None
+                timings.append(time.perf_counter() - start)
+        result = {
+            'benchmark': name,
+            'scale': scale,
+            'n': n,
+            'timings': timings,
+            'min': min(timings),
+            'median': median(timings),
+            'mean': mean(timings),
+            'max_rss_mb': max_rss_mb(),
+            **extra
+        }
+        print(f"{name:<28} scale={scale:<8} n={n:<8} median={result['median']:.4f}s min={result['min']:.4f}s")
+        self.results.append(result)
+        return value
+
+    def annotate(self, name: str, scale: int, **extra):
+        "Add extra fields to an already recorded result"
+        for result in self.results:
+            if result['benchmark'] == name and result['scale'] == scale:
+                result.update(extra)
+
+
+def fallback_distances(allele_mx_df: DataFrame):
+    """
+    Compute a distance matrix like cgmlst-dists does (non-numeric calls count as missing).
+    Only used for producing an input for the tree and GET benchmarks when cgmlst-dists is not installed.
+    """
+    m = allele_mx_df.apply(lambda col: col.map(lambda v: int(v) if v.isdigit() else 0)).to_numpy()
+    known = m > 0
+    dist = np.zeros((len(m), len(m)), dtype=int)
+    for i in range(len(m)):
+        dist[i] = ((m != m[i]) & known & known[i]).sum(axis=1)
+    return DataFrame(dist, index=allele_mx_df.index, columns=allele_mx_df.index)
+
+
+def startup_modules():
+    "Cold import main in a new process and return the lazily imported modules that were imported anyway"
+    code = f"import sys, main; print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    completed = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return completed.stdout.split()
+
+
+async def measure_startup(run: BenchmarkRun, budget: float):
+    async def startup():
+        return await asyncio.to_thread(startup_modules)
+
+    imported = await run.measure('startup', 0, 1, startup)
+    if imported is None:
+        return
+    result = next(r for r in run.results if r['benchmark'] == 'startup')
+    over_budget = result['median'] > budget
+    run.annotate('startup', 0, budget_seconds=budget, over_budget=over_budget, eagerly_imported=imported)
+    if over_budget or imported:
+        print(f"startup is over its budget of {budget}s or imports {imported}", file=sys.stderr)
+
+
+def spec_from_args(args, sample_count: int):
+    return ProfileSpec(
+        sample_count=sample_count,
+        locus_count=args.loci,
+        allele_cardinality=args.cardinality,
+        missing_rate=args.missing_rate,
+        cluster_count=args.clusters,
+        cluster_mutation_rate=args.mutation_rate,
+        hashed_allele_rate=args.hashed_rate,
+        schema_digests=args.digests,
+        seed=args.seed,
+    )
+
+
+def seed_database(mongo_api, spec: ProfileSpec, cutoff: int):
+    "Replace samples, config and calculation collections with fresh synthetic data. Returns the sample _ids."
+    db = mongo_api.db
+    for name in ['samples', 'BioAPI_config', 'nearest_neighbors', 'dist_calculations', 'tree_calculations']:
+        db[name].drop()
+    db['BioAPI_config'].insert_many(config_sections(cutoff=cutoff))
+    start = time.perf_counter()
+    sample_ids = insert_samples(db['samples'], spec)
+    print(f"Inserted {spec.sample_count} synthetic samples in {time.perf_counter() - start:.1f}s")
+    return sample_ids
+
+
+async def run_scale(run: BenchmarkRun, args, mongo_api, scale: int):
+    import calculations
+    import main
+    from httpx import AsyncClient
+    from tree_maker import make_tree_from_array
+    from allele_encoding import get_codebook
+    from profile_store import profile_store
+
+    sample_ids = seed_database(mongo_api, spec_from_args(args, scale), args.cutoff)
+
+    # Nearest neighbors
+    nn = calculations.NearestNeighbors(input_mongo_id=str(sample_ids[0]))
+    nn.input_sequence = await nn.query_mongodb_for_input_profile()
+    with quiet():
+        await nn.insert_document()
+    nn.engine = 'mongo'
+    await run.measure('nearest_neighbors', scale, scale, nn.calculate, cutoff=nn.cutoff)
+    nn.engine = 'numpy'
+    await run.measure('nearest_neighbors_numpy', scale, scale, nn.calculate, cutoff=nn.cutoff)
+    nn.engine = 'bitslice'
+
+    async def clear_profile_store():
+        profile_store.matrices.clear()
+
+    await run.measure('nearest_neighbors_bitslice_build', scale, scale, nn.calculate, setup=clear_profile_store)
+    with quiet():
+        await nn.calculate()  # builds the index if the build benchmark was not wanted
+    await run.measure('nearest_neighbors_bitslice', scale, scale, nn.calculate, cutoff=nn.cutoff)
+    if profile_store.matrices:
+        matrix = next(iter(profile_store.matrices.values()))
+        run.annotate('nearest_neighbors_bitslice', scale, index_bytes=int(matrix.bitslice.nbytes))
+
+    # Distance matrix: TSV build and distance step
+    dmx_ids = [str(_id) for _id in sample_ids[:args.dmx_max]]
+    dc = calculations.DistanceCalculation(seq_mongo_ids=dmx_ids)
+    with quiet():
+        await dc.insert_document()
+
+    async def build_tsv():
+        _count, cursor = await dc.query_mongodb_for_allele_profiles()
+        allele_mx_df, mongo_ids = await dc._amx_df_from_mongodb_cursor(cursor)
+        await dc._save_amx_df_as_tsv(allele_mx_df)
+        return allele_mx_df, mongo_ids
+
+    built = await run.measure('dmx_tsv', scale, len(dmx_ids), build_tsv)
+    if built is None:
+        built = await build_tsv()
+    allele_mx_df, mongo_ids = built
+    run.annotate('dmx_tsv', scale, allele_matrix_bytes=int(allele_mx_df.memory_usage(deep=True).sum()))
+
+    async def numpy_distances():
+        _count, cursor = await dc.query_mongodb_for_allele_profiles()
+        return await dc._dmx_array_from_mongodb_cursor(cursor)
+
+    if await run.measure('dmx_numpy', scale, len(dmx_ids), numpy_distances):
+        # The benchmark config has no digest_path for distance calculations, so the 'default' codebook is used
+        encoded = get_codebook(mongo_api.db, 'default').encode(list(allele_mx_df.to_dict(orient='index').values()))
+        run.annotate('dmx_numpy', scale, encoded_matrix_bytes=int(encoded.nbytes))
+
+    async def distance_step():
+        dist_mx_df = await dc._dmx_df_from_amx_tsv()
+        await dc._save_dmx_as_array(list(dist_mx_df.index), dist_mx_df.to_numpy())
+        return dist_mx_df
+
+    if shutil.which('cgmlst-dists'):
+        dist_mx_df = await run.measure('dmx_distances', scale, len(dmx_ids), distance_step)
+        if dist_mx_df is None:
+            dist_mx_df = await distance_step()
+    else:
+        print("cgmlst-dists not found in PATH; skipping dmx_distances and using fallback distances")
+        dist_mx_df = fallback_distances(allele_mx_df)
+        await dc._save_dmx_as_array(list(dist_mx_df.index), dist_mx_df.to_numpy())
+    with quiet():
+        await dc.store_result({'seq_to_mongo': mongo_ids})
+
+    # Trees
+    sequence_ids, distances = list(dist_mx_df.index), dist_mx_df.to_numpy()
+    for method in args.tree_methods:
+        async def tree(method=method):
+            return make_tree_from_array(distances, sequence_ids, method)
+        await run.measure(f'tree_{method}', scale, len(dmx_ids), tree)
+
+    # GET serialization paths, using all other samples as neighbors to get a large result
+    nn.result = [{'_id': _id, 'diff_count': i % args.cutoff} for i, _id in enumerate(sample_ids[1:])]
+    with quiet():
+        await nn.store_result(nn.result)
+    async with AsyncClient(app=main.app, base_url="http://bench") as client:
+        async def get_nn():
+            response = await client.get(f"/v1/nearest_neighbors/{nn._id}")
+            assert response.status_code == 200, response.text
+            return len(response.content)
+
+        async def get_dmx():
+            response = await client.get(f"/v1/distance_calculations/{dc._id}")
+            assert response.status_code == 200, response.text
+            return len(response.content)
+
+        nn_bytes = await run.measure('get_nearest_neighbors', scale, len(nn.result), get_nn)
+        run.annotate('get_nearest_neighbors', scale, response_bytes=nn_bytes)
+        dmx_bytes = await run.measure('get_distance_matrix', scale, len(dmx_ids), get_dmx)
+        run.annotate('get_distance_matrix', scale, response_bytes=dmx_bytes)
+
+
+def benchmark_mongo_api(connection_string: str | None):
+    """
+    Return a MongoAPI for a throwaway MongoDB database, or for an in-memory mongomock database
+    if no connection string is given, and make the calculations use it.
+    """
+    import calculations
+
+    if connection_string:
+        from mongo import MongoAPI
+        mongo_api = MongoAPI(connection_string)
+        if not any(word in mongo_api.db.name for word in ('bench', 'test')):
+            sys.exit(f"Refusing to use database '{mongo_api.db.name}': the benchmark drops collections, " +
+                "so use a database with 'bench' or 'test' in its name.")
+    else:
+        import mongomock
+        from tests.mongo_mock import MongoAPI as MockMongoAPI
+        mongo_api = MockMongoAPI(db=mongomock.MongoClient()['bio_api_bench'])
+    calculations.Calculation.set_mongo_api(mongo_api)
+    return mongo_api
+
+
+async def run_all(args):
+    import calculations
+
+    mongo_api = benchmark_mongo_api(args.mongo)
+
+    run = BenchmarkRun(args.repeat, args.only)
+    await measure_startup(run, args.startup_budget)
+    with tempfile.TemporaryDirectory(prefix='bio_api_bench_') as dmx_dir:
+        calculations.DMX_DIR = dmx_dir
+        for scale in args.scales:
+            await run_scale(run, args, mongo_api, scale)
+    return run.results
+
+
+def write_results(args, results):
+    output = args.output
+    if output is None:
+        timestamp = datetime.datetime.now(tz=datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        output = RESULTS_DIR.joinpath(f'bench_{timestamp}.json')
+    output.parent.mkdir(parents=True, exist_ok=True)
+    import pandas
+    report = {
+        'created_at': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        'git_commit': git_commit(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'pandas': pandas.__version__,
+        'backend': 'mongodb' if args.mongo else 'mongomock',
+        'cgmlst_dists': shutil.which('cgmlst-dists'),
+        'parameters': {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items()},
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+def compare(baseline_path: Path, candidate_path: Path):
+    "Print median timings of two result files side by side"
+    with open(baseline_path) as f:
+        baseline = {(r['benchmark'], r['scale']): r for r in load(f)['results']}
+    with open(candidate_path) as f:
+        candidate = {(r['benchmark'], r['scale']): r for r in load(f)['results']}
+    print(f"{'benchmark':<28}{'scale':>9}{'baseline':>12}{'candidate':>12}{'speedup':>10}")
+    for key in sorted(baseline.keys() & candidate.keys(), key=lambda k: (k[1], k[0])):
+        b, c = baseline[key]['median'], candidate[key]['median']
+        speedup = b / c if c else float('inf')
+        print(f"{key[0]:<28}{key[1]:>9}{b:>12.4f}{c:>12.4f}{speedup:>9.2f}x")
+
+
+def main():
+    args = parse_arguments()
+    if args.compare:
+        compare(*args.compare)
+        return
+    results = asyncio.run(run_all(args))
+    write_results(args, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Generator for synthetic cgMLST 'samples' documents.
+
+The documents follow the same structure as the sequence documents Bio API reads in production
+(see example_config.yaml for the field paths), so they can be inserted into MongoDB (or mongomock)
+and used as input for NearestNeighbors, DistanceCalculation and the tree calculations.
+
+Samples are drawn from a number of clonal clusters. Each cluster has a founder profile, and each
+sample in the cluster differs from the founder at a small number of loci. On top of that a
+configurable fraction of the calls is replaced by one of the 'unknown' allele codes (LNF, NIPH etc.).
+"""
+
+import argparse
+import hashlib
+import sys
+from dataclasses import dataclass, field, asdict
+from json import dump
+
+import numpy as np
+from bson.objectid import ObjectId
+
+from allele_encoding import IGNORED_ALLELE_VALUES
+
+
+SEQID_FIELD_PATH = 'categories.sample_info.summary.sofi_sequence_id'
+PROFILE_FIELD_PATH = 'categories.cgmlst.report.alleles'
+ALLELE_PATH = 'categories.cgmlst.report.allele_array'
+DIGEST_PATH = 'categories.cgmlst.report.schema.digest'
+CALL_PCT_PATH = 'categories.cgmlst.summary.call_percent'
+
+
+@dataclass
+class ProfileSpec:
+    sample_count: int = 1000
+    locus_count: int = 3000
+    allele_cardinality: int = 100  # Number of distinct alleles per locus
+    missing_rate: float = 0.01  # Fraction of calls replaced with an unknown allele code
+    cluster_count: int = 50  # Number of clonal clusters
+    cluster_mutation_rate: float = 0.002  # Fraction of loci where a sample differs from its cluster founder
+    hashed_allele_rate: float = 0.0  # Fraction of alleles that are reported as hashes instead of numbers
+    schema_digests: list = field(default_factory=lambda: ['schema_digest_1'])
+    shapes: tuple = ('alleles', 'allele_array')  # Which profile shapes to put in the documents
+    seed: int = 0
+
+
+def _allele_name(locus: int, allele: int, hashed: bool):
+    if hashed:
+        return hashlib.sha1(f"{locus}:{allele}".encode()).hexdigest()
+    return str(allele)
+
+
+def _set_nested(doc: dict, dotted_field_path: str, value):
+    path_elements = dotted_field_path.split('.')
+    for path_element in path_elements[:-1]:
+        doc = doc.setdefault(path_element, dict())
+    doc[path_elements[-1]] = value
+
+
+def generate_samples(spec: ProfileSpec):
+    """
+    Yield synthetic sample documents one at a time, so that large collections can be
+    inserted in batches without keeping all documents in memory.
+    """
+    rng = np.random.default_rng(spec.seed)
+    locus_names = [f"locus{i + 1}" for i in range(spec.locus_count)]
+    founders = rng.integers(1, spec.allele_cardinality + 1, size=(spec.cluster_count, spec.locus_count))
+    hashed_loci = rng.random(spec.locus_count) < spec.hashed_allele_rate
+
+    for sample_number in range(spec.sample_count):
+        cluster = int(rng.integers(spec.cluster_count))
+        profile = founders[cluster].copy()
+        mutated = rng.random(spec.locus_count) < spec.cluster_mutation_rate
+        profile[mutated] = rng.integers(1, spec.allele_cardinality + 1, size=int(mutated.sum()))
+        missing = rng.random(spec.locus_count) < spec.missing_rate
+        unknown_codes = rng.choice(IGNORED_ALLELE_VALUES, size=int(missing.sum()))
+
+        allele_array = [_allele_name(i, int(a), hashed_loci[i]) for i, a in enumerate(profile)]
+        for locus_index, code in zip(np.flatnonzero(missing), unknown_codes):
+            allele_array[locus_index] = str(code)
+        call_count = spec.locus_count - int(missing.sum())
+
+        doc = {'_id': ObjectId()}
+        _set_nested(doc, SEQID_FIELD_PATH, f"SYN{sample_number:07d}")
+        _set_nested(doc, 'categories.sample_info.summary.cluster', cluster)
+        _set_nested(doc, CALL_PCT_PATH, round(100 * call_count / spec.locus_count, 2))
+        _set_nested(doc, DIGEST_PATH, spec.schema_digests[sample_number % len(spec.schema_digests)])
+        if 'alleles' in spec.shapes:
+            _set_nested(doc, PROFILE_FIELD_PATH, dict(zip(locus_names, allele_array)))
+        if 'allele_array' in spec.shapes:
+            _set_nested(doc, ALLELE_PATH, allele_array)
+        yield doc
+
+
+def insert_samples(collection, spec: ProfileSpec, batch_size: int = 1000):
+    "Insert synthetic samples into a (Mongo or mongomock) collection. Returns the list of inserted _ids."
+    ids = list()
+    batch = list()
+    for doc in generate_samples(spec):
+        batch.append(doc)
+        if len(batch) == batch_size:
+            collection.insert_many(batch)
+            ids.extend(d['_id'] for d in batch)
+            batch = list()
+    if batch:
+        collection.insert_many(batch)
+        ids.extend(d['_id'] for d in batch)
+    return ids
+
+
+def config_sections(seq_collection: str = 'samples', cutoff: int = 15):
+    "BioAPI_config sections matching the synthetic document structure."
+    return [
+        {
+            'section': 'nearest_neighbors',
+            'seq_collection': seq_collection,
+            'filtering': {},
+            'profile_field_path': PROFILE_FIELD_PATH,
+            'allele_path': ALLELE_PATH,
+            'digest_path': DIGEST_PATH,
+            'call_pct_path': CALL_PCT_PATH,
+            'cutoff': cutoff,
+            'unknowns_are_diffs': True,
+        },
+        {
+            'section': 'dist_calculations',
+            'seq_collection': seq_collection,
+            'seqid_field_path': SEQID_FIELD_PATH,
+            'profile_field_path': PROFILE_FIELD_PATH,
+        },
+    ]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Write synthetic cgMLST sample documents as JSON lines")
+    parser.add_argument('output', type=argparse.FileType('w'))
+    parser.add_argument('--samples', type=int, default=ProfileSpec.sample_count)
+    parser.add_argument('--loci', type=int, default=ProfileSpec.locus_count)
+    parser.add_argument('--cardinality', type=int, default=ProfileSpec.allele_cardinality)
+    parser.add_argument('--missing-rate', type=float, default=ProfileSpec.missing_rate)
+    parser.add_argument('--clusters', type=int, default=ProfileSpec.cluster_count)
+    parser.add_argument('--mutation-rate', type=float, default=ProfileSpec.cluster_mutation_rate)
+    parser.add_argument('--hashed-rate', type=float, default=ProfileSpec.hashed_allele_rate)
+    parser.add_argument('--digests', nargs='+', default=['schema_digest_1'])
+    parser.add_argument('--seed', type=int, default=ProfileSpec.seed)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    spec = ProfileSpec(
+        sample_count=args.samples,
+        locus_count=args.loci,
+        allele_cardinality=args.cardinality,
+        missing_rate=args.missing_rate,
+        cluster_count=args.clusters,
+        cluster_mutation_rate=args.mutation_rate,
+        hashed_allele_rate=args.hashed_rate,
+        schema_digests=args.digests,
+        seed=args.seed,
+    )
+    for doc in generate_samples(spec):
+        doc['_id'] = {'$oid': str(doc['_id'])}  # MongoDB extended JSON, usable with mongoimport
+        dump(doc, args.output)
+        args.output.write('\n')
+    # stderr, so that the spec does not end up in the JSONL when it is written to stdout
+    print(f"Spec: {asdict(spec)}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
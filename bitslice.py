@@ -0,0 +1,155 @@
+import numpy as np
+
+from allele_encoding import compared_calls
+from hamming import saturating_dtype
+
+# Samples are packed 64 to a machine word. Sample s is bit s % 64 of word s // 64.
+WORD_BITS = 64
+ALL_ONES = np.uint64(0xFFFFFFFFFFFFFFFF)
+# Number of loci to transpose and pack at a time when building an index
+BUILD_CHUNK_LOCI = 256
+
+
+def pack_bits(bits: np.ndarray):
+    "Pack a boolean array along the last axis into little-endian uint64 words"
+    packed = np.packbits(bits, axis=-1, bitorder='little')
+    padding = -packed.shape[-1] % 8
+    if padding:
+        packed = np.concatenate([packed, np.zeros(packed.shape[:-1] + (padding,), dtype=np.uint8)], axis=-1)
+    return np.ascontiguousarray(packed).view('<u8')
+
+
+def unpack_bits(words: np.ndarray, count: int):
+    "Inverse of pack_bits: return the first count bits along the last axis as a boolean array"
+    return np.unpackbits(np.ascontiguousarray(words, dtype='<u8').view(np.uint8), axis=-1, bitorder='little')[..., :count].astype(bool)
+
+
+def bitsliced_sum(bits: np.ndarray):
+    """
+    Add up m bit vectors (an (m, W) array of words) sample by sample.
+
+    The result is a binary number per sample, stored as bit planes: an (K, W) array where plane j holds
+    bit j of every sample's sum. The vectors are added pairwise in a tree of ripple-carry adders, so all
+    operations are XOR/AND/OR over whole words (64 samples at a time).
+    """
+    numbers = bits[:, None, :]  # m numbers, each 1 bit wide
+    while len(numbers) > 1:
+        if len(numbers) % 2:
+            numbers = np.concatenate([numbers, np.zeros_like(numbers[:1])])
+        a, b = numbers[0::2], numbers[1::2]
+        width = numbers.shape[1]
+        total = np.empty((len(a), width + 1, numbers.shape[2]), dtype=np.uint64)
+        carry = np.zeros((len(a), numbers.shape[2]), dtype=np.uint64)
+        for j in range(width):
+            half = a[:, j] ^ b[:, j]
+            total[:, j] = half ^ carry
+            carry = (a[:, j] & b[:, j]) | (carry & half)
+        total[:, width] = carry
+        numbers = total
+    return numbers[0]
+
+
+def planes_to_counts(planes: np.ndarray, count: int):
+    "Turn bit planes from bitsliced_sum into an integer per sample"
+    counts = np.zeros(count, dtype=np.int64)
+    for j, plane in enumerate(planes):
+        counts += unpack_bits(plane, count).astype(np.int64) << j
+    return counts
+
+
+class BitSlicedIndex:
+    """
+    Bit-sliced representation of a matrix of integer encoded allele profiles (see allele_encoding).
+
+    For every locus, bit b of every sample's allele code is stored in a bit plane with one bit per sample,
+    and a separate plane marks the samples where the call is one of the ignored allele values. Comparing a
+    query profile with all samples then means XOR'ing the planes with the query's bits, OR'ing the results,
+    masking out ignored calls and adding up the mismatch bits per sample, all 64 samples per word operation.
+    Ignored calls in either the query or the sample are not counted and missing calls are compared like any
+    other call, like in NearestNeighbors.pipeline_prod().
+    """
+    def __init__(self, codes: np.ndarray):
+        self.sample_count, self.locus_count = codes.shape
+        max_code = int(codes.max()) if codes.size else 0
+        self.bit_count = max(max_code.bit_length(), 1)
+        word_count = -(-self.sample_count // WORD_BITS)
+        self.planes = np.empty((self.locus_count, self.bit_count, word_count), dtype=np.uint64)
+        self.ignored = np.empty((self.locus_count, word_count), dtype=np.uint64)
+        for start in range(0, self.locus_count, BUILD_CHUNK_LOCI):
+            codes_t = np.ascontiguousarray(codes[:, start:start + BUILD_CHUNK_LOCI].T)
+            for b in range(self.bit_count):
+                self.planes[start:start + len(codes_t), b] = pack_bits(((codes_t >> b) & 1).astype(bool))
+            self.ignored[start:start + len(codes_t)] = pack_bits(~compared_calls(codes_t))
+
+    @classmethod
+    def from_arrays(cls, planes: np.ndarray, ignored: np.ndarray, sample_count: int):
+        "Create an index from existing planes (e.g. memory-mapped from a file) without rebuilding it"
+        index = cls.__new__(cls)
+        index.sample_count = sample_count
+        index.locus_count, index.bit_count = planes.shape[:2]
+        index.planes = planes
+        index.ignored = ignored
+        return index
+
+    @property
+    def nbytes(self):
+        return self.planes.nbytes + self.ignored.nbytes
+
+    def _query_codes(self, query: np.ndarray):
+        "Truncate or pad (with missing calls) the query to the number of loci in the index"
+        query = np.asarray(query)[:self.locus_count]
+        if len(query) < self.locus_count:
+            query = np.concatenate([query, np.zeros(self.locus_count - len(query), dtype=query.dtype)])
+        return query.astype(np.uint64)
+
+    def shard_sample_count(self, words: slice):
+        "Return the number of samples in a range of words"
+        start, stop, _step = words.indices(self.ignored.shape[1])
+        return max(min(stop * WORD_BITS, self.sample_count) - start * WORD_BITS, 0)
+
+    def mismatch_bits(self, query: np.ndarray, words: slice = slice(None)):
+        """
+        Return an (loci, words) array with a bit set where a sample differs from the query at a locus.
+        Only the samples in the given range of words are compared.
+        """
+        query = self._query_codes(query)
+        ignored = self.ignored[:, words]
+        mismatch = np.zeros(ignored.shape, dtype=np.uint64)
+        for b in range(self.bit_count):
+            query_bit_masks = np.where((query >> np.uint64(b)) & np.uint64(1), ALL_ONES, np.uint64(0))
+            mismatch |= self.planes[:, b, words] ^ query_bit_masks[:, None]
+        # A query code that needs more bits than the index has differs from all samples
+        mismatch[query >= (1 << self.bit_count)] = ALL_ONES
+        mismatch &= ~ignored
+        mismatch[~compared_calls(query)] = 0
+        return mismatch
+
+    def count_differences(self, query: np.ndarray, words: slice = slice(None)):
+        """
+        Count the differences between the query profile and every sample in the index, or only the samples
+        in a range of words (samples words.start * 64 and up) so that shards can be counted in parallel.
+        """
+        sample_count = self.shard_sample_count(words)
+        if sample_count == 0:
+            return np.zeros(0, dtype=np.int64)
+        return planes_to_counts(bitsliced_sum(self.mismatch_bits(query, words)), sample_count)
+
+
+def distance_matrix(profiles: np.ndarray, on_progress=None, max_distance: int | None = None):
+    """
+    Return the symmetric matrix of pairwise differences between encoded profiles using a bit-sliced index.
+    If max_distance is given, the differences are saturated at max_distance + 1 like in
+    hamming.distance_matrix. They are still counted at all loci, as all samples in a word are counted at once.
+    on_progress(rows_done, row_count) is called after each row if given.
+    """
+    index = BitSlicedIndex(profiles)
+    if max_distance is None:
+        distances = np.zeros((len(profiles), len(profiles)), dtype=np.int32)
+    else:
+        distances = np.zeros((len(profiles), len(profiles)), dtype=saturating_dtype(max_distance))
+    for i, profile in enumerate(profiles):
+        counts = index.count_differences(profile)
+        distances[i] = counts if max_distance is None else np.minimum(counts, max_distance + 1)
+        if on_progress is not None:
+            on_progress(i + 1, len(profiles))
+    return distances
@@ -0,0 +1,239 @@
+import datetime
+import threading
+import time
+from os import getenv
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# Cluster membership, one document per (schema, threshold, sample)
+MEMBER_COLLECTION = 'cluster_members'
+# One document per merge of two or more clusters
+MERGE_COLLECTION = 'cluster_merges'
+# Per (schema, threshold): the last cluster id, a version that is bumped on every change and the claim of the
+# process that is changing the clusters
+COUNTER_COLLECTION = 'cluster_counters'
+# A claim older than this (in seconds) is considered left behind by a crashed process
+CLUSTER_CLAIM_TIMEOUT = float(getenv('CLUSTER_CLAIM_TIMEOUT', 60))
+# Seconds between attempts to claim clusters that another process is changing
+CLUSTER_CLAIM_RETRY_INTERVAL = 0.05
+
+
+class UnionFind:
+    "Disjoint sets with union by size and path halving"
+    def __init__(self):
+        self.parent = dict()
+        self.size = dict()
+
+    def __contains__(self, item):
+        return item in self.parent
+
+    def __len__(self):
+        return len(self.parent)
+
+    def add(self, item):
+        if item not in self.parent:
+            self.parent[item] = item
+            self.size[item] = 1
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        "Merge the sets of a and b and return the root of the merged set"
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return root_a
+        if self.size[root_a] < self.size[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.size[root_a] += self.size.pop(root_b)
+        return root_a
+
+    def components(self):
+        "Return the sets as a dict of {root: [items]}"
+        components = dict()
+        for item in self.parent:
+            components.setdefault(self.find(item), list()).append(item)
+        return components
+
+
+class ClusterIndex:
+    """
+    Single linkage clusters of the samples with one schema digest at one allele distance threshold.
+
+    Samples are added one at a time with their distances to the already clustered samples (a nearest
+    neighbors result), so adding a sample never requires a full distance matrix. Two samples end up in the
+    same cluster if they are connected by a chain of samples that are at most 'threshold' alleles apart,
+    which does not depend on the order in which samples are added.
+
+    Cluster ids are integers that are never reused. When a new sample links existing clusters, the oldest
+    (lowest) cluster id survives, the members of the other clusters are moved to it and the merge is
+    recorded in the merge log.
+
+    The membership is persisted in MongoDB. The in-memory union-find is reloaded when another process has
+    changed the clusters. Samples are added by one process (and thread) at a time, which claims the counter
+    document of the schema and threshold while it adds a sample, so that two samples that are added at the
+    same time still see each other.
+    """
+    def __init__(self, db, schema, threshold: int):
+        self.db = db
+        self.schema = str(schema)
+        self.threshold = threshold
+        self.version = None
+        self.union_find = UnionFind()
+        self.labels = dict()  # union-find root -> cluster id
+        self.lock = threading.RLock()
+        self.db[MEMBER_COLLECTION].create_index([('schema', 1), ('threshold', 1), ('sample', 1)], unique=True)
+        self.db[COUNTER_COLLECTION].create_index([('schema', 1), ('threshold', 1)], unique=True)
+
+    @property
+    def key(self):
+        return {'schema': self.schema, 'threshold': self.threshold}
+
+    def persisted_version(self):
+        counter = self.db[COUNTER_COLLECTION].find_one(self.key, {'version': True})
+        return counter['version'] if counter else 0
+
+    def load(self):
+        "(Re)build the union-find from the persisted membership"
+        self.union_find = UnionFind()
+        self.labels = dict()
+        first_members = dict()
+        for doc in self.db[MEMBER_COLLECTION].find(self.key, {'sample': True, 'cluster': True}):
+            self.union_find.add(doc['sample'])
+            first = first_members.setdefault(doc['cluster'], doc['sample'])
+            self.union_find.union(first, doc['sample'])
+        for cluster, first in first_members.items():
+            self.labels[self.union_find.find(first)] = cluster
+        self.version = self.persisted_version()
+
+    def refresh(self):
+        if self.version is None or self.version != self.persisted_version():
+            self.load()
+
+    def cluster_of(self, sample):
+        "Return the cluster id of a sample, or None if the sample has not been clustered"
+        with self.lock:
+            self.refresh()
+            if sample not in self.union_find:
+                return None
+            return self.labels[self.union_find.find(sample)]
+
+    def members(self, cluster: int):
+        with self.lock:
+            self.refresh()
+        return [doc['sample'] for doc in self.db[MEMBER_COLLECTION].find(dict(self.key, cluster=cluster), {'sample': True})]
+
+    def claim(self):
+        "Wait until no other process is changing the clusters and claim them. Returns the counter document."
+        try:
+            self.db[COUNTER_COLLECTION].update_one(
+                self.key,
+                {'$setOnInsert': {'version': 0, 'next_cluster': 0}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Created by another process at the same time
+            pass
+        writer = ObjectId()
+        while True:
+            now = datetime.datetime.now(tz=datetime.timezone.utc)
+            expired = now - datetime.timedelta(seconds=CLUSTER_CLAIM_TIMEOUT)
+            counter = self.db[COUNTER_COLLECTION].find_one_and_update(
+                {**self.key, '$or': [{'writer': None}, {'claimed_at': {'$lt': expired}}]},
+                {'$set': {'writer': writer, 'claimed_at': now}},
+                return_document=ReturnDocument.AFTER
+            )
+            if counter is not None:
+                return counter
+            time.sleep(CLUSTER_CLAIM_RETRY_INTERVAL)
+
+    def release(self, counter: dict, changes: dict):
+        "End a claim. If the clusters were changed, the version is bumped and the changes are added to the counter."
+        update = {'$unset': {'writer': '', 'claimed_at': ''}}
+        if changes:
+            update['$inc'] = dict(changes, version=1)
+        result = self.db[COUNTER_COLLECTION].update_one(dict(self.key, writer=counter['writer']), update)
+        if result.matched_count == 0:
+            # The claim expired and was taken over by another process, which may have changed the clusters too
+            if changes:
+                self.db[COUNTER_COLLECTION].update_one(self.key, {'$inc': dict(changes, version=1)})
+            self.version = None
+        elif changes and self.version == counter['version']:
+            self.version += 1
+
+    def add(self, sample, neighbor_distances: dict):
+        """
+        Add a sample given its distances to other samples ({sample: distance}).
+        Distances to samples that have not been clustered yet are ignored; the link is made when those
+        samples are added themselves.
+        Returns the cluster id of the sample and the list of cluster ids that were merged into it.
+        """
+        with self.lock:
+            self.refresh()
+            if sample in self.union_find:
+                return self.labels[self.union_find.find(sample)], []
+
+            counter = self.claim()
+            changes = dict()
+            try:
+                # Nobody else changes the clusters until the claim is released
+                if counter['version'] != self.version:
+                    self.load()
+                if sample in self.union_find:
+                    return self.labels[self.union_find.find(sample)], []
+
+                linked = [
+                    neighbor for neighbor, distance in neighbor_distances.items()
+                    if distance <= self.threshold and neighbor in self.union_find
+                ]
+                old_roots = {self.union_find.find(neighbor) for neighbor in linked}
+                clusters = sorted(self.labels[root] for root in old_roots)
+                cluster, merged = (clusters[0], clusters[1:]) if clusters else (counter['next_cluster'] + 1, [])
+
+                changes['next_cluster'] = 0 if clusters else 1
+                self.db[MEMBER_COLLECTION].insert_one(dict(self.key, sample=sample, cluster=cluster))
+                if merged:
+                    self.db[MEMBER_COLLECTION].update_many(
+                        dict(self.key, cluster={'$in': merged}),
+                        {'$set': {'cluster': cluster}}
+                    )
+                    self.db[MERGE_COLLECTION].insert_one(dict(
+                        self.key,
+                        cluster=cluster,
+                        merged=merged,
+                        sample=sample,
+                        merged_at=datetime.datetime.now(tz=datetime.timezone.utc)
+                    ))
+
+                self.union_find.add(sample)
+                for neighbor in linked:
+                    self.union_find.union(sample, neighbor)
+                for root in old_roots:
+                    del self.labels[root]
+                self.labels[self.union_find.find(sample)] = cluster
+                return cluster, merged
+            except BaseException:
+                # The persisted clusters may differ from the ones in memory
+                self.version = None
+                raise
+            finally:
+                self.release(counter, changes)
+
+
+_cluster_indexes = dict()
+
+def get_cluster_index(db, schema, threshold: int):
+    "Return the (cached) cluster index for a schema and threshold"
+    key = (db.name, str(schema), threshold)
+    index = _cluster_indexes.get(key)
+    if index is None or index.db is not db:
+        index = ClusterIndex(db, schema, threshold)
+        _cluster_indexes[key] = index
+    return index
@@ -0,0 +1,78 @@
+import numpy as np
+
+from allele_encoding import compared_calls, smallest_uint_dtype
+
+# Number of profiles to compare in one go. Bounds the size of the temporary boolean arrays.
+CHUNK_ROWS = 4096
+# Number of loci to compare at a time when distances are capped. Profiles that are past the cap after a
+# chunk of loci are not compared at the remaining loci.
+CAP_CHUNK_LOCI = 256
+
+
+def saturating_dtype(max_distance: int):
+    """
+    Return the smallest unsigned integer dtype for distances capped at max_distance: distances up to
+    max_distance are exact and max_distance + 1 means 'more than max_distance'.
+    """
+    return smallest_uint_dtype(max_distance + 1)
+
+
+def count_differences(query: np.ndarray, profiles: np.ndarray):
+    """
+    Count the loci where each of the encoded profiles differs from the encoded query profile.
+    Loci where either of the two calls is one of the ignored allele values are not counted, and a missing
+    call differs from a real allele, which are the same semantics as the nearest neighbors aggregation pipeline.
+    """
+    query_compared = compared_calls(query)
+    diff_counts = np.empty(len(profiles), dtype=np.int64)
+    for start in range(0, len(profiles), CHUNK_ROWS):
+        block = profiles[start:start + CHUNK_ROWS]
+        differs = (block != query) & compared_calls(block)
+        diff_counts[start:start + len(block)] = (differs & query_compared).sum(axis=1)
+    return diff_counts
+
+
+def capped_count_differences(query: np.ndarray, profiles: np.ndarray, max_distance: int):
+    """
+    Like count_differences, but stop counting the differences of a profile once there are more than
+    max_distance. The counts are returned saturated at max_distance + 1.
+    """
+    cap = max_distance + 1
+    query_compared = compared_calls(query)
+    diff_counts = np.zeros(len(profiles), dtype=np.int64)
+    for start in range(0, len(profiles), CHUNK_ROWS):
+        counts = diff_counts[start:start + CHUNK_ROWS]
+        active = np.arange(len(counts))
+        for locus in range(0, profiles.shape[1], CAP_CHUNK_LOCI):
+            loci = slice(locus, locus + CAP_CHUNK_LOCI)
+            block = profiles[start + active, loci]
+            differs = (block != query[loci]) & compared_calls(block)
+            counts[active] += (differs & query_compared[loci]).sum(axis=1)
+            active = active[counts[active] < cap]
+            if len(active) == 0:
+                break
+    return np.minimum(diff_counts, cap)
+
+
+def distance_matrix(profiles: np.ndarray, on_progress=None, max_distance: int | None = None):
+    """
+    Return the symmetric matrix of pairwise differences between encoded profiles.
+    If max_distance is given, differences are only counted up to max_distance + 1 and the matrix has the
+    smallest dtype that holds that (see saturating_dtype), otherwise it is int32.
+    on_progress(pairs_compared, pair_count) is called after each row if given.
+    """
+    n = len(profiles)
+    distances = np.zeros((n, n), dtype=np.int32 if max_distance is None else saturating_dtype(max_distance))
+    pair_count = n * (n - 1) // 2
+    compared = 0
+    for i in range(n - 1):
+        if max_distance is None:
+            row = count_differences(profiles[i], profiles[i + 1:])
+        else:
+            row = capped_count_differences(profiles[i], profiles[i + 1:], max_distance)
+        distances[i, i + 1:] = row
+        distances[i + 1:, i] = row
+        compared += len(row)
+        if on_progress is not None:
+            on_progress(compared, pair_count)
+    return distances
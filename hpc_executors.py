@@ -0,0 +1,140 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os import getenv
+
+from hpc_results import HPCResultConsumer
+
+# Number of processes that run HPC job types locally
+LOCAL_HPC_WORKERS = int(getenv('LOCAL_HPC_WORKERS', 2))
+
+
+def run_debug(args: dict, command: str | None = None):
+    """
+    The debug job type: sleep for args['sleep'] seconds.
+    It runs in the worker process itself, so it has no resource usage of its own (None).
+    """
+    time.sleep(float(args.get('sleep', 0)))
+    return {'slept': float(args.get('sleep', 0))}, None
+
+
+def run_command(args: dict, command: str | None = None):
+    """
+    Run a job type with a local command. The args of the job are passed as JSON on stdin, and the command
+    may print a JSON result (e.g. the locations of the result files) on stdout.
+    Returns the result and the resource usage (rusage) of the command, including the processes it started.
+    On Linux, the peak memory of a command is at least the memory of the process that started it, which
+    is why the workers of the LocalBackend are started fresh rather than forked from the API.
+    """
+    if not command:
+        raise RuntimeError("No local command is configured for this job type.")
+    # Files instead of pipes, so the command can be reaped with os.wait4 (which returns its rusage) without
+    # deadlocking on a full pipe
+    with tempfile.TemporaryFile('w+') as stdin, tempfile.TemporaryFile('w+') as stdout, tempfile.TemporaryFile('w+') as stderr:
+        json.dump(args, stdin)
+        stdin.seek(0)
+        process = subprocess.Popen(command, shell=True, stdin=stdin, stdout=stdout, stderr=stderr)
+        _pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        stdout.seek(0)
+        stderr.seek(0)
+        output, errors = stdout.read(), stderr.read()
+    if process.returncode != 0:
+        raise RuntimeError(f"'{command}' failed with exit code {process.returncode}: {errors[-1000:]}")
+    return (json.loads(output) if output.strip() else None), rusage
+
+
+LOCAL_RUNNERS = {
+    'debug': run_debug,
+}
+
+
+def run_job(job_type: str, args: dict, command: str | None):
+    """
+    Run a job in a worker process and report its resource usage like the HPC dispatcher does. The usage is
+    tagged with the local backend, as it is measured on the API host rather than on the HPC cluster.
+    """
+    started = time.monotonic()
+    result, rusage = LOCAL_RUNNERS.get(job_type, run_command)(args, command)
+    runtime = time.monotonic() - started
+    usage = {'runtime_seconds': runtime, 'backend': 'local'}
+    if rusage is not None:
+        # ru_maxrss is in kilobytes on Linux
+        usage['memory_gb'] = rusage.ru_maxrss / 1024 / 1024
+        # The average number of busy CPUs, so that runtime_seconds * cpus is the CPU time of the job
+        usage['cpus'] = (rusage.ru_utime + rusage.ru_stime) / runtime if runtime > 0 else None
+    return result, usage
+
+
+class LocalBackend:
+    """
+    Run jobs in a bounded process pool on the API host.
+
+    The status of a job is reported with the same messages as the HPC dispatcher sends ('running', then
+    'success' with the result and the usage, or 'failed'), and applied with the same HPCResultConsumer, so
+    calculations look the same whichever backend ran them. Jobs are queued by the pool when all workers
+    are busy; the resources of the job are not enforced.
+    """
+    def __init__(self, workers: int = LOCAL_HPC_WORKERS):
+        self.workers = workers
+        self.pool = None
+        self.tasks = set()
+
+    def get_pool(self):
+        if self.pool is None:
+            # Spawned workers start small, so the measured memory of a job is not that of a copy of the API
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self.pool
+
+    async def submit(self, db, uuid: str, job_type: str, args: dict, command: str | None = None):
+        "Start a job. command is the local command for job types without a built-in runner."
+        task = asyncio.create_task(self.run(db, uuid, job_type, args, command))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def report(self, db, job_uuids: list, job_type: str, **message):
+        "Apply a status message for the jobs of a call. The jobs of a batch call are reported individually."
+        consumer = HPCResultConsumer(db)
+        for job_uuid in job_uuids:
+            consumer.add(dict(message, job_uuid=job_uuid, job_type=job_type))
+        consumer.flush()
+
+    async def run(self, db, uuid: str, job_type: str, args: dict, command: str | None):
+        loop = asyncio.get_running_loop()
+        job_uuids = [job['uuid'] for job in args['jobs']] if 'jobs' in args else [uuid]
+        self.report(db, job_uuids, job_type, status='running')
+        try:
+            result, usage = await loop.run_in_executor(self.get_pool(), run_job, job_type, args, command)
+        except Exception as e:
+            print(f"Local {job_type} job {uuid} failed: {e!r}")
+            self.report(db, job_uuids, job_type, status='failed', error_msg=str(e))
+            return
+        self.report(db, job_uuids, job_type, status='success', result=result, usage=usage)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    async def drain(self):
+        "Wait until all submitted jobs have finished"
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+
+def choose_backend(settings: dict, job_type: str, samples: int | None = None):
+    """
+    Return the name of the backend for a job from the 'executor' settings of the hpc config section:
+    'local' for the job types in local_job_types and for jobs with at most local_max_samples samples,
+    otherwise the default backend ('amqp' unless configured).
+    """
+    if job_type in settings.get('local_job_types', []):
+        return 'local'
+    if samples is not None and samples <= settings.get('local_max_samples', 0):
+        return 'local'
+    return settings.get('backend', 'amqp')
@@ -0,0 +1,229 @@
+import asyncio
+import datetime
+import json
+from os import getenv
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+
+from resource_estimator import record_usage
+
+# Queue on which the HPC dispatcher publishes status and result messages for the jobs sent with send_hpc_call
+HPC_RESULT_QUEUE = getenv('HPC_RESULT_QUEUE', 'hpc_results')
+# Start the consumer as a background task of the API (set to 0 if it runs as a separate worker)
+HPC_RESULT_CONSUMER = int(getenv('HPC_RESULT_CONSUMER', 0))
+# Status updates are written to MongoDB in bulk when this many have been received...
+HPC_RESULT_BATCH_SIZE = int(getenv('HPC_RESULT_BATCH_SIZE', 100))
+# ...or when the oldest unwritten update is this many seconds old
+HPC_RESULT_FLUSH_INTERVAL = float(getenv('HPC_RESULT_FLUSH_INTERVAL', 1))
+
+# Collection of the calculation documents per job type. The uuid of an HPC call is the _id of the document.
+JOB_TYPE_COLLECTIONS = {
+    'snp': 'snp',
+    'snp_batch': 'snp',
+    'debug': 'debug',
+}
+DEFAULT_COLLECTION = 'hpc'
+
+COMPLETED_STATUSES = {'success', 'completed', 'finished'}
+FAILED_STATUSES = {'error', 'failed', 'failure'}
+
+
+def status_update(message: dict):
+    """
+    Translate a dispatcher message to a MongoDB update of the calculation document.
+    Terminal statuses complete the calculation; other statuses (e.g. 'queued', 'running') are only
+    recorded in the field hpc_status.
+    """
+    hpc_status = str(message.get('status', '')).lower()
+    update = {'hpc_status': hpc_status}
+    if hpc_status in COMPLETED_STATUSES or hpc_status in FAILED_STATUSES:
+        finished_at = message.get('finished_at')
+        try:
+            finished_at = datetime.datetime.fromisoformat(finished_at)
+        except (TypeError, ValueError):
+            finished_at = datetime.datetime.now(tz=datetime.timezone.utc)
+        update['finished_at'] = finished_at
+        update['progress'] = None
+        if hpc_status in COMPLETED_STATUSES:
+            update['status'] = 'completed'
+            update['result'] = message.get('result')
+        else:
+            update['status'] = 'error'
+            update['error_msg'] = message.get('error_msg') or message.get('error') or "The HPC job failed."
+    return update
+
+
+class HPCResultConsumer:
+    """
+    Applies the status and result messages of the HPC dispatcher to the calculation documents.
+
+    Messages are buffered and written with one unordered bulk write per collection, so a burst of
+    messages (e.g. many SNP jobs finishing at once) costs a few round trips instead of one per message.
+    Only calculations that are still running (status 'init') are updated, so redelivered or out of order
+    messages cannot change a finished calculation.
+    """
+    def __init__(
+            self,
+            db,
+            batch_size: int = HPC_RESULT_BATCH_SIZE,
+            flush_interval: float = HPC_RESULT_FLUSH_INTERVAL):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = dict()  # collection -> {_id: update}
+        self.acks = list()
+        self.usages = list()  # (collections, _id, usage) of finished jobs that reported their resource usage
+        self.pending_count = 0
+
+    def add(self, message: dict, ack=None):
+        "Buffer a message. ack (optional) is called once the update has been written."
+        try:
+            _id = ObjectId(message['job_uuid'])
+        except (KeyError, TypeError, InvalidId):
+            print(f"Ignoring HPC message without a valid job_uuid: {message}")
+            if ack is not None:
+                ack()
+            return
+        job_type = message.get('job_type')
+        collections = [JOB_TYPE_COLLECTIONS.get(job_type, DEFAULT_COLLECTION)] if job_type else \
+            list(dict.fromkeys(JOB_TYPE_COLLECTIONS.values())) + [DEFAULT_COLLECTION]
+        update = status_update(message)
+        for collection in collections:
+            # A later message for the same job in the same batch supersedes the earlier one
+            pending = self.pending.setdefault(collection, dict())
+            if update.get('status') or _id not in pending or not pending[_id].get('status'):
+                pending[_id] = update
+        usage = message.get('usage')
+        if update.get('status') == 'completed' and isinstance(usage, dict):
+            self.usages.append((collections, _id, usage))
+        if ack is not None:
+            self.acks.append(ack)
+        self.pending_count += 1
+
+    def flush(self):
+        """
+        Write the buffered updates and acknowledge their messages. Returns the number of modified documents.
+        If a write fails, the updates stay buffered (unacknowledged) for the next flush and the error is raised.
+        Writing an update again is harmless, as only calculations that are still running are updated.
+        """
+        pending, acks, usages, pending_count = self.pending, self.acks, self.usages, self.pending_count
+        self.pending, self.acks, self.usages, self.pending_count = dict(), list(), list(), 0
+        modified = 0
+        try:
+            for collection, updates in pending.items():
+                requests = [
+                    UpdateOne({'_id': _id, 'status': 'init'}, {'$set': update})
+                    for _id, update in updates.items()
+                ]
+                modified += self.db[collection].bulk_write(requests, ordered=False).modified_count
+            if usages:
+                self.record_usages(usages)
+        except Exception:
+            # Nothing is buffered while flushing, so the batch can be put back as it was
+            self.pending, self.acks, self.usages, self.pending_count = pending, acks, usages, pending_count
+            raise
+        for ack in acks:
+            ack()
+        return modified
+
+    def record_usages(self, usages: list):
+        "Record the resource usage of finished jobs together with the input size features they were submitted with"
+        by_collection = dict()
+        for collections, _id, usage in usages:
+            for collection in collections:
+                by_collection.setdefault(collection, dict())[_id] = usage
+        records = list()
+        for collection, job_usages in by_collection.items():
+            jobs = self.db[collection].find(
+                {'_id': {'$in': list(job_usages)}, 'hpc_features': {'$type': 'object'}},
+                {'hpc_call': True, 'hpc_job_type': True, 'hpc_features': True, 'hpc_resources': True}
+            )
+            for job in jobs:
+                usage = job_usages[job['_id']]
+                records.append({
+                    'hpc_call': job.get('hpc_call') or str(job['_id']),
+                    'job_type': job.get('hpc_job_type'),
+                    'features': job['hpc_features'],
+                    'runtime_seconds': usage.get('runtime_seconds'),
+                    'memory_gb': usage.get('memory_gb'),
+                    'cpus': usage.get('cpus') or (job.get('hpc_resources') or {}).get('cpus'),
+                    'backend': usage.get('backend'),
+                })
+        record_usage(self.db, records)
+
+    async def flush_periodically(self):
+        "Flush every flush_interval seconds. A failed flush is retried at the next interval."
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self.pending_count:
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"Could not write {self.pending_count} HPC status updates: {e!r}. Retrying in {self.flush_interval} seconds.")
+
+    async def run(self, messages):
+        """
+        Consume an async iterable of messages until it is exhausted (or forever for a broker queue).
+        Items are message dicts or (message dict, ack) tuples.
+        """
+        flusher = asyncio.create_task(self.flush_periodically())
+        try:
+            async for item in messages:
+                message, ack = item if isinstance(item, tuple) else (item, None)
+                self.add(message, ack)
+                if self.pending_count >= self.batch_size:
+                    self.flush()
+        finally:
+            flusher.cancel()
+        if self.pending_count:
+            self.flush()
+
+
+async def amqp_messages(amqp_url: str, queue_name: str = HPC_RESULT_QUEUE):
+    """
+    Yield (message dict, ack) tuples from a durable queue.
+    Messages are acknowledged after their update has been written, so updates are not lost if the consumer
+    stops before a flush; they are delivered again instead, which is harmless.
+    """
+    import aio_pika
+
+    connection = await aio_pika.connect_robust(amqp_url)
+    async with connection:
+        channel = await connection.channel()
+        await channel.set_qos(prefetch_count=HPC_RESULT_BATCH_SIZE * 2)
+        queue = await channel.declare_queue(queue_name, durable=True)
+        async with queue.iterator() as queue_iter:
+            async for message in queue_iter:
+                try:
+                    body = json.loads(message.body)
+                except ValueError:
+                    print(f"Ignoring HPC message that is not JSON: {message.body[:200]!r}")
+                    await message.reject()
+                    continue
+                loop = asyncio.get_running_loop()
+                yield body, lambda message=message: loop.create_task(message.ack())
+
+
+async def consume_hpc_results(db, amqp_url: str, queue_name: str = HPC_RESULT_QUEUE):
+    "Keep consuming HPC results, reconnecting if the connection to the broker is lost or an update cannot be written"
+    while True:
+        # The broker delivers the unacknowledged messages of a lost connection again, so the updates that
+        # were still buffered are not carried over to the next connection
+        consumer = HPCResultConsumer(db)
+        try:
+            await consumer.run(amqp_messages(amqp_url, queue_name))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"HPC result consumer stopped: {e!r}. Reconnecting in 5 seconds.")
+            await asyncio.sleep(5)
+
+
+if __name__ == '__main__':
+    # Run the consumer as a separate worker
+    from mongo import MongoAPI
+    from calculations import MONGO_CONNECTION_STRING, AMQP_HOST
+
+    asyncio.run(consume_hpc_results(MongoAPI(MONGO_CONNECTION_STRING).db, AMQP_HOST))
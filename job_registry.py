@@ -0,0 +1,44 @@
+import threading
+
+
+class RunningJob:
+    """
+    A calculation that runs in this process. Cancelling it sets the cancelled event, which the calculation
+    checks at its next chunk boundary, and kills the subprocesses it runs right away.
+    """
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.processes = set()
+
+    def cancel(self):
+        self.cancelled.set()
+        for process in list(self.processes):
+            if process.returncode is None:
+                process.kill()
+
+
+class JobRegistry:
+    "The calculations that run in this process, by job id"
+    def __init__(self):
+        self.jobs = dict()
+
+    def start(self, job_id: str):
+        job = self.jobs[job_id] = RunningJob()
+        return job
+
+    def finish(self, job_id: str):
+        self.jobs.pop(job_id, None)
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str):
+        "Cancel a job if it runs in this process. Returns False if it does not."
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancel()
+        return True
+
+
+job_registry = JobRegistry()
@@ -1,31 +1,54 @@
 from os import getenv
-from datetime import datetime
-from json import load
-from pathlib import Path
+import asyncio
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, BackgroundTasks
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import HTTPException
 from bson.errors import InvalidId
+import orjson
 
 from mongo import MongoAPI
 import calculations
+from result_compression import compression_stats
+import artifacts
+import hpc_results
+import nn_precompute
 
 import pydantic_classes as pc
 
+MONGO_CONNECTION_STRING = getenv('BIO_API_MONGO_CONNECTION', 'mongodb://mongodb:27017/bio_api_test')
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The MongoDB client is created here rather than at import time and connects on first use
+    mongo_api = MongoAPI(MONGO_CONNECTION_STRING)
+    calculations.Calculation.set_mongo_api(mongo_api)
+    # Apply the status and result messages of the HPC dispatcher to the HPC calculation documents
+    consumer = None
+    if hpc_results.HPC_RESULT_CONSUMER:
+        consumer = asyncio.create_task(hpc_results.consume_hpc_results(mongo_api.db, calculations.AMQP_HOST))
+    # Precompute the nearest neighbors of samples when they gain a cgMLST profile
+    precomputer = None
+    if nn_precompute.NN_PRECOMPUTE:
+        precomputer = asyncio.create_task(nn_precompute.precompute_neighbors(mongo_api.db))
+    yield
+    if consumer is not None:
+        consumer.cancel()
+    if precomputer is not None:
+        precomputer.cancel()
+    calculations.local_backend.shutdown()
+    mongo_api.close()
+
 app = FastAPI(
     title="Bio API", 
     description="REST API for controlling bioinformatic calculations", 
     version="0.2.0",
-    root_path="/bioapi"
+    root_path="/bioapi",
+    lifespan=lifespan
 
 )
 
-MONGO_CONNECTION_STRING = getenv('BIO_API_MONGO_CONNECTION', 'mongodb://mongodb:27017/bio_api_test')
-
-mongo_api = MongoAPI(MONGO_CONNECTION_STRING)
-calculations.Calculation.set_mongo_api(mongo_api)
-
 DMX_DIR = getenv('DMX_DIR', '/dmx_data')
 
 additional_responses = {
@@ -33,6 +56,53 @@ additional_responses = {
     404: {"model": pc.Message}
     }
 
+cancel_responses = {
+    **additional_responses,
+    409: {"model": pc.Message}
+    }
+
+async def cancel_calculation(calc_class, job_id: str):
+    "Cancel a calculation that has not finished yet"
+    try:
+        calc = calc_class.recall(job_id)
+    except InvalidId as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+            )
+    if calc is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"A document with id {job_id} was not found in collection {calc_class.collection}."
+            )
+    if not await calc.cancel():
+        raise HTTPException(
+            status_code=409,
+            detail=f"Calculation {job_id} has already finished with status '{calc.status}'."
+            )
+    return pc.CommonPOSTResponse(
+        job_id=str(calc._id),
+        created_at=calc.created_at.isoformat(),
+        status=calc.status
+    )
+
+class TrustedJSONResponse(JSONResponse):
+    "orjson response that also serializes values like ObjectIds which are left in stored results"
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+def trusted_response(model, content: dict):
+    """
+    Return content shaped like the response model without validating it.
+    Large results (long neighbor lists, embedded distance matrices) are expensive to validate and encode
+    with the standard JSON encoder, and results that Bio API stored itself are already known to be valid.
+    The endpoint's response_model is still used for the OpenAPI schema.
+    """
+    return TrustedJSONResponse({
+        name: content.get(name, None if field.is_required() else field.get_default(call_default_factory=True))
+        for name, field in model.model_fields.items()
+    })
+
 @app.post("/v1/nearest_neighbors",
     tags=["Nearest Neighbors"],
     status_code=201,
@@ -52,7 +122,8 @@ async def nearest_neighbors(rq: pc.NearestNeighborsRequest, background_tasks: Ba
         input_mongo_id=rq.input_mongo_id,
         cutoff=rq.cutoff,
         filtering=rq.filtering,
-        unknowns_are_diffs=rq.unknowns_are_diffs
+        unknowns_are_diffs=rq.unknowns_are_diffs,
+        timeout_seconds=rq.timeout_seconds
     )
 
     # Get input profile or fail if sequence not found
@@ -73,14 +144,20 @@ async def nearest_neighbors(rq: pc.NearestNeighborsRequest, background_tasks: Ba
 
     # Check that at least the input sequence has the profile field, otherwise there's no reason to run the calculation
     try:
-        _p = calc.input_profile
+        calc.input_profile
     except KeyError:
         raise HTTPException(
             status_code=404,
             detail=f"Input sequence {calc.input_sequence['_id']} does not have a field named '{calc.allele_path}'."
             )
+    neighbors = nn_precompute.lookup(calculations.Calculation.mongo_api.db, calc)
     calc._id = await calc.insert_document()
-    background_tasks.add_task(calc.calculate)
+    if neighbors is None:
+        background_tasks.add_task(calc.run)
+    else:
+        # The neighbors were precomputed when the sample gained its profile
+        await calc.store_result(neighbors)
+        calc.status = 'completed'
 
     return pc.CommonPOSTResponse(
         job_id=str(calc._id),
@@ -117,7 +194,18 @@ async def nn_result(nn_id: str, level:str='full'):
     if level != 'full' and content['status'] == 'completed':
         content['result'] = None
 
-    return pc.NearestNeighborsGETResponse(**content)
+    return trusted_response(pc.NearestNeighborsGETResponse, content)
+
+@app.delete("/v1/nearest_neighbors/{nn_id}",
+    tags=["Nearest Neighbors"],
+    response_model=pc.CommonPOSTResponse,
+    responses=cancel_responses
+    )
+async def cancel_nn(nn_id: str):
+    """
+    Cancel a nearest neighbors calculation
+    """
+    return await cancel_calculation(calculations.NearestNeighbors, nn_id)
 
 @app.post("/v1/distance_calculations",
     response_model=pc.CommonPOSTResponse,
@@ -133,6 +221,8 @@ async def dmx_from_mongodb(rq: pc.DistanceMatrixRequest, background_tasks: Backg
     # Initialize DistanceCalculation object
     calc = calculations.DistanceCalculation(
             seq_mongo_ids=rq.seq_mongo_ids,
+            max_distance=rq.max_distance,
+            timeout_seconds=rq.timeout_seconds
     )
 
     #i dont think the created_at and finished_at here is necessary - they are in Calculation __init__
@@ -154,7 +244,7 @@ async def dmx_from_mongodb(rq: pc.DistanceMatrixRequest, background_tasks: Backg
             )
 
     calc._id = await calc.insert_document()
-    background_tasks.add_task(calc.calculate, cursor)
+    background_tasks.add_task(calc.run, cursor)
 
     return pc.CommonPOSTResponse(
         job_id=str(calc._id),
@@ -167,9 +257,12 @@ async def dmx_from_mongodb(rq: pc.DistanceMatrixRequest, background_tasks: Backg
     response_model=pc.DistanceMatrixGETResponse,
     responses=additional_responses
 )
-async def dmx_result(dc_id: str, level:str='full'):
+async def dmx_result(dc_id: str, background_tasks: BackgroundTasks, level:str='full', recompute:bool=False):
     """
-    Get result of a distance calculation
+    Get result of a distance calculation.
+    A distance matrix that has been evicted to free disk space has status 'evicted'. Use recompute=true to
+    calculate it again. A calculation that timed out, was cancelled or failed can also be recomputed; with the
+    'tiled' engine it continues after its last finished tile.
     """
     try:
         calc = calculations.DistanceCalculation.recall(dc_id)
@@ -185,6 +278,19 @@ async def dmx_result(dc_id: str, level:str='full'):
             detail=f"A document with id {dc_id} was not found in collection {calculations.DistanceCalculation.collection}."
             )
 
+    if calc.status in ('evicted', 'timeout', 'cancelled', 'error') and recompute:
+        # Restarted first, so that the profiles are fetched within the new deadline
+        await calc.restart()
+        try:
+            _profile_count, cursor = await calc.query_mongodb_for_allele_profiles()
+        except calculations.MissingDataException as e:
+            await calc.store_result(str(e), 'error')
+            raise HTTPException(
+                status_code=404,
+                detail=str(e)
+                )
+        background_tasks.add_task(calc.run, cursor)
+
     content = calc.to_dict()
     
     if calc.status == 'completed':
@@ -197,11 +303,268 @@ async def dmx_result(dc_id: str, level:str='full'):
         content['result'] = calc.result
         if level == 'full':
             # Add result from file
-            with open(Path(calc.folder, 'distance_matrix.json')) as f:
-                json = load(f)
-                content['result']['distances'] = [calc.dmx_tsv_from_dict(json)]
+            artifacts.touch(calc.folder)
+            content['result']['distances'] = [calc.dmx_tsv_from_dict(await calc.load_dmx_dict())]
+
+    return trusted_response(pc.DistanceMatrixGETResponse, content)
+
+@app.delete("/v1/distance_calculations/{dc_id}",
+    tags=["Distances"],
+    response_model=pc.CommonPOSTResponse,
+    responses=cancel_responses
+    )
+async def cancel_dmx(dc_id: str):
+    """
+    Cancel a distance calculation. A running cgmlst-dists process is killed.
+    """
+    return await cancel_calculation(calculations.DistanceCalculation, dc_id)
 
-    return pc.DistanceMatrixGETResponse(**content)
+@app.post("/v1/distance_calculations/slices",
+    response_model=pc.CommonPOSTResponse,
+    tags=["Distances"],
+    status_code=201,
+    responses=additional_responses
+    )
+async def dmx_slice(rq: pc.SubMatrixRequest, background_tasks: BackgroundTasks):
+    """
+    Extract the distances between a subset of the sequences of a completed distance calculation.
+    The sub-matrix is registered as a new distance calculation job, which can also be used for trees.
+    """
+    try:
+        source = calculations.DistanceCalculation.recall(rq.dmx_job)
+    except InvalidId as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+            )
+    if source is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Distance matrix job with id {rq.dmx_job} does not exist."
+            )
+    if source.status != 'completed':
+        raise HTTPException(
+            status_code=400,
+            detail=f"Distance matrix job with id {rq.dmx_job} has status '{source.status}'."
+            )
+    if (rq.seq_mongo_ids is None) == (rq.sequence_ids is None):
+        raise HTTPException(
+            status_code=400,
+            detail="Either seq_mongo_ids or sequence_ids must be given."
+            )
+
+    seq_to_mongo = source.result['seq_to_mongo']
+    if rq.sequence_ids is not None:
+        sequence_ids = rq.sequence_ids
+        missing = [sequence_id for sequence_id in sequence_ids if sequence_id not in seq_to_mongo]
+    else:
+        mongo_to_seq = {str(mongo_id): sequence_id for sequence_id, mongo_id in seq_to_mongo.items()}
+        sequence_ids = [mongo_to_seq.get(mongo_id) for mongo_id in rq.seq_mongo_ids]
+        missing = [mongo_id for mongo_id, sequence_id in zip(rq.seq_mongo_ids, sequence_ids) if sequence_id is None]
+    if missing:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Distance matrix job with id {rq.dmx_job} does not contain: {', '.join(missing)}"
+            )
+
+    calc = calculations.DistanceCalculation(
+        seq_mongo_ids=[str(seq_to_mongo[sequence_id]) for sequence_id in sequence_ids],
+        source_dmx_job=rq.dmx_job,
+        max_distance=source.max_distance
+    )
+    calc._id = await calc.insert_document()
+    background_tasks.add_task(calc.run, source, sequence_ids, work=calc.slice_from)
+
+    return pc.CommonPOSTResponse(
+        job_id=str(calc._id),
+        created_at=calc.created_at.isoformat(),
+        status=calc.status
+    )
+
+@app.post("/v1/threshold_graphs",
+    response_model=pc.CommonPOSTResponse,
+    tags=["Distances"],
+    status_code=201,
+    responses=additional_responses
+    )
+async def threshold_graph(rq: pc.ThresholdGraphRequest, background_tasks: BackgroundTasks):
+    """
+    Find all pairs of sequences within max_distance allele differences of each other, without calculating a
+    distance matrix. Use this instead of a distance matrix for large numbers of sequences.
+    """
+    calc = calculations.ThresholdGraphCalculation(
+        seq_mongo_ids=rq.seq_mongo_ids,
+        max_distance=rq.max_distance,
+        timeout_seconds=rq.timeout_seconds
+    )
+    try:
+        profile_count, cursor = await calc.query_mongodb_for_allele_profiles()
+    except InvalidId as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+            )
+    except calculations.MissingDataException as e:
+        raise HTTPException(
+            status_code=404,
+            detail=str(e)
+            )
+
+    calc._id = await calc.insert_document()
+    background_tasks.add_task(calc.run, cursor, profile_count)
+
+    return pc.CommonPOSTResponse(
+        job_id=str(calc._id),
+        created_at=calc.created_at.isoformat(),
+        status=calc.status
+    )
+
+def recall_threshold_graph(tg_id: str, completed: bool = False):
+    "Return a threshold graph calculation, which must have completed if completed is True"
+    try:
+        calc = calculations.ThresholdGraphCalculation.recall(tg_id)
+    except InvalidId as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+            )
+    if calc is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"A document with id {tg_id} was not found in collection {calculations.ThresholdGraphCalculation.collection}."
+            )
+    if completed and calc.status != 'completed':
+        raise HTTPException(
+            status_code=400,
+            detail=f"Threshold graph with id {tg_id} has status '{calc.status}'."
+            )
+    return calc
+
+@app.get("/v1/threshold_graphs/{tg_id}",
+    tags=["Distances"],
+    response_model=pc.ThresholdGraphGETResponse,
+    responses=additional_responses
+    )
+async def threshold_graph_result(tg_id: str):
+    """
+    Get the status and the size of a threshold graph
+    """
+    return pc.ThresholdGraphGETResponse(**recall_threshold_graph(tg_id).to_dict())
+
+@app.get("/v1/threshold_graphs/{tg_id}/components",
+    tags=["Distances"],
+    response_model=pc.ThresholdGraphComponents,
+    responses=additional_responses
+    )
+async def threshold_graph_components(tg_id: str):
+    """
+    Get the connected components of a threshold graph with more than one sequence, largest first
+    """
+    calc = recall_threshold_graph(tg_id, completed=True)
+    return trusted_response(pc.ThresholdGraphComponents, {'components': await calc.components()})
+
+@app.get("/v1/threshold_graphs/{tg_id}/samples/{seq_mongo_id}",
+    tags=["Distances"],
+    response_model=pc.ThresholdGraphNeighborhood,
+    responses=additional_responses
+    )
+async def threshold_graph_neighborhood(tg_id: str, seq_mongo_id: str):
+    """
+    Get the connected component of a sequence and its edges in a threshold graph
+    """
+    calc = recall_threshold_graph(tg_id, completed=True)
+    neighborhood = await calc.neighborhood(seq_mongo_id)
+    if neighborhood is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Sequence {seq_mongo_id} is not in threshold graph {tg_id}."
+            )
+    return trusted_response(pc.ThresholdGraphNeighborhood, neighborhood)
+
+@app.delete("/v1/threshold_graphs/{tg_id}",
+    tags=["Distances"],
+    response_model=pc.CommonPOSTResponse,
+    responses=cancel_responses
+    )
+async def cancel_threshold_graph(tg_id: str):
+    """
+    Cancel a threshold graph calculation
+    """
+    return await cancel_calculation(calculations.ThresholdGraphCalculation, tg_id)
+
+@app.post("/v1/clusters",
+    response_model=pc.CommonPOSTResponse,
+    tags=["Clusters"],
+    status_code=201,
+    responses=additional_responses
+    )
+async def clusters(rq: pc.ClusterRequest, background_tasks: BackgroundTasks):
+    """
+    Assign a sequence to clusters at one or more allele distance thresholds
+    """
+    calc = calculations.ClusterCalculation(
+        input_mongo_id=rq.input_mongo_id,
+        thresholds=rq.thresholds,
+        timeout_seconds=rq.timeout_seconds
+    )
+
+    # Fail early if the sequence does not exist
+    try:
+        await calc.nearest_neighbors().query_mongodb_for_input_profile()
+    except InvalidId as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+            )
+    except calculations.MissingDataException as e:
+        raise HTTPException(
+            status_code=404,
+            detail=str(e)
+            )
+
+    calc._id = await calc.insert_document()
+    background_tasks.add_task(calc.run)
+
+    return pc.CommonPOSTResponse(
+        job_id=str(calc._id),
+        created_at=calc.created_at.isoformat(),
+        status=calc.status
+    )
+
+@app.get("/v1/clusters/{cc_id}",
+    tags=["Clusters"],
+    response_model=pc.ClusterGETResponse,
+    responses=additional_responses
+    )
+async def cluster_result(cc_id: str):
+    """
+    Get result of a cluster assignment
+    """
+    try:
+        calc = calculations.ClusterCalculation.recall(cc_id)
+    except InvalidId as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+            )
+    if calc is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"A document with id {cc_id} was not found in collection {calculations.ClusterCalculation.collection}."
+            )
+
+    return pc.ClusterGETResponse(**calc.to_dict())
+
+@app.delete("/v1/clusters/{cc_id}",
+    tags=["Clusters"],
+    response_model=pc.CommonPOSTResponse,
+    responses=cancel_responses
+    )
+async def cancel_cluster(cc_id: str):
+    """
+    Cancel a cluster assignment
+    """
+    return await cancel_calculation(calculations.ClusterCalculation, cc_id)
 
 @app.post("/v1/trees",
     response_model=pc.CommonPOSTResponse,
@@ -221,9 +584,9 @@ async def hc_tree_from_dmx_job(rq: pc.HCTreeCalcRequest, background_tasks: Backg
             status_code=400,
             detail=str(f"Distance matrix job with id {rq.dmx_job} has status '{calc.status}'.")
             )
-    tc = calculations.TreeCalculation(rq.dmx_job, rq.method)
+    tc = calculations.TreeCalculation(rq.dmx_job, rq.method, timeout_seconds=rq.timeout_seconds)
     tc._id = await tc.insert_document()
-    background_tasks.add_task(tc.calculate)
+    background_tasks.add_task(tc.run)
     return pc.CommonPOSTResponse(
         job_id=str(tc._id),
         created_at=tc.created_at.isoformat(),
@@ -251,6 +614,152 @@ async def hc_tree_result(tc_id:str, level:str='full'):
 
     return pc.HCTreeCalcGETResponse(**content)
 
+@app.delete("/v1/trees/{tc_id}",
+    tags=["Trees"],
+    response_model=pc.CommonPOSTResponse,
+    responses=cancel_responses
+    )
+async def cancel_tree(tc_id: str):
+    """
+    Cancel a tree calculation
+    """
+    return await cancel_calculation(calculations.TreeCalculation, tc_id)
+
+@app.get("/v1/result_compression",
+    tags=["Stats"],
+    response_model=list[pc.CompressionStats]
+    )
+async def result_compression_stats():
+    """
+    Get the compression ratios achieved for stored results, per calculation collection and codec
+    """
+    stats = list()
+    for calc_class in (
+            calculations.NearestNeighbors,
+            calculations.DistanceCalculation,
+            calculations.TreeCalculation,
+            calculations.TreePipelineCalculation,
+            calculations.ClusterCalculation):
+        collection = calculations.Calculation.mongo_api.db[calc_class.collection]
+        for codec_stats in compression_stats(collection):
+            stats.append(pc.CompressionStats(collection=calc_class.collection, **codec_stats))
+    return stats
+
+@app.get("/v1/mongo_latency",
+    tags=["Stats"],
+    response_model=dict[str, pc.MongoLatency]
+    )
+async def mongo_latency():
+    """
+    Get the latency of the recent MongoDB commands per client ('primary' for job documents, 'profiles' for heavy reads of sequences)
+    """
+    return calculations.Calculation.mongo_api.latency()
+
+@app.post("/v1/tree_pipelines",
+    response_model=pc.CommonPOSTResponse,
+    tags=["Trees"],
+    status_code=201,
+    responses=additional_responses
+    )
+async def tree_pipeline(rq: pc.TreePipelineRequest, background_tasks: BackgroundTasks):
+    """
+    Make trees directly from the cgMLST profiles of the selected sequences in a single job
+    """
+    calc = calculations.TreePipelineCalculation(
+        seq_mongo_ids=rq.seq_mongo_ids,
+        methods=rq.methods,
+        timeout_seconds=rq.timeout_seconds
+    )
+    dc = calc.distance_calculation()
+    try:
+        _profile_count, cursor = await dc.query_mongodb_for_allele_profiles()
+    except InvalidId as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+            )
+    except calculations.MissingDataException as e:
+        raise HTTPException(
+            status_code=404,
+            detail=str(e)
+            )
+
+    dc._id = await dc.insert_document()
+    calc.dmx_job = str(dc._id)
+    calc._id = await calc.insert_document()
+    background_tasks.add_task(calc.run, dc, cursor)
+
+    return pc.CommonPOSTResponse(
+        job_id=str(calc._id),
+        created_at=calc.created_at.isoformat(),
+        status=calc.status
+    )
+
+@app.get("/v1/tree_pipelines/{tp_id}",
+    tags=["Trees"],
+    response_model=pc.TreePipelineGETResponse,
+    responses=additional_responses
+    )
+async def tree_pipeline_result(tp_id: str, level:str='full'):
+    """
+    Get result of a tree pipeline: the job_id of the distance calculation and a tree per linkage method
+    """
+    try:
+        calc = calculations.TreePipelineCalculation.recall(tp_id)
+    except InvalidId as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+            )
+    if calc is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"A document with id {tp_id} was not found in collection {calculations.TreePipelineCalculation.collection}."
+            )
+
+    content = calc.to_dict()
+    if level != 'full' and content['status'] == 'completed':
+        content['result'] = None
+
+    return pc.TreePipelineGETResponse(**content)
+
+@app.delete("/v1/tree_pipelines/{tp_id}",
+    tags=["Trees"],
+    response_model=pc.CommonPOSTResponse,
+    responses=cancel_responses
+    )
+async def cancel_tree_pipeline(tp_id: str):
+    """
+    Cancel a tree pipeline and its distance calculation
+    """
+    return await cancel_calculation(calculations.TreePipelineCalculation, tp_id)
+
+async def submit_snp_calculations(rqs: list):
+    """
+    Create, store and submit SNP calculations. The files of all the calculations are looked up in one
+    query and calculations that share a reference are submitted together.
+    Returns the calculations and {position: error message} for those that could not be submitted.
+    """
+    calcs = [
+        calculations.SNPCalculation(
+            seq_mongo_ids=rq.seq_mongo_ids,
+            reference_mongo_id=rq.reference_mongo_id,
+            depth=rq.depth,
+            ignore_hz=rq.ignore_hz,
+            hpc_resources=rq.hpc_resources
+        )
+        for rq in rqs
+    ]
+    missing = await calculations.SNPCalculation.resolve_filenames(calcs)
+    # Calculations with missing data are saved too, so the error can be looked up
+    for calc in calcs:
+        await calc.insert_document()
+    for position, message in missing.items():
+        await calcs[position].store_result(message, 'error')
+        calcs[position].status = 'error'
+    await calculations.SNPCalculation.submit([calc for position, calc in enumerate(calcs) if position not in missing])
+    return calcs, missing
+
 @app.post("/v1/snp_calculations",
     response_model=pc.CommonPOSTResponse,
     tags=["SNP"],
@@ -261,26 +770,69 @@ async def snp(rq: pc.SNPRequest):
     """
     Initialize a new SNP calculation
     """
-
-    # After - Load from config if not provided
-    #config_values = mongo_api.db['BioAPI_config'].find_one({'section': 'snp'}) or {}
-    #depth=rq.depth if rq.depth is not None else config_values.get("depth"),
-    #ignore_hz=rq.ignore_hz if rq.ignore_hz is not None else config_values.get("ignore_hz"),
-    #hpc_resources=rq.hpc_resources if rq.hpc_resources is not None else config_values.get("hpc_resources", {})
-    
-    calc = calculations.SNPCalculation(
-        seq_mongo_ids=rq.seq_mongo_ids,
-        reference_mongo_id=rq.reference_mongo_id,
-        depth=rq.depth,
-        ignore_hz=rq.ignore_hz,
-        hpc_resources=rq.hpc_resources
+    calcs, missing = await submit_snp_calculations([rq])
+    if missing:
+        raise HTTPException(
+            status_code=404,
+            detail=missing[0]
+            )
+    return pc.CommonPOSTResponse(
+        job_id=str(calcs[0]._id),
+        created_at=calcs[0].created_at.isoformat(),
+        status=calcs[0].status
     )
 
+@app.post("/v1/snp_calculations/batch",
+    response_model=list[pc.CommonPOSTResponse],
+    tags=["SNP"],
+    status_code=201,
+    responses=additional_responses
+    )
+async def snp_batch(rq: pc.SNPBatchRequest):
+    """
+    Initialize many SNP calculations at once. The response has a job per requested calculation, in the
+    same order. Calculations whose samples or reference could not be found have the status 'error'.
+    """
+    calcs, _missing = await submit_snp_calculations(rq.calculations)
+    return [
+        pc.CommonPOSTResponse(
+            job_id=str(calc._id),
+            created_at=calc.created_at.isoformat(),
+            status=calc.status
+        )
+        for calc in calcs
+    ]
 
-    # Save object in MongoDB, so at least we have something even if filename lookup fails
-    await calc.insert_document()
-
-    # First we need to get the files from a MongoDB lookup
-    # calc.query_mongodb_for_file_names()
+@app.get("/v1/snp_calculations/{snp_id}",
+    tags=["SNP"],
+    response_model=pc.SNPGETResponse,
+    responses=additional_responses
+    )
+async def snp_result(snp_id: str):
+    """
+    Get the status of a SNP calculation and the result reported by the HPC dispatcher
+    """
+    try:
+        calc = calculations.SNPCalculation.recall(snp_id)
+    except InvalidId as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e)
+            )
+    if calc is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"A document with id {snp_id} was not found in collection {calculations.SNPCalculation.collection}."
+            )
+    return pc.SNPGETResponse(**calc.to_dict())
 
-    # Now we are ready to send the calculation to RabbitMQ
\ No newline at end of file
+@app.delete("/v1/snp_calculations/{snp_id}",
+    tags=["SNP"],
+    response_model=pc.CommonPOSTResponse,
+    responses=cancel_responses
+    )
+async def cancel_snp(snp_id: str):
+    """
+    Cancel a SNP calculation. Results that the HPC dispatcher reports later are ignored.
+    """
+    return await cancel_calculation(calculations.SNPCalculation, snp_id)
@@ -1,5 +1,28 @@
+import importlib.util
+from collections import deque
+from os import getenv
+
 import pymongo
 from bson.objectid import ObjectId
+from pymongo import monitoring
+from pymongo.read_preferences import read_pref_mode_from_name, make_read_preference
+
+# Read preference for heavy reads of sequence documents (profile fetches, NN scans), e.g. 'secondaryPreferred'.
+# Job documents and the config are always read from and written to the primary.
+MONGO_PROFILE_READ_PREFERENCE = getenv('BIO_API_MONGO_PROFILE_READ_PREFERENCE', 'primary')
+# Secondaries that lag more than this are not used for profile reads (-1: no limit, otherwise at least 90)
+MONGO_PROFILE_MAX_STALENESS_SECONDS = int(getenv('BIO_API_MONGO_PROFILE_MAX_STALENESS_SECONDS', -1))
+# Comma separated network compressors in order of preference (zstd, snappy, zlib). Unavailable ones are skipped.
+MONGO_COMPRESSORS = getenv('BIO_API_MONGO_COMPRESSORS', '')
+# Connection pool sizes of the job document client and the profile client
+MONGO_MAX_POOL_SIZE = int(getenv('BIO_API_MONGO_MAX_POOL_SIZE', 100))
+MONGO_PROFILE_MAX_POOL_SIZE = int(getenv('BIO_API_MONGO_PROFILE_MAX_POOL_SIZE', 20))
+MONGO_MIN_POOL_SIZE = int(getenv('BIO_API_MONGO_MIN_POOL_SIZE', 0))
+# Number of recent command durations per client that the latency stats are computed from
+MONGO_LATENCY_WINDOW = int(getenv('BIO_API_MONGO_LATENCY_WINDOW', 1000))
+
+# The python modules that the network compressors need (zlib is built in)
+COMPRESSOR_MODULES = {'zstd': 'zstandard', 'snappy': 'snappy', 'zlib': None}
 
 def strs2ObjectIds(id_strings: list):
     """
@@ -16,26 +39,161 @@ def extractIds(cursor):
         ids.append(str(item['_id']))
     return ids
 
+def available_compressors(compressors: str):
+    "Return the configured network compressors whose python modules are installed"
+    available = list()
+    for name in filter(None, (c.strip() for c in compressors.split(','))):
+        if name not in COMPRESSOR_MODULES:
+            raise ValueError(f"Unknown MongoDB compressor '{name}'.")
+        module = COMPRESSOR_MODULES[name]
+        if module is not None and importlib.util.find_spec(module) is None:
+            print(f"{module} is not installed. Not using the {name} compressor for MongoDB.")
+            continue
+        available.append(name)
+    return available
+
+
+def get_profile_read_preference(name: str = MONGO_PROFILE_READ_PREFERENCE, max_staleness: int = MONGO_PROFILE_MAX_STALENESS_SECONDS):
+    mode = read_pref_mode_from_name(name)
+    if mode == 0:
+        return pymongo.ReadPreference.PRIMARY
+    return make_read_preference(mode, None, max_staleness=max_staleness)
+
+
+class LatencyMonitor(monitoring.CommandListener):
+    "Keeps the durations of the most recent commands of a MongoClient"
+    def __init__(self, window: int = MONGO_LATENCY_WINDOW):
+        self.durations = deque(maxlen=window)
+        self.commands = 0
+        self.failures = 0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.commands += 1
+        self.durations.append(event.duration_micros / 1000)
+
+    def failed(self, event):
+        self.commands += 1
+        self.failures += 1
+        self.durations.append(event.duration_micros / 1000)
+
+    def stats(self):
+        durations = sorted(self.durations)
+        def percentile(p):
+            return round(durations[min(int(len(durations) * p), len(durations) - 1)], 3) if durations else None
+        return {
+            'commands': self.commands,
+            'failures': self.failures,
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'max_ms': percentile(1),
+        }
+
+
 class MongoAPI:
+    """
+    Separate clients (with separate connection pools) per workload:
+    - db: job documents, config etc. Reads and writes go to the primary.
+    - profile_db: heavy reads of sequence documents, with the read preference MONGO_PROFILE_READ_PREFERENCE
+      so that they can be served by secondaries instead of competing with writes on the primary.
+    """
     def __init__(self,
         connection_string: str,
+        profile_read_preference = None,
+        compressors: str = MONGO_COMPRESSORS,
+        max_pool_size: int = MONGO_MAX_POOL_SIZE,
+        profile_max_pool_size: int = MONGO_PROFILE_MAX_POOL_SIZE,
     ):
-        self.connection = pymongo.MongoClient(connection_string, directConnection=True)
-        self.db = self.connection.get_database()
+        if profile_read_preference is None:
+            profile_read_preference = get_profile_read_preference()
+        options = {'minPoolSize': MONGO_MIN_POOL_SIZE}
+        compressors = available_compressors(compressors)
+        if compressors:
+            options['compressors'] = compressors
+        self.latency_monitors = {'primary': LatencyMonitor(), 'profiles': LatencyMonitor()}
+        # connect=False: the client connects on the first operation instead of in the background right away
+        self.connection = pymongo.MongoClient(
+            connection_string,
+            directConnection=True,
+            connect=False,
+            maxPoolSize=max_pool_size,
+            event_listeners=[self.latency_monitors['primary']],
+            **options
+        )
+        self.db = self.connection.get_database(read_preference=pymongo.ReadPreference.PRIMARY)
+        # Secondaries can only be found when connecting to the replica set rather than directly to one member
+        self.profile_connection = pymongo.MongoClient(
+            connection_string,
+            directConnection=profile_read_preference.mode == 0,
+            connect=False,
+            maxPoolSize=profile_max_pool_size,
+            read_preference=profile_read_preference,
+            event_listeners=[self.latency_monitors['profiles']],
+            **options
+        )
+        self.profile_db = self.profile_connection.get_database()
+
+    def close(self):
+        self.connection.close()
+        self.profile_connection.close()
+
+    def kill_operations(self, comment: str):
+        """
+        Kill the running operations that were started with a comment (e.g. the aggregation of a cancelled
+        calculation). Returns the number of operations that were killed.
+        """
+        killed = 0
+        for connection in (self.connection, self.profile_connection):
+            admin = connection.get_database('admin', read_preference=connection.read_preference)
+            try:
+                operations = list(admin.aggregate([
+                    {'$currentOp': {'allUsers': True}},
+                    {'$match': {'command.comment': comment}}
+                ]))
+                for operation in operations:
+                    admin.command('killOp', op=operation['opid'], read_preference=connection.read_preference)
+                    killed += 1
+            except pymongo.errors.PyMongoError as e:
+                # On a replica set with several secondaries killOp may reach another member than the operation
+                print(f"Could not kill the operations with comment {comment}: {e!r}")
+        return killed
+
+    def latency(self):
+        "Command latency and server round trip times per client"
+        latency = dict()
+        for name, connection in (('primary', self.connection), ('profiles', self.profile_connection)):
+            stats = self.latency_monitors[name].stats()
+            stats['read_preference'] = connection.read_preference.name
+            stats['servers'] = {
+                f'{address[0]}:{address[1]}': round(server.round_trip_time * 1000, 3) if server.round_trip_time is not None else None
+                for address, server in connection.topology_description.server_descriptions().items()
+            }
+            latency[name] = stats
+        return latency
 
     async def get_field_data(
             self,
             collection:str,   # MongoDB collection
             mongo_ids:list | None,   # List of MongoDB ObjectIds as str
             field_paths:list, # List of field paths in dotted notation: ['some.example.field1', 'some.other.example.field2']
+            max_time_ms:int | None = None, # Server-side time limit of the count and the cursor
         ):
+        projection = {field_path: True for field_path in field_paths}
+        time_limit = {} if max_time_ms is None else {'maxTimeMS': max_time_ms}
         if mongo_ids:
             filter = {'_id': {'$in': strs2ObjectIds(mongo_ids)}}
-            document_count = self.db[collection].count_documents(filter)
-            cursor = self.db[collection].find(filter, {field_path: True for field_path in field_paths})
+            document_count = self.profile_db[collection].count_documents(filter, **time_limit)
+            db = self.profile_db
+            if document_count < len(set(filter['_id']['$in'])) and self.profile_db.read_preference.mode != 0:
+                # Recently added sequences may not have been replicated to the secondary yet
+                document_count = self.db[collection].count_documents(filter, **time_limit)
+                db = self.db
+            cursor = db[collection].find(filter, projection).max_time_ms(max_time_ms)
         else:
-            document_count = self.db[collection].count_documents({})
-            cursor = self.db[collection].find({}, {field_path: True for field_path in field_paths})
+            document_count = self.profile_db[collection].count_documents({}, **time_limit)
+            cursor = self.profile_db[collection].find({}, projection).max_time_ms(max_time_ms)
         return document_count, cursor
 
 class Config:
@@ -0,0 +1,275 @@
+import asyncio
+import datetime
+from hashlib import sha1
+from os import getenv
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from calculations import Calculation, NearestNeighbors, hoist
+
+# Start the precompute service as a background task of the API (set to 0 if it runs as a separate worker)
+NN_PRECOMPUTE = int(getenv('NN_PRECOMPUTE', 0))
+# How new samples are found: 'change_stream' (MongoDB must run as a replica set) or 'poll'
+NN_PRECOMPUTE_SOURCE = getenv('NN_PRECOMPUTE_SOURCE', 'change_stream')
+# Seconds between queries for new samples with the 'poll' source
+NN_PRECOMPUTE_POLL_INTERVAL = float(getenv('NN_PRECOMPUTE_POLL_INTERVAL', 10))
+# Seconds an instance of the service holds its lease without renewing it; only the holder runs
+NN_PRECOMPUTE_LEASE_SECONDS = float(getenv('NN_PRECOMPUTE_LEASE_SECONDS', 60))
+
+# The precomputed neighbors of each sample, with the sample's _id
+PRECOMPUTED_COLLECTION = 'nn_precomputed'
+# The change stream resume token, the watermark of the poll source and the lease of the running instance
+STATE_COLLECTION = 'nn_precompute_state'
+
+
+def profile_hash(profile):
+    "Fingerprint of an allele profile, so neighbors that were computed for an earlier profile are not used"
+    return sha1(repr(profile).encode()).hexdigest()
+
+
+def touches(path: str, updated_fields):
+    "True if an update of the (dotted) updated_fields may have changed the field at path"
+    return any(path == field or path.startswith(field + '.') or field.startswith(path + '.') for field in updated_fields)
+
+
+def comparable(calc: NearestNeighbors):
+    "True if the input sequence of calc has a profile that passes the filters of nearest neighbors calculations"
+    try:
+        calc.input_profile
+        hoist(calc.input_sequence, calc.digest_path)
+        return hoist(calc.input_sequence, calc.call_pct_path) > 85
+    except (KeyError, TypeError):
+        return False
+
+
+def lookup(db, calc: NearestNeighbors):
+    """
+    Return the precomputed neighbors of the input sequence of a nearest neighbors calculation, or None if
+    there are none that answer it. They must have been computed for the current profile of the sample, with
+    the same unknowns_are_diffs and filtering and a cutoff that is not lower than the calculation's. A
+    calculation without a cutoff is never answered from them.
+    """
+    if calc.cutoff is None:
+        return None
+    doc = db[PRECOMPUTED_COLLECTION].find_one({'_id': calc.input_sequence['_id']})
+    if doc is None or doc['cutoff'] is None or doc['cutoff'] < calc.cutoff:
+        return None
+    if doc['unknowns_are_diffs'] != calc.unknowns_are_diffs or doc['filtering'] != calc.filtering:
+        return None
+    if doc['profile_hash'] != profile_hash(calc.input_profile):
+        return None
+    return [neighbor for neighbor in doc['neighbors'] if neighbor['diff_count'] < calc.cutoff]
+
+
+class NeighborPrecomputer:
+    """
+    Computes the nearest neighbors of samples as they gain a cgMLST profile, with the configured cutoff and
+    engine, so that a later nearest neighbors request for the sample is answered from the stored result.
+
+    Neighbors are symmetric, so a new sample is also added to the precomputed neighbors of each of its
+    neighbors; their lists stay complete without recomputing them. A sample that changes is removed from the
+    lists of the others before its neighbors are recomputed, and a sample that is deleted or no longer has
+    a comparable profile is removed altogether. Samples are processed one at a time, and the MongoDB writes
+    run outside of the event loop.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.collection = db[PRECOMPUTED_COLLECTION]
+        self.collection.create_index('neighbors._id')
+
+    def forget(self, sample_id):
+        "Remove a sample from the precomputed neighbors of all samples, and its own precomputed neighbors"
+        self.collection.update_many({'neighbors._id': sample_id}, {'$pull': {'neighbors': {'_id': sample_id}}})
+        self.collection.delete_one({'_id': sample_id})
+
+    async def precompute(self, sample: dict):
+        "Compute and store the neighbors of a sample. Returns the neighbors, or None if the sample is not comparable."
+        calc = NearestNeighbors(input_mongo_id=str(sample['_id']))
+        calc.input_sequence = sample
+        # The samples that were added just before this one must be found to keep the neighbor lists complete
+        calc.fresh_profiles = True
+        await asyncio.to_thread(self.forget, sample['_id'])
+        if not comparable(calc):
+            return None
+        neighbors = sorted(
+            ({'_id': neighbor['_id'], 'diff_count': neighbor['diff_count']} for neighbor in await calc.find_neighbors()),
+            key=lambda neighbor: neighbor['diff_count']
+        )
+        await asyncio.to_thread(self.collection.replace_one, {'_id': sample['_id']}, {
+            'cutoff': calc.cutoff,
+            'unknowns_are_diffs': calc.unknowns_are_diffs,
+            'filtering': calc.filtering,
+            'profile_hash': profile_hash(calc.input_profile),
+            'neighbors': neighbors,
+            'computed_at': datetime.datetime.now(tz=datetime.timezone.utc),
+        }, upsert=True)
+        requests = [
+            UpdateOne(
+                {
+                    '_id': neighbor['_id'],
+                    'cutoff': calc.cutoff,
+                    'unknowns_are_diffs': calc.unknowns_are_diffs,
+                    'filtering': calc.filtering,
+                    'neighbors._id': {'$ne': sample['_id']},
+                },
+                {'$push': {'neighbors': {
+                    '$each': [{'_id': sample['_id'], 'diff_count': neighbor['diff_count']}],
+                    '$sort': {'diff_count': 1}
+                }}}
+            )
+            for neighbor in neighbors
+        ]
+        if requests:
+            await asyncio.to_thread(self.collection.bulk_write, requests, ordered=False)
+        return neighbors
+
+    async def run(self, samples):
+        "Precompute the neighbors of the samples of an async iterable until it is exhausted (or forever for a change stream)"
+        async for sample in samples:
+            try:
+                neighbors = await self.precompute(sample)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Could not precompute the neighbors of sample {sample['_id']}: {e!r}")
+                continue
+            if neighbors is not None:
+                print(f"Precomputed {len(neighbors)} neighbors of sample {sample['_id']}")
+
+
+def profile_paths(calc: NearestNeighbors):
+    "The fields of a sample that decide whether it has a comparable profile"
+    return [calc.allele_path, calc.digest_path, calc.call_pct_path]
+
+
+async def change_stream_samples(db, seq_collection: str, paths: list):
+    """
+    Yield the samples whose profile may have changed, from a change stream on the sequence collection.
+    Deleted samples are yielded with only their _id. The resume token is stored after a change has been
+    processed, so the service continues after the last processed change when it is restarted.
+    """
+    state = db[STATE_COLLECTION]
+    saved = await asyncio.to_thread(state.find_one, {'_id': 'change_stream'})
+    pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}]
+    with db[seq_collection].watch(
+            pipeline,
+            full_document='updateLookup',
+            resume_after=saved['resume_token'] if saved else None) as stream:
+        while stream.alive:
+            # try_next waits for at most the server's await time, so run it outside of the event loop
+            change = await asyncio.to_thread(stream.try_next)
+            if change is None:
+                continue
+            description = change.get('updateDescription', {})
+            changed_fields = list(description.get('updatedFields', {})) + description.get('removedFields', [])
+            if change['operationType'] != 'update' or any(touches(path, changed_fields) for path in paths):
+                # The full document is missing if the sample was deleted after the change
+                yield change.get('fullDocument') or {'_id': change['documentKey']['_id']}
+            await asyncio.to_thread(state.replace_one, {'_id': 'change_stream'}, {'resume_token': change['_id']}, upsert=True)
+
+
+async def polled_samples(db, seq_collection: str, paths: list, interval: float = NN_PRECOMPUTE_POLL_INTERVAL):
+    """
+    Yield new samples with a profile by polling for _ids after the last one seen, for deployments without a
+    replica set. Unlike the change stream, this does not see a profile that is added to or changed in a
+    sample after it has been seen, nor deleted samples.
+    """
+    state = db[STATE_COLLECTION]
+    saved = await asyncio.to_thread(state.find_one, {'_id': 'poll'})
+    last_id = saved['last_id'] if saved else None
+    projection = {path: True for path in paths}
+    while True:
+        query = {paths[0]: {'$exists': True}}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        new_samples = await asyncio.to_thread(lambda: list(db[seq_collection].find(query, projection).sort('_id', 1)))
+        for sample in new_samples:
+            yield sample
+            last_id = sample['_id']
+            await asyncio.to_thread(state.replace_one, {'_id': 'poll'}, {'last_id': last_id}, upsert=True)
+        await asyncio.sleep(interval)
+
+
+class Lease:
+    """
+    A document in the state collection that lets one instance of the precompute service run at a time. It
+    expires when its holder stops renewing it, so another instance takes over when the holder has died.
+    """
+    def __init__(self, db, seconds: float = NN_PRECOMPUTE_LEASE_SECONDS):
+        self.state = db[STATE_COLLECTION]
+        self.seconds = seconds
+        self.holder = str(ObjectId())
+
+    def acquire(self):
+        "Take the lease if it is free or has expired, or renew it if this instance holds it. Returns True if it does."
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        try:
+            self.state.update_one(
+                {'_id': 'lease', '$or': [{'holder': self.holder}, {'expires_at': {'$lt': now}}]},
+                {'$set': {'holder': self.holder, 'expires_at': now + datetime.timedelta(seconds=self.seconds)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Another instance holds the lease
+            return False
+        return True
+
+    def release(self):
+        self.state.delete_one({'_id': 'lease', 'holder': self.holder})
+
+    async def hold(self, work):
+        "Run a coroutine while renewing the lease. The coroutine is cancelled if the lease is lost to another instance."
+        task = asyncio.create_task(work)
+        try:
+            while True:
+                done, _pending = await asyncio.wait({task}, timeout=self.seconds / 3)
+                if done:
+                    return task.result()
+                if not await asyncio.to_thread(self.acquire):
+                    print("Nearest neighbors precompute service lost its lease to another instance.")
+                    return None
+        finally:
+            task.cancel()
+            await asyncio.to_thread(self.release)
+
+
+async def serve(db, source: str):
+    "Precompute the neighbors of the samples from the source"
+    calc = NearestNeighbors()
+    if source == 'poll':
+        samples = polled_samples(db, calc.seq_collection, profile_paths(calc))
+    else:
+        samples = change_stream_samples(db, calc.seq_collection, profile_paths(calc))
+    await NeighborPrecomputer(db).run(samples)
+
+
+async def precompute_neighbors(db, source: str = NN_PRECOMPUTE_SOURCE, lease_seconds: float = NN_PRECOMPUTE_LEASE_SECONDS):
+    "Keep precomputing the neighbors of new samples while this instance holds the lease, restarting the source if it fails"
+    lease = Lease(db, lease_seconds)
+    while True:
+        try:
+            if NearestNeighbors().cutoff is None:
+                print("Nearest neighbors precompute service not started: the nearest_neighbors config section has no cutoff.")
+                return
+            if not await asyncio.to_thread(lease.acquire):
+                await asyncio.sleep(lease.seconds / 3)
+                continue
+            print(f"Nearest neighbors precompute service {lease.holder} holds the lease.")
+            await lease.hold(serve(db, source))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Nearest neighbors precompute service stopped: {e!r}. Restarting in 5 seconds.")
+        await asyncio.sleep(5)
+
+
+if __name__ == '__main__':
+    # Run the precompute service as a separate worker
+    from mongo import MongoAPI
+    from calculations import MONGO_CONNECTION_STRING
+
+    mongo_api = MongoAPI(MONGO_CONNECTION_STRING)
+    Calculation.set_mongo_api(mongo_api)
+    asyncio.run(precompute_neighbors(mongo_api.db))
@@ -0,0 +1,262 @@
+import os
+import shutil
+import threading
+import time
+from hashlib import sha1
+from os import getenv
+from pathlib import Path
+
+import bson
+import numpy as np
+
+from allele_encoding import get_codebook, profile_loci
+from bitslice import BitSlicedIndex
+
+# If set, profile matrices are published to this directory and memory-mapped read-only by every process
+# (e.g. all uvicorn workers) instead of being loaded into each process separately.
+PROFILE_STORE_DIR = getenv('PROFILE_STORE_DIR', '')
+# A build lock older than this (in seconds) is considered left behind by a crashed process
+BUILD_LOCK_TIMEOUT = int(getenv('PROFILE_STORE_BUILD_LOCK_TIMEOUT', 600))
+# Version of the files of a generation. Generations of another version are rebuilt instead of attached.
+GENERATION_FORMAT = 2
+
+
+def chunked(iterable, size: int):
+    "Yield lists of at most size elements from an iterable (like a MongoDB cursor)"
+    chunk = list()
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+class ProfileMatrix:
+    """
+    All comparable allele profiles for one schema digest, integer encoded.
+    The bit-sliced index is only built when it is asked for, unless it was loaded with the matrix.
+    """
+    def __init__(
+            self,
+            db,
+            ids: list,
+            codes: np.ndarray,
+            loci: list,
+            fingerprint: tuple,
+            bitslice: BitSlicedIndex | None = None,
+            generation: str | None = None):
+        self.db = db
+        self.ids = ids
+        self.codes = codes
+        self.loci = loci
+        self.fingerprint = fingerprint
+        self._bitslice = bitslice
+        self.generation = generation
+
+    @property
+    def bitslice(self):
+        if self._bitslice is None:
+            self._bitslice = BitSlicedIndex(self.codes)
+        return self._bitslice
+
+
+class SharedGenerations:
+    """
+    Published generations of one profile matrix in a directory shared by several processes.
+
+    Each generation is a directory with the codes and the bit-sliced index as .npy files, which readers
+    memory-map read-only so that the operating system shares the pages between processes. The file CURRENT
+    names the current generation. A new generation is written next to the current one and published by
+    atomically replacing CURRENT, so readers never see a partially written generation and never wait for a
+    build. Only one process builds at a time (build.lock); the others keep using the current generation.
+    """
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.pointer = Path(directory, 'CURRENT')
+        self.lock = Path(directory, 'build.lock')
+
+    def current(self):
+        "Return the directory of the current generation, or None if nothing has been published"
+        try:
+            return Path(self.directory, self.pointer.read_text().strip())
+        except FileNotFoundError:
+            return None
+
+    def attach(self, db, generation: Path):
+        "Memory-map a published generation. Returns None if it was written in another format."
+        meta = bson.decode(Path(generation, 'meta.bson').read_bytes())
+        if meta.get('format') != GENERATION_FORMAT:
+            return None
+        ids = bson.decode(Path(generation, 'ids.bson').read_bytes())['ids']
+        index = BitSlicedIndex.from_arrays(
+            np.load(Path(generation, 'planes.npy'), mmap_mode='r'),
+            np.load(Path(generation, 'ignored.npy'), mmap_mode='r'),
+            len(ids)
+        )
+        codes = np.load(Path(generation, 'codes.npy'), mmap_mode='r')
+        return ProfileMatrix(db, ids, codes, meta['loci'], tuple(meta['fingerprint']), index, generation.name)
+
+    def acquire(self):
+        "Try to become the builder. Returns False if another process is building."
+        self.directory.mkdir(parents=True, exist_ok=True)
+        try:
+            os.close(os.open(self.lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - self.lock.stat().st_mtime < BUILD_LOCK_TIMEOUT:
+                    return False
+                self.lock.unlink()
+            except FileNotFoundError:
+                pass
+            return self.acquire()
+
+    def release(self):
+        self.lock.unlink(missing_ok=True)
+
+    def publish(self, matrix: ProfileMatrix):
+        "Write a matrix as a new generation, make it the current one and remove older generations"
+        previous = self.current()
+        name = f"gen-{time.time_ns()}-{os.getpid()}"
+        staging = Path(self.directory, name + '.tmp')
+        staging.mkdir()
+        np.save(Path(staging, 'codes.npy'), matrix.codes)
+        np.save(Path(staging, 'planes.npy'), matrix.bitslice.planes)
+        np.save(Path(staging, 'ignored.npy'), matrix.bitslice.ignored)
+        Path(staging, 'ids.bson').write_bytes(bson.encode({'ids': matrix.ids}))
+        Path(staging, 'meta.bson').write_bytes(bson.encode({
+            'format': GENERATION_FORMAT,
+            'loci': matrix.loci,
+            'fingerprint': list(matrix.fingerprint)
+        }))
+        staging.rename(Path(self.directory, name))
+
+        pointer = Path(self.directory, f'CURRENT.{os.getpid()}.tmp')
+        pointer.write_text(name)
+        os.replace(pointer, self.pointer)
+
+        # Processes that still have the previous generation mapped keep it until they move on; older
+        # generations are not used by anyone.
+        for path in self.directory.glob('gen-*'):
+            if path.name != name and (previous is None or path.name != previous.name):
+                shutil.rmtree(path, ignore_errors=True)
+        return Path(self.directory, name)
+
+
+class ProfileStore:
+    """
+    Cache of encoded allele profiles per (collection, schema digest).
+
+    A cached matrix is reused as long as the number of matching sequence documents and the highest _id
+    among them are unchanged, which is the case until sequences are added or deleted. A profile that is
+    changed in place in an existing sequence document is not noticed until then.
+
+    A cached matrix is returned right away and checked (and rebuilt if needed) in a background thread, so a
+    request only sees the sequences that were added before the previous check of the matrix. Only a request
+    for a matrix that is not cached yet, or one that asks for a fresh matrix, waits for the check and build.
+
+    Without a directory, every process keeps its own matrices in memory. With a directory, one process
+    builds a matrix and publishes it (see SharedGenerations), and all processes memory-map it.
+    """
+    def __init__(self, batch_size: int = 5000, directory: str = PROFILE_STORE_DIR):
+        self.batch_size = batch_size
+        self.directory = directory
+        self.matrices = dict()
+        # Keys of the matrices that are being checked in a background thread
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def fingerprint(self, collection, filter: dict):
+        last = collection.find_one(filter, {'_id': True}, sort=[('_id', -1)])
+        return (collection.count_documents(filter), last['_id'] if last else None)
+
+    def get(self, db, collection_name: str, digest, allele_path: str, filter: dict, read_db=None, fresh: bool = False):
+        """
+        Return the ProfileMatrix for the sequences in collection_name that match filter, encoded with the
+        codebook of the schema digest. Documents without a profile in allele_path are skipped.
+        The sequences are read from read_db (e.g. a handle that reads from secondaries) if given; the
+        codebook is always read from and written to db.
+        With fresh=True, the matrix is checked and rebuilt if needed before it is returned.
+        """
+        collection = (db if read_db is None else read_db)[collection_name]
+        key = (db.name, collection_name, str(digest), allele_path)
+        matrix = self.matrices.get(key)
+        if matrix is not None and matrix.db is db and not fresh:
+            self.refresh_in_background(key, db, collection, digest, allele_path, filter)
+            return matrix
+        return self.refresh(key, db, collection, digest, allele_path, filter)
+
+    def refresh_in_background(self, key: tuple, db, collection, digest, allele_path: str, filter: dict):
+        "Check the matrix for key in a background thread, unless that is already happening"
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        def refresh():
+            try:
+                self.refresh(key, db, collection, digest, allele_path, filter)
+            except Exception as e:
+                print(f"Could not refresh profile matrix {key}: {e!r}")
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+        threading.Thread(target=refresh, name='profile-store-refresh', daemon=True).start()
+
+    def refresh(self, key: tuple, db, collection, digest, allele_path: str, filter: dict):
+        "Return the cached matrix for key if it is up to date, otherwise build (or attach) and cache a new one"
+        fingerprint = self.fingerprint(collection, filter)
+        matrix = self.matrices.get(key)
+        if matrix is not None and matrix.db is db and matrix.fingerprint == fingerprint:
+            return matrix
+
+        if self.directory:
+            matrix = self.shared(key, fingerprint, db, collection, digest, allele_path, filter)
+        else:
+            matrix = self.build(db, collection, digest, allele_path, filter, fingerprint)
+        self.matrices[key] = matrix
+        return matrix
+
+    def shared(self, key: tuple, fingerprint: tuple, db, collection, digest, allele_path: str, filter: dict):
+        "Attach the published matrix for key, publishing a new generation first if it is out of date"
+        generations = SharedGenerations(Path(self.directory, sha1(repr(key).encode()).hexdigest()))
+        current = generations.current()
+        matrix = generations.attach(db, current) if current is not None else None
+        if matrix is not None and matrix.fingerprint == fingerprint:
+            return matrix
+        if not generations.acquire():
+            if matrix is not None:
+                print(f"Profile matrix {key} is being rebuilt by another process. Using generation {current.name}.")
+                return matrix
+            print(f"Profile matrix {key} is being built by another process. Building a private copy.")
+            return self.build(db, collection, digest, allele_path, filter, fingerprint)
+        try:
+            matrix = self.build(db, collection, digest, allele_path, filter, fingerprint)
+            return generations.attach(db, generations.publish(matrix))
+        finally:
+            generations.release()
+
+    def build(self, db, collection, digest, allele_path: str, filter: dict, fingerprint: tuple):
+        "Read and encode the profiles from MongoDB"
+        codebook = get_codebook(db, digest)
+        ids = list()
+        loci = dict()
+        chunks = list()
+        pipeline = [{'$match': filter}, {'$project': {'profile': f'${allele_path}'}}]
+        cursor = collection.aggregate(pipeline, batchSize=self.batch_size)
+        for docs in chunked(cursor, self.batch_size):
+            docs = [doc for doc in docs if doc.get('profile') is not None]
+            loci.update(dict.fromkeys(profile_loci([doc['profile'] for doc in docs])))
+            chunks.append(codebook.encode([doc['profile'] for doc in docs], list(loci)))
+            ids.extend(doc['_id'] for doc in docs)
+        # Earlier chunks may have fewer loci than later ones. Missing loci are encoded as missing calls (0).
+        codes = np.zeros((len(ids), len(loci)), dtype=codebook.dtype)
+        row = 0
+        for chunk in chunks:
+            codes[row:row + len(chunk), :chunk.shape[1]] = chunk
+            row += len(chunk)
+        return ProfileMatrix(db, ids, codes, list(loci), fingerprint)
+
+
+profile_store = ProfileStore()
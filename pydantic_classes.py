@@ -1,7 +1,7 @@
 import typing
 from enum import Enum
 from typing import Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 
@@ -10,9 +10,17 @@ class DeprecatedFields(BaseModel):
     seqid_field_path: Optional[str] = None
     profile_field_path: Optional[str] = None
 
+class TimeLimit(BaseModel):
+    """
+    timeout_seconds: the calculation ends with status 'timeout' if it has not finished after this many seconds
+    (default: the 'timeout_seconds' config value of the calculation type, or no limit)
+    """
+    timeout_seconds: Optional[float] = None
+
+
 # Request classes
 
-class NearestNeighborsRequest(DeprecatedFields):
+class NearestNeighborsRequest(DeprecatedFields, TimeLimit):
     """
     Parameters for a REST request for a nearest neighbors calculation.
     """
@@ -23,7 +31,7 @@ class NearestNeighborsRequest(DeprecatedFields):
     cutoff: Optional[int] = None
     unknowns_are_diffs: Optional[bool] = None
 
-class DistanceMatrixRequest(DeprecatedFields):
+class DistanceMatrixRequest(DeprecatedFields, TimeLimit):
     """
     Parameters for a REST request for a distance calculation.
 
@@ -31,18 +39,72 @@ class DistanceMatrixRequest(DeprecatedFields):
     seqid_field_path: field path in dotted notation which contains the 'sequence id' the user wants to see
     profile_field_path: field path in dotted notation which contains the cgMLST allele profiles
     seq_mongo_ids: the  _id strings for the desired sequence documents
+    max_distance: distances are exact up to this value, larger distances are stored as max_distance + 1
+    (default: the 'max_distance' config value, or no limit)
     """
     seq_mongo_ids: list | None
+    max_distance: Optional[int] = None
+
+
+class ThresholdGraphRequest(TimeLimit):
+    """
+    Parameters for a REST request for the graph of the sequences that are close to each other.
+
+    seq_mongo_ids: the _id strings for the desired sequence documents (all sequences if null)
+    max_distance: sequences with at most this many allele differences are connected
+    (default: the 'max_distance' config value, or 10)
+    """
+    seq_mongo_ids: list | None
+    max_distance: Optional[int] = None
+
+
+class ClusterRequest(TimeLimit):
+    """
+    Parameters for a REST request for assigning a sequence to clusters.
 
+    input_mongo_id: the _id string for the sequence document
+    thresholds: allele distance thresholds, at least one (defaults to the thresholds in the config)
+    """
+    input_mongo_id: str
+    thresholds: Optional[list[int]] = Field(default=None, min_length=1)
+
+
+class SubMatrixRequest(BaseModel):
+    """
+    Parameters for a REST request for extracting a sub-matrix from a completed distance calculation.
 
-class HCTreeCalcRequest(BaseModel):
+    dmx_job: the job_id of the distance calculation to slice
+    seq_mongo_ids: the _id strings of the sequences to include
+    sequence_ids: the sequence IDs (as in the source matrix) of the sequences to include
+    Either seq_mongo_ids or sequence_ids must be given.
+    """
+    dmx_job: str
+    seq_mongo_ids: Optional[list[str]] = None
+    sequence_ids: Optional[list[str]] = None
+
+
+# See https://docs.scipy.org/doc/scipy/reference/cluster.hierarchy.html
+LinkageMethod = typing.Literal["single", "complete", "average", "weighted", "centroid", "median", "ward"]
+
+
+class HCTreeCalcRequest(TimeLimit):
     """
     Parameters for a REST request for a tree calculation based on hierarchical clustering.
     Distances are taken directly from the request.
     """
     dmx_job: str
-    # See https://docs.scipy.org/doc/scipy/reference/cluster.hierarchy.html
-    method: typing.Literal["single", "complete", "average", "weighted", "centroid", "median", "ward"]
+    method: LinkageMethod
+
+
+class TreePipelineRequest(TimeLimit):
+    """
+    Parameters for a REST request for trees made directly from allele profiles.
+
+    seq_mongo_ids: the _id strings for the desired sequence documents
+    methods: the linkage methods to make trees with
+    """
+    seq_mongo_ids: list | None
+    methods: list[LinkageMethod] = ["single"]
 
 
 class SNPRequest(BaseModel):
@@ -64,6 +126,14 @@ class SNPRequest(BaseModel):
     # TODO: hpc_resources: we probably need to be able to specify these in the request.
 
 
+class SNPBatchRequest(BaseModel):
+    """
+    Parameters for a REST request for many SNP calculations. Calculations with the same reference are
+    sent to the HPC cluster together.
+    """
+    calculations: list[SNPRequest]
+
+
 # Response classes
 
 class Message(BaseModel):
@@ -74,6 +144,9 @@ class Status(str, Enum):
     init = "init"
     completed = "completed"
     error = "error"
+    evicted = "evicted"
+    cancelled = "cancelled"
+    timeout = "timeout"
 
 
 class CommonPOSTResponse(BaseModel):
@@ -83,8 +156,19 @@ class CommonPOSTResponse(BaseModel):
     status: Status
 
 
+class Progress(BaseModel):
+    """Progress of a running calculation. processed, total and eta_seconds are not known for every stage."""
+    stage: str
+    processed: typing.Optional[int] = None
+    total: typing.Optional[int] = None
+    eta_seconds: typing.Optional[float] = None
+    updated_at: str
+
+
 class CommonGETResponse(CommonPOSTResponse):
     finished_at: typing.Optional[str]  # Optional since if job not completed the field will not exist
+    progress: typing.Optional[Progress] = None  # Set while the calculation is running, and where it stopped if it timed out
+    deadline: typing.Optional[str] = None
 
 
 class Neighbor(BaseModel):
@@ -96,17 +180,79 @@ class NearestNeighborsGETResponse(NearestNeighborsRequest, CommonGETResponse):
     result: typing.Any
 
 
+class ClusterAssignment(BaseModel):
+    threshold: int
+    cluster: int
+    merged: list[int]
+
+
+class ClusterGETResponse(ClusterRequest, CommonGETResponse):
+    result: typing.Optional[list[ClusterAssignment] | str]
+
+
 class DistanceMatrixResult(BaseModel):
     seq_to_mongo: dict
     distances: typing.Optional[dict] = None
 
 class DistanceMatrixGETResponse(DistanceMatrixRequest, CommonGETResponse):
+    source_dmx_job: Optional[str] = None
     result: typing.Any
 
 
+class ThresholdGraphResult(BaseModel):
+    samples: int
+    edges: int
+    components: int  # Connected components with more than one sample
+
+
+class ThresholdGraphGETResponse(ThresholdGraphRequest, CommonGETResponse):
+    result: typing.Optional[ThresholdGraphResult | str]
+
+
+class GraphEdge(BaseModel):
+    a: str
+    b: str
+    distance: int
+
+
+class ThresholdGraphComponents(BaseModel):
+    components: list[list[str]]  # Lists of mongo ids, largest component first
+
+
+class ThresholdGraphNeighborhood(BaseModel):
+    component: list[str]  # The mongo ids of the connected component of the sample
+    edges: list[GraphEdge]  # The edges of the sample, closest first
+
+
 class HCTreeCalcGETResponse(HCTreeCalcRequest, CommonGETResponse):
     result: typing.Optional[str]
 
 
+class TreePipelineGETResponse(TreePipelineRequest, CommonGETResponse):
+    dmx_job: typing.Optional[str] = None
+    result: typing.Any
+
+
 class SNPGETResponse(SNPRequest, CommonGETResponse):
-    result: typing.Optional[DistanceMatrixResult]
\ No newline at end of file
+    hpc_status: typing.Optional[str] = None  # Last status reported by the HPC dispatcher
+    error_msg: typing.Optional[str] = None  # Reason the HPC job failed
+    result: typing.Any = None  # Result (file locations) reported by the HPC dispatcher
+
+
+class CompressionStats(BaseModel):
+    collection: str
+    codec: str
+    results: int
+    raw_bytes: int
+    stored_bytes: int
+    ratio: typing.Optional[float]
+
+
+class MongoLatency(BaseModel):
+    read_preference: str
+    commands: int
+    failures: int
+    p50_ms: Optional[float] = None
+    p95_ms: Optional[float] = None
+    max_ms: Optional[float] = None
+    servers: dict[str, Optional[float]]  # Round trip time in ms per server
@@ -0,0 +1,133 @@
+import datetime
+import math
+import os
+from os import getenv
+
+import numpy as np
+from pymongo import UpdateOne
+
+# Observed runtime and memory usage of finished HPC calls, one document per call
+USAGE_COLLECTION = 'hpc_usage'
+# Input size features of an HPC call
+FEATURES = ('samples', 'read_bytes', 'reference_bytes')
+# Fewer observations than this (per job type and feature set) and the configured resources are used as they are
+MIN_OBSERVATIONS = int(getenv('HPC_ESTIMATOR_MIN_OBSERVATIONS', 10))
+# Only the most recent observations are used, so the model follows changes in tools and hardware
+MAX_OBSERVATIONS = int(getenv('HPC_ESTIMATOR_MAX_OBSERVATIONS', 500))
+
+DEFAULT_SETTINGS = {
+    'margin': 1.5,  # Multiplied with the estimated memory and walltime
+    'min_cpus': 1,
+    'max_cpus': 16,
+    'min_memGB': 1,
+    'max_memGB': 256,
+    'target_walltime_hours': 1,  # cpus are chosen so that a job is expected to finish within this time
+    'max_walltime_hours': 48,
+}
+
+
+def file_size(path):
+    "Return the size of a file, or None if it cannot be read from here (e.g. it only exists on the HPC cluster)"
+    try:
+        return os.stat(path).st_size
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+def flatten(filenames):
+    for filename in filenames:
+        if isinstance(filename, (list, tuple)):
+            yield from flatten(filename)
+        else:
+            yield filename
+
+
+def snp_features(input_filenames: list, reference_filename: str | None):
+    "Input size features of an SNP job or a batch of SNP jobs. File sizes are None if unknown."
+    read_sizes = [file_size(filename) for filename in flatten(input_filenames)]
+    return {
+        'samples': len(input_filenames),
+        'read_bytes': None if None in read_sizes else sum(read_sizes),
+        'reference_bytes': file_size(reference_filename),
+    }
+
+
+def format_walltime(seconds: float):
+    seconds = int(math.ceil(seconds))
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def record_usage(db, usages: list):
+    """
+    Store the observed usage of finished HPC calls.
+    usages is a list of dicts with hpc_call, job_type, features, runtime_seconds, memory_gb and cpus, and
+    backend 'local' for calls that ran in the local process pool.
+    Jobs that were submitted in the same call share the call's usage, so a call is only stored once.
+    """
+    requests = [
+        UpdateOne(
+            {'hpc_call': usage['hpc_call']},
+            {'$setOnInsert': dict(usage, recorded_at=datetime.datetime.now(tz=datetime.timezone.utc))},
+            upsert=True
+        )
+        for usage in usages
+    ]
+    if requests:
+        db[USAGE_COLLECTION].bulk_write(requests, ordered=False)
+
+
+def fit(x: np.ndarray, y: np.ndarray):
+    "Least squares fit of y = x @ coefficients (x including a constant column). Returns the coefficients and the residual standard deviation."
+    coefficients, _residuals, _rank, _sv = np.linalg.lstsq(x, y, rcond=None)
+    residual_std = float(np.std(y - x @ coefficients))
+    return coefficients, residual_std
+
+
+class ResourceEstimator:
+    """
+    Estimates the resources of an HPC call from the input size, using linear models of the CPU time and
+    memory usage of previous calls of the same job type.
+
+    Only the features that are known for the call (file sizes may be unknown) are used, and only previous
+    calls with those features contribute. Calls that ran on the local backend are not used, as they ran on
+    other hardware. Until there are MIN_OBSERVATIONS of those, the configured resources are returned as
+    they are.
+    """
+    def __init__(self, db, settings: dict | None = None):
+        self.db = db
+        self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+
+    def observations(self, job_type: str, features: list):
+        query = {'job_type': job_type, 'backend': {'$ne': 'local'}, 'runtime_seconds': {'$gt': 0}, 'memory_gb': {'$gt': 0}}
+        for feature in features:
+            query[f'features.{feature}'] = {'$type': 'number'}
+        return list(self.db[USAGE_COLLECTION].find(
+            query,
+            {'features': True, 'runtime_seconds': True, 'memory_gb': True, 'cpus': True}
+        ).sort('recorded_at', -1).limit(MAX_OBSERVATIONS))
+
+    def estimate(self, job_type: str, features: dict, defaults: dict):
+        "Return defaults with cpus, memGB and walltime replaced by estimates if there are enough observations"
+        known = [feature for feature in FEATURES if features.get(feature) is not None]
+        observations = self.observations(job_type, known)
+        if len(observations) < MIN_OBSERVATIONS:
+            return dict(defaults)
+
+        x = np.array([[1.0] + [float(doc['features'][f]) for f in known] for doc in observations])
+        query = np.array([1.0] + [float(features[f]) for f in known])
+        cpu_seconds = np.array([doc['runtime_seconds'] * (doc.get('cpus') or 1) for doc in observations], dtype=float)
+        memory_gb = np.array([doc['memory_gb'] for doc in observations], dtype=float)
+
+        settings = self.settings
+        margin = settings['margin']
+        coefficients, residual_std = fit(x, cpu_seconds)
+        # Rounded so that floating point noise in an exact fit does not add a CPU or a GB
+        expected_cpu_seconds = round(max(float(query @ coefficients) + residual_std, 1.0) * margin)
+        coefficients, residual_std = fit(x, memory_gb)
+        expected_memory_gb = round(max(float(query @ coefficients) + residual_std, 0.0) * margin, 2)
+
+        target_seconds = settings['target_walltime_hours'] * 3600
+        cpus = min(max(math.ceil(expected_cpu_seconds / target_seconds), settings['min_cpus']), settings['max_cpus'])
+        walltime = min(expected_cpu_seconds / cpus, settings['max_walltime_hours'] * 3600)
+        memory = min(max(math.ceil(expected_memory_gb), settings['min_memGB']), settings['max_memGB'])
+        return dict(defaults, cpus=cpus, memGB=memory, walltime=format_walltime(max(walltime, 60)))
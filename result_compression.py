@@ -0,0 +1,91 @@
+import gzip
+
+import bson
+from bson.binary import Binary
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Results that are smaller than this (BSON encoded) are stored as they are
+DEFAULT_MIN_BYTES = 16384
+DEFAULT_CODEC = 'gzip'
+# A compressed result is stored as {COMPRESSED_MARKER: codec, 'data': Binary(...)} in the result field
+COMPRESSED_MARKER = '_compressed'
+
+
+def available_codec(codec: str):
+    "Return the codec to use for a configured codec, falling back to gzip if zstandard is not installed"
+    if codec == 'zstd' and zstandard is None:
+        print("zstandard is not installed. Compressing results with gzip instead.")
+        return 'gzip'
+    if codec not in ('gzip', 'zstd', 'none'):
+        raise ValueError(f"Unknown result compression codec '{codec}'.")
+    return codec
+
+
+def compress_result(result, codec: str = DEFAULT_CODEC, min_bytes: int = DEFAULT_MIN_BYTES, level: int | None = None):
+    """
+    Compress a result if its BSON encoding is at least min_bytes long.
+    The result is BSON encoded before compression, so ObjectIds, datetimes etc. survive the round trip.
+    Returns the value to store in the result field and the compression stats (None if not compressed).
+    """
+    codec = available_codec(codec)
+    if codec == 'none' or result is None:
+        return result, None
+    raw = bson.encode({'result': result})
+    if len(raw) < min_bytes:
+        return result, None
+    if codec == 'zstd':
+        data = zstandard.ZstdCompressor(level=level if level is not None else 3).compress(raw)
+    else:
+        data = gzip.compress(raw, compresslevel=level if level is not None else 6)
+    stats = {
+        'codec': codec,
+        'raw_bytes': len(raw),
+        'stored_bytes': len(data),
+        'ratio': round(len(raw) / len(data), 2)
+    }
+    return {COMPRESSED_MARKER: codec, 'data': Binary(data)}, stats
+
+
+def is_compressed(value):
+    return isinstance(value, dict) and COMPRESSED_MARKER in value
+
+
+def decompress_result(value):
+    "Return a result as it was before compress_result(). Values that are not compressed are returned as they are."
+    if not is_compressed(value):
+        return value
+    codec = value[COMPRESSED_MARKER]
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("This result is compressed with zstd but zstandard is not installed.")
+        raw = zstandard.ZstdDecompressor().decompress(value['data'])
+    else:
+        raw = gzip.decompress(value['data'])
+    return bson.decode(raw)['result']
+
+
+def compression_stats(collection):
+    "Summarize the compression stats stored with the results in a calculation collection"
+    pipeline = [
+        {'$match': {'result_compression': {'$type': 'object'}}},
+        {'$group': {
+            '_id': '$result_compression.codec',
+            'results': {'$sum': 1},
+            'raw_bytes': {'$sum': '$result_compression.raw_bytes'},
+            'stored_bytes': {'$sum': '$result_compression.stored_bytes'},
+        }}
+    ]
+    stats = list()
+    for group in collection.aggregate(pipeline):
+        stats.append({
+            'codec': group['_id'],
+            'results': group['results'],
+            'raw_bytes': group['raw_bytes'],
+            'stored_bytes': group['stored_bytes'],
+            'ratio': round(group['raw_bytes'] / group['stored_bytes'], 2) if group['stored_bytes'] else None
+        })
+    return stats
@@ -0,0 +1,64 @@
+import asyncio
+import heapq
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+
+import numpy as np
+
+from bitslice import BitSlicedIndex, WORD_BITS
+
+# Number of threads that scan shards of a profile matrix. The bit-sliced kernels are NumPy operations on
+# large uint64 arrays, which release the GIL, so one query can use all cores.
+SCAN_WORKERS = int(getenv('SCAN_WORKERS', os.cpu_count() or 1))
+# Smallest shard worth scheduling on its own thread
+MIN_SHARD_SAMPLES = int(getenv('MIN_SHARD_SAMPLES', 16384))
+
+_executor = None
+
+def get_executor():
+    "Return the thread pool shared by all scans"
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix='nn-scan')
+    return _executor
+
+
+def shard_words(index: BitSlicedIndex, workers: int = SCAN_WORKERS, min_shard_samples: int = MIN_SHARD_SAMPLES):
+    "Split the words of an index in up to 'workers' ranges of roughly equal size"
+    word_count = index.ignored.shape[1]
+    shard_count = max(1, min(workers, index.sample_count // max(min_shard_samples, 1), word_count))
+    bounds = np.linspace(0, word_count, shard_count + 1).astype(int).tolist()
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def scan_shard(index: BitSlicedIndex, query: np.ndarray, words: slice, cutoff: int):
+    "Return (diff_count, row) for the samples in a shard with less than cutoff differences, ordered by diff_count"
+    diff_counts = index.count_differences(query, words)
+    rows = np.flatnonzero(diff_counts < cutoff)
+    hits = diff_counts[rows]
+    order = np.argsort(hits, kind='stable')
+    return list(zip(hits[order].tolist(), (rows[order] + words.start * WORD_BITS).tolist()))
+
+
+async def scan(
+        index: BitSlicedIndex,
+        query: np.ndarray,
+        cutoff: int,
+        workers: int = SCAN_WORKERS,
+        min_shard_samples: int = MIN_SHARD_SAMPLES
+        ):
+    """
+    Find the samples in the index with less than cutoff differences to the query.
+
+    The samples are split in shards that are counted in parallel on the scan thread pool, which also keeps
+    the event loop free while a large scan runs. The ordered hits of the shards are merged into a single
+    list of (diff_count, row) tuples, ordered by diff_count and then row.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    shard_hits = await asyncio.gather(*(
+        loop.run_in_executor(executor, scan_shard, index, query, words, cutoff)
+        for words in shard_words(index, workers, min_shard_samples)
+    ))
+    return list(heapq.merge(*shard_hits))
@@ -20,10 +20,21 @@ class MongoAPI:
         else:
             self.connection = pymongo.MongoClient(connection_string, directConnection=True)
             self.db = self.connection.get_database()
+        # Heavy profile reads use the same database as everything else
+        self.profile_db = self.db
 
-    async def get_field_data(self, collection: str, mongo_ids: Optional[list], field_paths: list):
+    def kill_operations(self, comment: str):
+        """mongomock runs every operation to completion before returning"""
+        return 0
+
+    def latency(self):
+        """mongomock does not publish command events"""
+        return {}
+
+    async def get_field_data(self, collection: str, mongo_ids: Optional[list], field_paths: list, max_time_ms: Optional[int] = None):
         """
         Return (document count, cursor) from a collection, with optional filtering by ObjectIds and field projection.
+        mongomock has no server-side time limits, so max_time_ms is ignored.
         """
         if mongo_ids:
             filter = {'_id': {'$in': strs2ObjectIds(mongo_ids)}}
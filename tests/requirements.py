@@ -111,3 +111,14 @@ MOCK_RECALL_DICT = {
         {"id": str(MOCK_NEIGHBOR_ID_2), "diff_count": 2}
     ]
 }
+
+# === SNP config (sample documents with "reads" and "contigs" fields) === #
+
+MOCK_SNP_CONFIG = dict(
+    MOCK_MONGO_CONFIG,
+    fastq_field_path="reads",
+    contigs_field_path="contigs",
+    depth=15,
+    ignore_hz=True,
+    hpc_resources={"cpus": 1, "memGB": 4}
+)
@@ -0,0 +1,186 @@
+# test_allele_encoding.py
+
+import pytest
+import logging
+import numpy as np
+from unittest.mock import patch
+import calculations
+from calculations import NearestNeighbors, DistanceCalculation
+from allele_encoding import (
+    AlleleCodebook,
+    get_codebook,
+    profile_loci,
+    MISSING_CODE,
+    FIRST_ALLELE_CODE,
+    IGNORED_ALLELE_VALUES
+)
+from hamming import count_differences, distance_matrix, CAP_CHUNK_LOCI
+import bitslice
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_INPUT_ID,
+    MOCK_NEIGHBOR_ID_1,
+    MOCK_NEIGHBOR_ID_2,
+    MOCK_NEIGHBOR_SEQUENCE,
+    MOCK_NEIGHBOR_SEQUENCE_2
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("allele_encoding_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def test_encode_reserves_codes_for_unknowns(mock_db):
+    """Missing calls and ignored allele values get reserved codes below FIRST_ALLELE_CODE"""
+    logger.info("===== test_encode_reserves_codes_for_unknowns =====")
+
+    codebook = AlleleCodebook(mock_db, "schema1")
+    profiles = [
+        {"locus1": "1", "locus2": "LNF", "locus3": "7"},
+        {"locus1": "1", "locus2": "2"},
+    ]
+    codes = codebook.encode(profiles)
+    logger.info(f"Encoded profiles: {codes}")
+
+    assert codes.dtype == np.uint8
+    assert codes[0, 0] == codes[1, 0] >= FIRST_ALLELE_CODE
+    assert codes[0, 1] == 1 + IGNORED_ALLELE_VALUES.index("LNF")
+    assert codes[1, 2] == MISSING_CODE
+    assert codebook.decode(codes[0], profile_loci(profiles)) == profiles[0]
+
+
+def test_codebook_is_persisted(mock_db):
+    """A new codebook instance for the same schema gives the same codes"""
+    logger.info("===== test_codebook_is_persisted =====")
+
+    first = AlleleCodebook(mock_db, "schema1").encode([["3", "5"], ["4", "5"]])
+    second = AlleleCodebook(mock_db, "schema1").encode([["4", "5"], ["3", "6"]])
+    logger.info(f"First: {first}, second: {second}")
+
+    assert (second[0] == first[1]).all()
+    assert second[1, 0] == first[0, 0]
+    assert second[1, 1] not in first[:, 1]
+    assert mock_db["allele_codebooks"].count_documents({"schema": "schema1"}) == 2
+
+
+def test_numbers_and_strings_encode_alike(mock_db):
+    """allele_array values can be ints or strings, and the codes should not depend on that"""
+    codebook = get_codebook(mock_db, "schema1")
+    codes = codebook.encode([[1, 2], ["1", "2"]])
+    assert (codes[0] == codes[1]).all()
+
+
+def test_dtype_grows_with_cardinality(mock_db):
+    """The smallest sufficient dtype is used"""
+    codebook = AlleleCodebook(mock_db, "schema1")
+    codes = codebook.encode([[str(i)] for i in range(300)])
+    assert codes.dtype == np.uint16
+    assert len(np.unique(codes)) == 300
+
+
+def test_count_differences_ignores_ignored_values(mock_db):
+    """Ignored allele values in either profile are not counted as differences, missing calls are"""
+    codebook = AlleleCodebook(mock_db, "schema1")
+    codes = codebook.encode([
+        ["1", "2", "3", "4", None],
+        ["1", "9", "NIPH", "4", None],
+        ["LNF", "9", "8", None, ""],
+    ])
+    diffs = count_differences(codes[0], codes)
+    logger.info(f"Differences: {diffs}")
+    assert diffs.tolist() == [0, 1, 4]
+
+    dmx = distance_matrix(codes)
+    assert (dmx == dmx.T).all()
+    assert dmx[0].tolist() == diffs.tolist()
+    # 4 and None, None and ''
+    assert dmx[1, 2] == 2
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_nearest_neighbors_numpy_engine(mock_get_section, prepared_mongo):
+    """The numpy engine finds the same neighbors as the aggregation pipeline"""
+    logger.info("===== test_nearest_neighbors_numpy_engine =====")
+
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, engine="numpy")
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE)
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE_2)
+
+    calc = NearestNeighbors(input_mongo_id=str(MOCK_INPUT_ID))
+    calc.input_sequence = await calc.query_mongodb_for_input_profile()
+    await calc.calculate()
+    logger.info(f"Result: {calc.result}")
+
+    assert calc.result == [{"_id": MOCK_NEIGHBOR_ID_1, "diff_count": 1}]
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_distance_matrix_numpy_engine(mock_get_section, prepared_mongo, monkeypatch):
+    """The numpy engine builds the distance matrix dict from profiles that are encoded in batches"""
+    logger.info("===== test_distance_matrix_numpy_engine =====")
+
+    monkeypatch.setattr(calculations, "ENCODING_BATCH_SIZE", 2)
+
+    mock_get_section.return_value = dict(
+        MOCK_MONGO_CONFIG,
+        seqid_field_path="_id",
+        engine="numpy"
+    )
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE)
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE_2)
+
+    calc = DistanceCalculation(seq_mongo_ids=None)
+    _count, cursor = await calc.query_mongodb_for_allele_profiles()
+    sequence_ids, distances, mongo_ids = await calc._dmx_array_from_mongodb_cursor(cursor)
+    dist_mx_dict = calc.dmx_dict_from_array(sequence_ids, distances)
+    logger.info(f"Distance matrix: {dist_mx_dict}")
+
+    assert dist_mx_dict[MOCK_INPUT_ID][MOCK_NEIGHBOR_ID_1] == 1
+    assert dist_mx_dict[MOCK_NEIGHBOR_ID_1][MOCK_INPUT_ID] == 1
+    assert len(mongo_ids) == 3
+
+
+def test_capped_distance_matrix():
+    """Capped distances are exact up to max_distance and saturate at max_distance + 1 in a small dtype"""
+    rng = np.random.default_rng(0)
+    profiles = rng.integers(FIRST_ALLELE_CODE - 1, FIRST_ALLELE_CODE + 3, size=(40, CAP_CHUNK_LOCI * 3)).astype(np.uint8)
+    distances = distance_matrix(profiles)
+    max_distance = int(np.median(distances))
+
+    capped = distance_matrix(profiles, max_distance=max_distance)
+    assert capped.dtype == np.uint16
+    assert (capped == np.minimum(distances, max_distance + 1)).all()
+    assert (bitslice.distance_matrix(profiles, max_distance=max_distance) == capped).all()
+    assert distance_matrix(profiles, max_distance=100).dtype == np.uint8
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_capped_distance_calculation(mock_get_section, prepared_mongo):
+    """The distance matrix array of a calculation with max_distance is stored saturated"""
+    logger.info("===== test_capped_distance_calculation =====")
+
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="_id", engine="numpy")
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE)
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE_2)
+
+    calc = DistanceCalculation(seq_mongo_ids=None, max_distance=1)
+    _count, cursor = await calc.query_mongodb_for_allele_profiles()
+    sequence_ids, distances, _mongo_ids = await calc._dmx_array_from_mongodb_cursor(cursor)
+    saturated = calc.saturate(distances)
+    logger.info(f"Distance matrix: {saturated}")
+
+    assert saturated.dtype == np.uint8
+    rows = {sequence_id: row for row, sequence_id in enumerate(sequence_ids)}
+    assert saturated[rows[MOCK_INPUT_ID], rows[MOCK_NEIGHBOR_ID_1]] == 1
+    # The input sequence and the second neighbor have 2 differences
+    assert saturated[rows[MOCK_INPUT_ID], rows[MOCK_NEIGHBOR_ID_2]] == 2
@@ -0,0 +1,54 @@
+# test_api_responses.py
+
+import pytest
+import logging
+import datetime
+from unittest.mock import patch
+import pydantic_classes as pc
+from calculations import NearestNeighbors
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_INPUT_ID,
+    MOCK_NEIGHBOR_ID_1,
+    MOCK_NEIGHBOR_ID_2
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("api_responses_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_nn_result_fast_path_matches_response_model(mock_get_section, prepared_mongo, test_client):
+    """The unvalidated orjson response has the same content as the validated response model"""
+    logger.info("===== test_nn_result_fast_path_matches_response_model =====")
+
+    mock_get_section.return_value = MOCK_MONGO_CONFIG
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    result = [{"_id": MOCK_NEIGHBOR_ID_1, "diff_count": 1}, {"_id": MOCK_NEIGHBOR_ID_2, "diff_count": 2}]
+    job_id = prepared_mongo[NearestNeighbors.collection].insert_one({
+        "status": "completed",
+        "created_at": now,
+        "finished_at": now,
+        "result": result,
+        "input_mongo_id": str(MOCK_INPUT_ID),
+        "cutoff": 2,
+        "filtering": {},
+        "unknowns_are_diffs": True
+    }).inserted_id
+
+    response = await test_client.get(f"/v1/nearest_neighbors/{job_id}")
+    logger.info(f"Response: {response.text}")
+    assert response.status_code == 200
+
+    expected = pc.NearestNeighborsGETResponse(**NearestNeighbors.recall(str(job_id)).to_dict())
+    assert response.json() == expected.model_dump(mode="json")
+    assert response.json()["result"][0] == {"id": str(MOCK_NEIGHBOR_ID_1), "diff_count": 1}
@@ -0,0 +1,87 @@
+# test_artifacts.py
+
+import os
+import pytest
+import logging
+from pathlib import Path
+from unittest.mock import patch
+import artifacts
+import calculations
+from calculations import DistanceCalculation
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_INPUT_ID,
+    MOCK_NEIGHBOR_SEQUENCE,
+    MOCK_NEIGHBOR_SEQUENCE_2
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("artifacts_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def make_job_folder(directory, job_id, size, last_access):
+    folder = Path(directory, job_id)
+    folder.mkdir()
+    Path(folder, "distance_matrix.npy").write_bytes(b"x" * size)
+    artifacts.touch(folder)
+    os.utime(Path(folder, artifacts.ACCESS_MARKER), (last_access, last_access))
+    return folder
+
+
+def test_evict_least_recently_used(tmp_path):
+    make_job_folder(tmp_path, "old", 100, 1000)
+    make_job_folder(tmp_path, "running", 100, 2000)
+    make_job_folder(tmp_path, "recent", 100, 3000)
+    assert [f.job_id for f in artifacts.usage(tmp_path)] == ["old", "running", "recent"]
+
+    assert artifacts.evict_lru(tmp_path, 300) == []
+    assert artifacts.evict_lru(tmp_path, 150, protect={"running"}) == ["old", "recent"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["running"]
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_distance_matrix_eviction(mock_get_section, prepared_mongo, test_client, tmp_path, monkeypatch):
+    """Evicted distance matrices are marked in their documents and can be recomputed"""
+    logger.info("===== test_distance_matrix_eviction =====")
+
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine="numpy")
+    prepared_mongo["samples"].update_one({"_id": MOCK_INPUT_ID}, {"$set": {"sequence_id": "input"}})
+    prepared_mongo["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE, sequence_id="neighbor1"))
+    prepared_mongo["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE_2, sequence_id="neighbor2"))
+
+    async def run_job():
+        calc = DistanceCalculation(seq_mongo_ids=None)
+        _count, cursor = await calc.query_mongodb_for_allele_profiles()
+        await calc.insert_document()
+        await calc.calculate(cursor)
+        return calc
+
+    first = await run_job()
+    assert not Path(first.allele_mx_filepath).exists()
+    folder_size = artifacts.folder_usage(first.folder).size
+    monkeypatch.setattr(artifacts, "DMX_DIR_QUOTA_MB", 1.5 * folder_size / 1024 / 1024)
+
+    second = await run_job()
+    assert not first.folder.exists()
+    assert second.folder.exists()
+    assert DistanceCalculation.recall(str(first._id)).status == "evicted"
+
+    response = await test_client.get(f"/v1/distance_calculations/{first._id}")
+    logger.info(f"Evicted response: {response.json()}")
+    assert response.json()["status"] == "evicted"
+
+    # Recomputing the first job evicts the second one
+    await test_client.get(f"/v1/distance_calculations/{first._id}", params={"recompute": True})
+    assert DistanceCalculation.recall(str(first._id)).status == "completed"
+    assert Path(first.dist_array_filepath).exists()
+    assert DistanceCalculation.recall(str(second._id)).status == "evicted"
@@ -0,0 +1,173 @@
+# test_bitslice.py
+
+import pytest
+import logging
+import numpy as np
+from unittest.mock import patch
+from calculations import NearestNeighbors, hoist
+from allele_encoding import FIRST_ALLELE_CODE
+from bitslice import BitSlicedIndex, pack_bits, unpack_bits, distance_matrix as bitslice_distance_matrix
+from hamming import count_differences, distance_matrix
+from profile_store import profile_store
+import sharded_scan
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_INPUT_ID,
+    MOCK_NEIGHBOR_ID_1,
+    MOCK_NEIGHBOR_SEQUENCE,
+    MOCK_NEIGHBOR_SEQUENCE_2
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("bitslice_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def random_codes(sample_count, locus_count, max_code, seed=1):
+    return np.random.default_rng(seed).integers(0, max_code, size=(sample_count, locus_count)).astype(np.uint16)
+
+
+def test_pack_bits_roundtrip():
+    """Packing and unpacking bits is lossless, also when the count is not a multiple of 64"""
+    bits = np.random.default_rng(2).random((3, 130)) < 0.5
+    assert (unpack_bits(pack_bits(bits), 130) == bits).all()
+
+
+def test_bitslice_matches_hamming():
+    """The bit-sliced index counts the same differences as hamming.count_differences"""
+    logger.info("===== test_bitslice_matches_hamming =====")
+
+    codes = random_codes(200, 37, FIRST_ALLELE_CODE + 20)
+    index = BitSlicedIndex(codes)
+    for query in codes[:5]:
+        assert (index.count_differences(query) == count_differences(query, codes)).all()
+
+    # A query with a code the index has no bits for differs at that locus from every known call
+    query = codes[0].copy()
+    query[0] = 1 << index.bit_count
+    assert (index.count_differences(query) == count_differences(query, codes)).all()
+
+    # Short queries are padded with missing calls
+    padded = np.concatenate([codes[0][:10], np.zeros(27, dtype=codes.dtype)])
+    assert (index.count_differences(codes[0][:10]) == count_differences(padded, codes)).all()
+
+    assert (bitslice_distance_matrix(codes[:50]) == distance_matrix(codes[:50])).all()
+
+
+@pytest.mark.asyncio
+async def test_sharded_scan_matches_full_scan():
+    """Hits from parallel shards are merged in diff_count order and match a single full count"""
+    codes = random_codes(1000, 40, FIRST_ALLELE_CODE + 3)
+    index = BitSlicedIndex(codes)
+    shards = sharded_scan.shard_words(index, workers=4, min_shard_samples=1)
+    assert len(shards) == 4
+    assert sum(index.shard_sample_count(words) for words in shards) == 1000
+
+    diff_counts = count_differences(codes[0], codes)
+    cutoff = int(np.median(diff_counts))
+    hits = await sharded_scan.scan(index, codes[0], cutoff, workers=4, min_shard_samples=1)
+    logger.info(f"Sharded hits: {hits[:10]}")
+    expected = sorted((int(d), row) for row, d in enumerate(diff_counts) if d < cutoff)
+    assert hits == expected
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_nearest_neighbors_bitslice_engine(mock_get_section, prepared_mongo):
+    """The bitslice engine finds the same neighbors as the aggregation pipeline and reuses its index"""
+    logger.info("===== test_nearest_neighbors_bitslice_engine =====")
+
+    profile_store.matrices.clear()
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, engine="bitslice")
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE)
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE_2)
+
+    calc = NearestNeighbors(input_mongo_id=str(MOCK_INPUT_ID))
+    calc.input_sequence = await calc.query_mongodb_for_input_profile()
+    await calc.calculate()
+    logger.info(f"Result: {calc.result}")
+
+    assert calc.result == [{"_id": MOCK_NEIGHBOR_ID_1, "diff_count": 1}]
+    cached = list(profile_store.matrices.values())
+    assert len(cached) == 1
+
+    await calc.calculate()
+    assert list(profile_store.matrices.values())[0] is cached[0]
+
+
+def evaluate(expression, pair):
+    "Evaluate the $filter condition of NearestNeighbors.pipeline_prod() for a pair of calls, as MongoDB would"
+    if expression == "$$pair":
+        return pair
+    if isinstance(expression, list):
+        return [evaluate(e, pair) for e in expression]
+    if not isinstance(expression, dict):
+        return expression
+    (operator, args), = expression.items()
+    args = evaluate(args, pair)
+    if operator == "$and":
+        return all(args)
+    if operator == "$ne":
+        return args[0] != args[1]
+    if operator == "$not":
+        return not args
+    if operator == "$in":
+        return args[0] in args[1]
+    if operator == "$arrayElemAt":
+        return args[0][args[1]]
+    raise NotImplementedError(operator)
+
+
+def pipeline_diff_count(calc, doc):
+    "The diff_count that pipeline_prod() computes for a document (mongomock does not implement $zip)"
+    add_fields = next(stage["$addFields"] for stage in calc.pipeline_prod() if "$addFields" in stage)
+    filter = add_fields["diff_count"]["$size"]["$filter"]
+    field, query = filter["input"]["$zip"]["inputs"]
+    return sum(evaluate(filter["cond"], [a, b]) for a, b in zip(hoist(doc, field[1:]), query))
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_engines_match_pipeline_with_missing_calls(mock_get_section, prepared_mongo):
+    """The numpy and bitslice engines find the same neighbors as the aggregation pipeline, also with None and '' calls"""
+    logger.info("===== test_engines_match_pipeline_with_missing_calls =====")
+
+    rng = np.random.default_rng(3)
+    calls = ["1", "2", "3", None, "", "LNF"]
+    founder = rng.choice(len(calls), 12)
+    docs = list()
+    for _ in range(60):
+        profile = founder.copy()
+        mutated = rng.choice(12, rng.integers(0, 8), replace=False)
+        profile[mutated] = rng.choice(len(calls), len(mutated))
+        docs.append({"categories": {"cgmlst": {
+            "summary": {"call_percent": 100},
+            "report": {"allele_array": [calls[c] for c in profile], "schema": {"digest": "parity"}}
+        }}})
+    prepared_mongo["samples"].insert_many(docs)
+    input_sequence = prepared_mongo["samples"].find_one({"_id": docs[0]["_id"]})
+
+    results = dict()
+    for engine in ("mongo", "numpy", "bitslice"):
+        mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, engine=engine, cutoff=6)
+        calc = NearestNeighbors(input_mongo_id=str(input_sequence["_id"]))
+        calc.input_sequence = input_sequence
+        if engine == "mongo":
+            results[engine] = sorted(
+                (pipeline_diff_count(calc, doc), doc["_id"]) for doc in docs[1:]
+                if pipeline_diff_count(calc, doc) < calc.cutoff
+            )
+        else:
+            results[engine] = sorted((neighbor["diff_count"], neighbor["_id"]) for neighbor in await calc.find_neighbors())
+    logger.info(f"Pipeline neighbors: {results['mongo']}")
+
+    assert len(results["mongo"]) > 5
+    assert results["numpy"] == results["mongo"]
+    assert results["bitslice"] == results["mongo"]
@@ -0,0 +1,178 @@
+# test_cancellation.py
+
+import asyncio
+import threading
+import time
+import pytest
+import logging
+from pathlib import Path
+from unittest.mock import patch
+import calculations
+from calculations import DistanceCalculation, TreePipelineCalculation
+from job_registry import job_registry
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_INPUT_ID,
+    MOCK_NEIGHBOR_SEQUENCE,
+    MOCK_NEIGHBOR_SEQUENCE_2
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("cancellation_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def insert_profiles(db):
+    db["samples"].update_one({"_id": MOCK_INPUT_ID}, {"$set": {"sequence_id": "input"}})
+    db["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE, sequence_id="neighbor1"))
+    db["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE_2, sequence_id="neighbor2"))
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_cancel_kills_cgmlst_dists(mock_get_section, prepared_mongo, test_client, tmp_path, monkeypatch):
+    """DELETE kills a running cgmlst-dists process and marks the job as cancelled"""
+    logger.info("===== test_cancel_kills_cgmlst_dists =====")
+
+    # A cgmlst-dists that never finishes
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    Path(bin_dir, "cgmlst-dists").write_text("#!/bin/sh\nexec sleep 60\n")
+    Path(bin_dir, "cgmlst-dists").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{calculations.getenv('PATH')}")
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine="cgmlst-dists")
+    insert_profiles(prepared_mongo)
+
+    calc = DistanceCalculation(seq_mongo_ids=None)
+    _count, cursor = await calc.query_mongodb_for_allele_profiles()
+    await calc.insert_document()
+    running = asyncio.create_task(calc.run(cursor))
+    for _ in range(100):
+        job = job_registry.get(str(calc._id))
+        if job is not None and job.processes:
+            break
+        await asyncio.sleep(0.05)
+    process = next(iter(job.processes))
+
+    response = await test_client.delete(f"/v1/distance_calculations/{calc._id}")
+    logger.info(f"Response: {response.json()}")
+    assert response.status_code == 200
+    assert response.json()["status"] == "cancelled"
+    await asyncio.wait_for(running, 5)
+
+    assert process.returncode is not None
+    assert not Path(calc.allele_mx_filepath).exists()
+    assert job_registry.get(str(calc._id)) is None
+    response = await test_client.get(f"/v1/distance_calculations/{calc._id}")
+    assert response.json()["status"] == "cancelled"
+
+    response = await test_client.delete(f"/v1/distance_calculations/{calc._id}")
+    assert response.status_code == 409
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_cancel_running_numpy_calculation(mock_get_section, prepared_mongo, test_client, tmp_path, monkeypatch):
+    """DELETE is served while a numpy calculation is running in its thread, and the calculation stops at its next chunk"""
+    logger.info("===== test_cancel_running_numpy_calculation =====")
+
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine="numpy")
+    insert_profiles(prepared_mongo)
+
+    # A distance matrix calculation that keeps reporting progress until it is stopped
+    started = threading.Event()
+    stopped = threading.Event()
+    def endless_distance_matrix(profiles, on_progress=None, max_distance=None):
+        started.set()
+        try:
+            while True:
+                on_progress(0, len(profiles))
+                time.sleep(0.01)
+        finally:
+            stopped.set()
+    monkeypatch.setattr(calculations, "distance_matrix", endless_distance_matrix)
+
+    calc = DistanceCalculation(seq_mongo_ids=None)
+    _count, cursor = await calc.query_mongodb_for_allele_profiles()
+    await calc.insert_document()
+    running = asyncio.create_task(calc.run(cursor))
+    assert await asyncio.to_thread(started.wait, 5)
+
+    response = await test_client.delete(f"/v1/distance_calculations/{calc._id}")
+    logger.info(f"Response: {response.json()}")
+    assert response.status_code == 200
+    assert response.json()["status"] == "cancelled"
+    await asyncio.wait_for(running, 5)
+
+    assert stopped.is_set()
+    assert job_registry.get(str(calc._id)) is None
+    assert not Path(calc.dist_array_filepath).exists()
+    response = await test_client.get(f"/v1/distance_calculations/{calc._id}")
+    assert response.json()["status"] == "cancelled"
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_cancelled_by_another_worker(mock_get_section, prepared_mongo, tmp_path, monkeypatch):
+    """A job that was cancelled in another process stops at its next chunk boundary and stays cancelled"""
+    logger.info("===== test_cancelled_by_another_worker =====")
+
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine="numpy")
+    insert_profiles(prepared_mongo)
+
+    calc = DistanceCalculation(seq_mongo_ids=None)
+    _count, cursor = await calc.query_mongodb_for_allele_profiles()
+    await calc.insert_document()
+    prepared_mongo[calc.collection].update_one({"_id": calc._id}, {"$set": {"status": "cancelled"}})
+
+    await calc.run(cursor)
+    doc = prepared_mongo[calc.collection].find_one({"_id": calc._id})
+    assert doc["status"] == "cancelled"
+    assert doc["result"] is None
+    assert not Path(calc.dist_array_filepath).exists()
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_cancel_tree_pipeline(mock_get_section, prepared_mongo, test_client, tmp_path, monkeypatch):
+    """Cancelling a tree pipeline cancels its distance calculation, and a pipeline whose distance calculation is cancelled fails"""
+    logger.info("===== test_cancel_tree_pipeline =====")
+
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine="numpy")
+    insert_profiles(prepared_mongo)
+
+    async def pipeline():
+        calc = TreePipelineCalculation(seq_mongo_ids=None)
+        dc = calc.distance_calculation()
+        _count, cursor = await dc.query_mongodb_for_allele_profiles()
+        await dc.insert_document()
+        calc.dmx_job = str(dc._id)
+        await calc.insert_document()
+        return calc, dc, cursor
+
+    calc, dc, cursor = await pipeline()
+    response = await test_client.delete(f"/v1/tree_pipelines/{calc._id}")
+    assert response.status_code == 200
+    await calc.run(dc, cursor)
+    assert DistanceCalculation.recall(str(dc._id)).status == "cancelled"
+    assert TreePipelineCalculation.recall(str(calc._id)).status == "cancelled"
+
+    calc, dc, cursor = await pipeline()
+    response = await test_client.delete(f"/v1/distance_calculations/{dc._id}")
+    assert response.status_code == 200
+    await calc.run(dc, cursor)
+    recalled = TreePipelineCalculation.recall(str(calc._id))
+    logger.info(f"Pipeline: {recalled.to_dict()}")
+    assert recalled.status == "error"
+    assert str(dc._id) in recalled.result
@@ -0,0 +1,145 @@
+# test_clustering.py
+
+import threading
+import time
+import pytest
+import logging
+from unittest.mock import patch
+from pymongo.errors import DuplicateKeyError
+from calculations import ClusterCalculation
+from clustering import ClusterIndex, UnionFind, MEMBER_COLLECTION, MERGE_COLLECTION
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_INPUT_ID,
+    MOCK_NEIGHBOR_ID_1,
+    MOCK_NEIGHBOR_ID_2,
+    MOCK_NEIGHBOR_SEQUENCE,
+    MOCK_NEIGHBOR_SEQUENCE_2
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("clustering_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def test_union_find():
+    uf = UnionFind()
+    for item in "abcde":
+        uf.add(item)
+    uf.union("a", "b")
+    uf.union("c", "d")
+    uf.union("b", "d")
+    assert uf.find("a") == uf.find("c")
+    assert uf.find("e") != uf.find("a")
+    assert sorted(len(c) for c in uf.components().values()) == [1, 4]
+
+
+def test_cluster_ids_are_stable_and_merges_are_logged(mock_db):
+    """A sample that links two clusters merges the newer cluster into the older one"""
+    logger.info("===== test_cluster_ids_are_stable_and_merges_are_logged =====")
+
+    index = ClusterIndex(mock_db, "schema1", 5)
+    assert index.add("a", {}) == (1, [])
+    assert index.add("b", {"a": 20}) == (2, [])
+    assert index.add("c", {"b": 3, "not_clustered": 1}) == (2, [])
+    assert index.add("d", {"a": 5, "c": 4}) == (1, [2])
+    assert index.add("d", {}) == (1, [])
+
+    merge = mock_db[MERGE_COLLECTION].find_one()
+    logger.info(f"Merge: {merge}")
+    assert merge["cluster"] == 1 and merge["merged"] == [2] and merge["sample"] == "d"
+
+    # A fresh index loads the same clusters from the database
+    reloaded = ClusterIndex(mock_db, "schema1", 5)
+    assert {s: reloaded.cluster_of(s) for s in "abcd"} == {"a": 1, "b": 1, "c": 1, "d": 1}
+    assert sorted(reloaded.members(1)) == ["a", "b", "c", "d"]
+    assert reloaded.add("e", {"b": 2}) == (1, [])
+
+    # The first index notices that it is out of date
+    assert index.cluster_of("e") == 1
+
+
+def test_clusters_do_not_depend_on_order(mock_db):
+    distances = {("a", "b"): 2, ("b", "c"): 2, ("a", "c"): 4, ("c", "d"): 9}
+    def neighbors(sample):
+        return {b if a == sample else a: d for (a, b), d in distances.items() if sample in (a, b)}
+
+    partitions = list()
+    for schema, order in (("s1", "abcd"), ("s2", "dcab"), ("s3", "cdba")):
+        index = ClusterIndex(mock_db, schema, 3)
+        for sample in order:
+            index.add(sample, neighbors(sample))
+        groups = dict()
+        for sample in "abcd":
+            groups.setdefault(index.cluster_of(sample), set()).add(sample)
+        partitions.append(sorted(map(sorted, groups.values())))
+    assert partitions[0] == partitions[1] == partitions[2] == [["a", "b", "c"], ["d"]]
+
+
+def test_adds_are_serialized(mock_db):
+    """A sample that is added while another process adds its neighbor waits for it and joins its cluster"""
+    logger.info("===== test_adds_are_serialized =====")
+
+    other_process = ClusterIndex(mock_db, "schema1", 5)
+    index = ClusterIndex(mock_db, "schema1", 5)
+    assert index.cluster_of("a") is None
+
+    # The other process is adding "a" and holds the claim
+    counter = other_process.claim()
+    results = list()
+    adding = threading.Thread(target=lambda: results.append(index.add("b", {"a": 1})))
+    adding.start()
+    time.sleep(0.2)
+    assert adding.is_alive()
+    mock_db[MEMBER_COLLECTION].insert_one(dict(other_process.key, sample="a", cluster=counter["next_cluster"] + 1))
+    other_process.release(counter, {"next_cluster": 1})
+    adding.join(5)
+
+    assert results == [(1, [])]
+    assert other_process.cluster_of("b") == 1
+    assert other_process.add("c", {}) == (2, [])
+    with pytest.raises(DuplicateKeyError):
+        mock_db[MEMBER_COLLECTION].insert_one(dict(index.key, sample="a", cluster=3))
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_cluster_calculation(mock_get_section, prepared_mongo):
+    """Sequences are added to clusters at each threshold using nearest neighbors distances"""
+    logger.info("===== test_cluster_calculation =====")
+
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, engine="numpy")
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE)
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE_2)
+
+    results = dict()
+    for sample_id in (MOCK_INPUT_ID, MOCK_NEIGHBOR_ID_2, MOCK_NEIGHBOR_ID_1):
+        calc = ClusterCalculation(input_mongo_id=str(sample_id), thresholds=[1, 0])
+        await calc.insert_document()
+        await calc.calculate()
+        results[sample_id] = (await calc.get_result())
+        logger.info(f"Result for {sample_id}: {results[sample_id]}")
+
+    assert results[MOCK_INPUT_ID] == [
+        {"threshold": 0, "cluster": 1, "merged": []},
+        {"threshold": 1, "cluster": 1, "merged": []},
+    ]
+    assert results[MOCK_NEIGHBOR_ID_2][1] == {"threshold": 1, "cluster": 2, "merged": []}
+    # The first neighbor is 1 allele from both and links their clusters at threshold 1
+    assert results[MOCK_NEIGHBOR_ID_1] == [
+        {"threshold": 0, "cluster": 3, "merged": []},
+        {"threshold": 1, "cluster": 1, "merged": [2]},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_cluster_request_needs_thresholds(test_client):
+    response = await test_client.post("/v1/clusters", json={"input_mongo_id": str(MOCK_INPUT_ID), "thresholds": []})
+    assert response.status_code == 422
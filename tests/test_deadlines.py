@@ -0,0 +1,140 @@
+# test_deadlines.py
+
+import asyncio
+import pytest
+import logging
+from pathlib import Path
+from unittest.mock import patch
+import calculations
+import sharded_scan
+from calculations import DistanceCalculation, NearestNeighbors
+from profile_store import profile_store
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_INPUT_ID,
+    MOCK_NEIGHBOR_SEQUENCE,
+    MOCK_NEIGHBOR_SEQUENCE_2
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("deadlines_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def insert_profiles(db):
+    db["samples"].update_one({"_id": MOCK_INPUT_ID}, {"$set": {"sequence_id": "input"}})
+    db["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE, sequence_id="neighbor1"))
+    db["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE_2, sequence_id="neighbor2"))
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_deadline(mock_get_section, prepared_mongo, test_client, tmp_path, monkeypatch):
+    """The deadline defaults to the configured timeout, can be set per request and limits MongoDB operations"""
+    logger.info("===== test_deadline =====")
+
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, timeout_seconds=600)
+    calc = NearestNeighbors(input_mongo_id=str(MOCK_INPUT_ID))
+    assert (calc.deadline - calc.created_at).total_seconds() == 600
+    options = calc.operation_options()
+    assert 0 < options["maxTimeMS"] <= 600 * 1000
+    assert options["comment"] == calc.cancellation_comment
+    assert NearestNeighbors(input_mongo_id=str(MOCK_INPUT_ID), timeout_seconds=10).remaining_seconds() <= 10
+
+    mock_get_section.return_value = MOCK_MONGO_CONFIG
+    assert NearestNeighbors(input_mongo_id=str(MOCK_INPUT_ID)).deadline is None
+    assert NearestNeighbors(input_mongo_id=str(MOCK_INPUT_ID)).operation_options() == {"comment": "bio_api:nearest_neighbors:None"}
+
+    calc = DistanceCalculation(seq_mongo_ids=None, timeout_seconds=60)
+    await calc.insert_document()
+    response = await test_client.get(f"/v1/distance_calculations/{calc._id}")
+    logger.info(f"Response: {response.json()}")
+    assert response.json()["timeout_seconds"] == 60
+    # MongoDB returns the deadline without time zone
+    recalled = DistanceCalculation.recall(str(calc._id))
+    assert 0 < recalled.remaining_seconds() <= 60
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_timeout_records_progress(mock_get_section, prepared_mongo, test_client, tmp_path, monkeypatch):
+    """An in-process engine that overruns its deadline stops with the status 'timeout' and records how far it got"""
+    logger.info("===== test_timeout_records_progress =====")
+
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine="numpy")
+    insert_profiles(prepared_mongo)
+
+    calc = DistanceCalculation(seq_mongo_ids=None, timeout_seconds=0.01)
+    _count, cursor = await calc.query_mongodb_for_allele_profiles()
+    await calc.insert_document()
+    await asyncio.sleep(0.02)
+    await calc.run(cursor)
+
+    response = await test_client.get(f"/v1/distance_calculations/{calc._id}")
+    logger.info(f"Response: {response.json()}")
+    assert response.json()["status"] == "timeout"
+    assert response.json()["progress"]["stage"] == "encoding profiles"
+    assert "encoding profiles" in prepared_mongo[calc.collection].find_one({"_id": calc._id})["error_msg"]
+    assert not Path(calc.dist_array_filepath).exists()
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_timeout_kills_cgmlst_dists(mock_get_section, prepared_mongo, tmp_path, monkeypatch):
+    """cgmlst-dists is killed when the distance calculation passes its deadline"""
+    logger.info("===== test_timeout_kills_cgmlst_dists =====")
+
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    Path(bin_dir, "cgmlst-dists").write_text("#!/bin/sh\nexec sleep 60\n")
+    Path(bin_dir, "cgmlst-dists").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{calculations.getenv('PATH')}")
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine="cgmlst-dists")
+    insert_profiles(prepared_mongo)
+
+    calc = DistanceCalculation(seq_mongo_ids=None, timeout_seconds=1)
+    _count, cursor = await calc.query_mongodb_for_allele_profiles()
+    await calc.insert_document()
+    await asyncio.wait_for(calc.run(cursor), 10)
+
+    doc = prepared_mongo[calc.collection].find_one({"_id": calc._id})
+    logger.info(f"Document: {doc}")
+    assert doc["status"] == "timeout"
+    assert doc["progress"]["stage"] == "running cgmlst-dists"
+    assert not Path(calc.allele_mx_filepath).exists()
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_timeout_stops_bitslice_scan(mock_get_section, prepared_mongo, test_client, monkeypatch):
+    """A bitslice nearest neighbors job that is still scanning at its deadline stops with the status 'timeout'"""
+    logger.info("===== test_timeout_stops_bitslice_scan =====")
+
+    profile_store.matrices.clear()
+    monkeypatch.setattr(calculations, "PROGRESS_INTERVAL", 0)
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, engine="bitslice")
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE)
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE_2)
+    async def slow_scan(*args, **kwargs):
+        await asyncio.sleep(30)
+    monkeypatch.setattr(sharded_scan, "scan", slow_scan)
+
+    calc = NearestNeighbors(input_mongo_id=str(MOCK_INPUT_ID), timeout_seconds=0.5)
+    calc.input_sequence = await calc.query_mongodb_for_input_profile()
+    calc._id = await calc.insert_document()
+    await asyncio.wait_for(calc.run(), timeout=10)
+
+    response = await test_client.get(f"/v1/nearest_neighbors/{calc._id}")
+    logger.info(f"Response: {response.json()}")
+    assert response.json()["status"] == "timeout"
+    assert response.json()["progress"]["stage"] == "scanning profiles"
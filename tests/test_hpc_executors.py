@@ -0,0 +1,118 @@
+# test_hpc_executors.py
+
+import sys
+import pytest
+import logging
+from unittest.mock import patch
+import calculations
+from hpc_executors import choose_backend, run_job
+from resource_estimator import USAGE_COLLECTION
+from .requirements import MOCK_SNP_CONFIG
+from .test_snp_batch import insert_sample
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("hpc_executors_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def test_choose_backend():
+    settings = {"local_job_types": ["debug"], "local_max_samples": 2}
+    assert choose_backend(settings, "debug") == "local"
+    assert choose_backend(settings, "snp", 2) == "local"
+    assert choose_backend(settings, "snp", 3) == "amqp"
+    assert choose_backend({}, "snp", 1) == "amqp"
+    assert choose_backend({"backend": "local"}, "snp", 100) == "local"
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_local_snp_jobs(mock_get_section, prepared_mongo, test_client, mock_messenger, monkeypatch):
+    """Small SNP jobs run in the local process pool and complete like dispatched jobs"""
+    logger.info("===== test_local_snp_jobs =====")
+
+    mock_get_section.return_value = dict(MOCK_SNP_CONFIG, executor={
+        "local_max_samples": 3,
+        # Echo the args as the result
+        "local_commands": {"snp": "cat", "snp_batch": "cat"}
+    })
+    monkeypatch.setattr(calculations, "get_messenger", lambda: mock_messenger)
+    send_hpc_call = mock_messenger.send_hpc_call
+    samples = [insert_sample(prepared_mongo, f"sample{i}") for i in range(5)]
+
+    response = await test_client.post("/v1/snp_calculations/batch", json={"calculations": [
+        {"seq_mongo_ids": samples[1:3], "reference_mongo_id": samples[0]},
+        {"seq_mongo_ids": samples[2:4], "reference_mongo_id": samples[0]},
+        {"seq_mongo_ids": samples[1:5], "reference_mongo_id": samples[1]},
+    ]})
+    jobs = response.json()
+    await calculations.local_backend.drain()
+
+    # The batch of two jobs (4 samples) and the job with 4 samples are too big to run locally
+    assert send_hpc_call.call_count == 2
+    assert [call.kwargs["job_type"] for call in send_hpc_call.call_args_list] == ["snp_batch", "snp"]
+
+    mock_get_section.return_value = dict(mock_get_section.return_value, executor=dict(
+        mock_get_section.return_value["executor"], local_max_samples=4))
+    response = await test_client.post("/v1/snp_calculations/batch", json={"calculations": [
+        {"seq_mongo_ids": samples[1:3], "reference_mongo_id": samples[0]},
+        {"seq_mongo_ids": samples[2:4], "reference_mongo_id": samples[0]},
+    ]})
+    jobs = response.json()
+    await calculations.local_backend.drain()
+    assert send_hpc_call.call_count == 2
+
+    for job in jobs:
+        response = await test_client.get(f"/v1/snp_calculations/{job['job_id']}")
+        logger.info(f"Local job: {response.json()}")
+        assert response.json()["status"] == "completed"
+        assert response.json()["hpc_status"] == "success"
+        assert response.json()["result"]["reference"] == "sample0.fasta"
+        assert len(response.json()["result"]["jobs"]) == 2
+    usage = prepared_mongo[USAGE_COLLECTION].find_one()
+    assert usage["job_type"] == "snp_batch"
+    assert usage["runtime_seconds"] > 0
+    assert usage["memory_gb"] > 0
+    assert usage["backend"] == "local"
+
+
+def test_run_job_measures_each_job():
+    """The memory and CPU usage of a job are those of its command, not of the worker process or earlier jobs"""
+    allocate = f"{sys.executable} -c 'x = bytearray(400 * 1024 * 1024); x[::4096] = b\"1\" * len(x[::4096])'"
+    result, big = run_job("snp", {"samples": 1}, f"{allocate} && cat")
+    logger.info(f"Usage of the big job: {big}")
+    assert result == {"samples": 1}
+    assert big["memory_gb"] > 0.39
+    assert big["cpus"] > 0
+    assert big["backend"] == "local"
+
+    # Not the largest usage so far. Its memory includes that of this process, which started it.
+    _result, small = run_job("snp", {}, "cat")
+    logger.info(f"Usage of the small job: {small}")
+    assert small["memory_gb"] < big["memory_gb"] - 0.1
+
+    _result, usage = run_job("debug", {"sleep": 0}, None)
+    assert "memory_gb" not in usage
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_local_job_failure(mock_get_section, prepared_mongo, test_client):
+    """A local job whose command fails ends in the error status"""
+    logger.info("===== test_local_job_failure =====")
+
+    mock_get_section.return_value = dict(MOCK_SNP_CONFIG, executor={"backend": "local", "local_commands": {"snp": "exit 3"}})
+    sample = insert_sample(prepared_mongo, "sample")
+
+    response = await test_client.post("/v1/snp_calculations", json={"seq_mongo_ids": [sample], "reference_mongo_id": sample})
+    await calculations.local_backend.drain()
+    response = await test_client.get(f"/v1/snp_calculations/{response.json()['job_id']}")
+    logger.info(f"Failed job: {response.json()}")
+    assert response.json()["status"] == "error"
+    assert "exit code 3" in response.json()["error_msg"]
@@ -0,0 +1,134 @@
+# test_hpc_results.py
+
+import asyncio
+import datetime
+import pytest
+import logging
+from bson.objectid import ObjectId
+from unittest.mock import patch
+from pymongo.errors import AutoReconnect
+from hpc_results import HPCResultConsumer
+from .requirements import MOCK_MONGO_CONFIG
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("hpc_results_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def insert_hpc_job(db, collection):
+    return db[collection].insert_one({
+        "status": "init",
+        "created_at": datetime.datetime.now(tz=datetime.timezone.utc),
+        "finished_at": None,
+        "result": None,
+        "seq_mongo_ids": [],
+        "reference_mongo_id": str(ObjectId()),
+        "depth": 15,
+        "ignore_hz": True,
+        "input_filenames": [],
+        "reference_filename": None,
+        "hpc_resources": {},
+    }).inserted_id
+
+
+async def stand_in_queue(messages):
+    "Local stand-in for the dispatcher's result queue"
+    for message in messages:
+        yield message
+
+
+@pytest.mark.asyncio
+async def test_consumer_batches_updates(mock_db, mock_messenger):
+    """Status messages are written in bulk and only to calculations that are still running"""
+    logger.info("===== test_consumer_batches_updates =====")
+
+    snp_id = insert_hpc_job(mock_db, "snp")
+    debug_id = insert_hpc_job(mock_db, "debug")
+    acked = list()
+    messages = [
+        {"job_uuid": str(snp_id), "job_type": "snp", "status": "running"},
+        ({"job_uuid": str(snp_id), "job_type": "snp", "status": "success", "result": {"vcf": "/data/snp.vcf"}}, lambda: acked.append(1)),
+        {"job_uuid": str(snp_id), "job_type": "snp", "status": "running"},  # Out of order
+        {"job_uuid": str(debug_id), "status": "failed", "error_msg": "Out of memory"},
+        {"job_uuid": "not an id", "status": "success"},
+    ]
+    consumer = HPCResultConsumer(mock_db, batch_size=100)
+    with patch.object(consumer, "flush", wraps=consumer.flush) as flush:
+        await consumer.run(stand_in_queue(messages))
+        # The mocked messenger's job_uuid is not a calculation id, so there is nothing to write
+        await consumer.run(mock_messenger.consume())
+        assert flush.call_count == 1
+    assert acked == [1]
+
+    snp = mock_db["snp"].find_one({"_id": snp_id})
+    logger.info(f"SNP document: {snp}")
+    assert snp["status"] == "completed"
+    assert snp["result"] == {"vcf": "/data/snp.vcf"}
+    assert snp["finished_at"] is not None
+
+    debug = mock_db["debug"].find_one({"_id": debug_id})
+    assert debug["status"] == "error"
+    assert debug["error_msg"] == "Out of memory"
+
+    # A redelivered message does not change a finished calculation
+    await consumer.run(stand_in_queue([{"job_uuid": str(snp_id), "job_type": "snp", "status": "failed"}]))
+    assert mock_db["snp"].find_one({"_id": snp_id})["status"] == "completed"
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_is_retried(mock_db):
+    """Updates that could not be written stay buffered and unacknowledged, and the periodic flush keeps running"""
+    logger.info("===== test_failed_flush_is_retried =====")
+
+    snp_id = insert_hpc_job(mock_db, "snp")
+    acked = list()
+    consumer = HPCResultConsumer(mock_db, batch_size=100, flush_interval=0.05)
+    consumer.add({"job_uuid": str(snp_id), "job_type": "snp", "status": "success", "result": {}}, lambda: acked.append(1))
+
+    bulk_write = mock_db["snp"].bulk_write
+    failures = list()
+    def failing_bulk_write(*args, **kwargs):
+        if len(failures) < 2:
+            failures.append(1)
+            raise AutoReconnect("connection lost")
+        return bulk_write(*args, **kwargs)
+    with patch.object(type(mock_db["snp"]), "bulk_write", side_effect=failing_bulk_write, autospec=False):
+        with pytest.raises(AutoReconnect):
+            consumer.flush()
+        assert consumer.pending_count == 1
+        assert acked == []
+
+        flusher = asyncio.create_task(consumer.flush_periodically())
+        for _ in range(100):
+            if acked:
+                break
+            await asyncio.sleep(0.05)
+        flusher.cancel()
+    assert len(failures) == 2
+    assert acked == [1]
+    assert mock_db["snp"].find_one({"_id": snp_id})["status"] == "completed"
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_snp_status_endpoint(mock_get_section, prepared_mongo, test_client):
+    """The SNP GET endpoint exposes the status reported by the dispatcher"""
+    logger.info("===== test_snp_status_endpoint =====")
+
+    mock_get_section.return_value = MOCK_MONGO_CONFIG
+    snp_id = insert_hpc_job(prepared_mongo, "snp")
+    consumer = HPCResultConsumer(prepared_mongo)
+    await consumer.run(stand_in_queue([{"job_uuid": str(snp_id), "job_type": "snp", "status": "queued"}]))
+
+    response = await test_client.get(f"/v1/snp_calculations/{snp_id}")
+    logger.info(f"Response: {response.json()}")
+    assert response.status_code == 200
+    assert response.json()["status"] == "init"
+    assert response.json()["hpc_status"] == "queued"
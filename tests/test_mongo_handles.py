@@ -0,0 +1,90 @@
+# test_mongo_handles.py
+
+import pytest
+import logging
+import mongomock
+import pymongo
+from types import SimpleNamespace
+import mongo
+from mongo import MongoAPI, LatencyMonitor, available_compressors, get_profile_read_preference
+from calculations import Calculation
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("mongo_handles_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+# Nothing listens here; the clients only connect on their first operation
+UNUSED_CONNECTION_STRING = "mongodb://localhost:1/bio_api_test"
+
+
+def test_client_options(monkeypatch):
+    monkeypatch.setattr(mongo, "COMPRESSOR_MODULES", {"zstd": "module_that_is_not_installed", "zlib": None})
+    assert available_compressors("zstd, zlib") == ["zlib"]
+    with pytest.raises(ValueError):
+        available_compressors("lz4")
+
+    assert get_profile_read_preference("primary") == pymongo.ReadPreference.PRIMARY
+    assert get_profile_read_preference("secondaryPreferred", 120).document == {"mode": "secondaryPreferred", "maxStalenessSeconds": 120}
+
+    mongo_api = MongoAPI(UNUSED_CONNECTION_STRING, profile_read_preference=get_profile_read_preference("secondary", 90), compressors="zlib", profile_max_pool_size=5)
+    assert mongo_api.db.read_preference == pymongo.ReadPreference.PRIMARY
+    assert mongo_api.profile_db.read_preference.mode == pymongo.ReadPreference.SECONDARY.mode
+    assert mongo_api.profile_connection.options.pool_options.max_pool_size == 5
+    assert mongo_api.connection.options.pool_options.max_pool_size == mongo.MONGO_MAX_POOL_SIZE
+    mongo_api.close()
+
+
+def test_latency_monitor():
+    monitor = LatencyMonitor(window=3)
+    assert monitor.stats()["p50_ms"] is None
+    for micros in (1000, 2000, 3000, 4000):
+        monitor.succeeded(SimpleNamespace(duration_micros=micros))
+    monitor.failed(SimpleNamespace(duration_micros=10000))
+    stats = monitor.stats()
+    logger.info(f"Latency: {stats}")
+    assert stats["commands"] == 5
+    assert stats["failures"] == 1
+    # Only the last 3 durations are kept
+    assert stats["p50_ms"] == 4.0
+    assert stats["max_ms"] == 10.0
+
+
+@pytest.mark.asyncio
+async def test_profile_reads_fall_back_to_primary():
+    """Sequences that have not been replicated to the secondary yet are read from the primary"""
+    logger.info("===== test_profile_reads_fall_back_to_primary =====")
+
+    mongo_api = MongoAPI(UNUSED_CONNECTION_STRING)
+    mongo_api.db = mongomock.MongoClient().get_database("primary")
+    mongo_api.profile_db = mongomock.MongoClient().get_database("secondary", read_preference=pymongo.ReadPreference.SECONDARY_PREFERRED)
+    ids = [str(mongo_api.db["samples"].insert_one({"name": name}).inserted_id) for name in ("old", "new")]
+    mongo_api.profile_db["samples"].insert_one({"_id": mongo_api.db["samples"].find_one({"name": "old"})["_id"], "name": "old"})
+
+    count, cursor = await mongo_api.get_field_data("samples", ids[:1], ["name"])
+    assert cursor.collection.database.name == "secondary"
+    count, cursor = await mongo_api.get_field_data("samples", ids, ["name"])
+    assert count == 2
+    assert [doc["name"] for doc in cursor] == ["old", "new"]
+
+
+@pytest.mark.asyncio
+async def test_mongo_latency_endpoint(test_client):
+    mongo_api = MongoAPI(UNUSED_CONNECTION_STRING)
+    mongo_api.latency_monitors["profiles"].succeeded(SimpleNamespace(duration_micros=2500))
+    Calculation.set_mongo_api(mongo_api)
+    try:
+        response = await test_client.get("/v1/mongo_latency")
+    finally:
+        mongo_api.close()
+    logger.info(f"Response: {response.json()}")
+    assert response.status_code == 200
+    assert response.json()["primary"]["commands"] == 0
+    assert response.json()["profiles"]["p50_ms"] == 2.5
+    assert "localhost:1" in response.json()["profiles"]["servers"]
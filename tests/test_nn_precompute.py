@@ -0,0 +1,169 @@
+# test_nn_precompute.py
+
+import asyncio
+import pytest
+import logging
+from unittest.mock import patch
+from calculations import NearestNeighbors
+from nn_precompute import Lease, NeighborPrecomputer, PRECOMPUTED_COLLECTION, STATE_COLLECTION, lookup, polled_samples, touches
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_INPUT_ID,
+    MOCK_NEIGHBOR_ID_1,
+    MOCK_NEIGHBOR_ID_2,
+    MOCK_NEIGHBOR_SEQUENCE,
+    MOCK_NEIGHBOR_SEQUENCE_2,
+    NN_REQUEST_BODY
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("nn_precompute_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+PATHS = [MOCK_MONGO_CONFIG["allele_path"], MOCK_MONGO_CONFIG["digest_path"], MOCK_MONGO_CONFIG["call_pct_path"]]
+
+
+async def first(samples, count):
+    "The first count items of an async iterable"
+    taken = 0
+    async for sample in samples:
+        yield sample
+        taken += 1
+        if taken == count:
+            return
+
+
+def precomputed(db):
+    return {
+        doc["_id"]: [neighbor["_id"] for neighbor in doc["neighbors"]]
+        for doc in db[PRECOMPUTED_COLLECTION].find()
+    }
+
+
+def test_touches():
+    path = "categories.cgmlst.report.allele_array"
+    assert touches(path, ["categories.cgmlst"])
+    assert touches(path, ["categories.cgmlst.report.allele_array.0"])
+    assert not touches(path, ["categories.cgmlst.summary.call_percent"])
+    assert not touches(path, ["categories.cgmlst.report.allele_array_v2"])
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_precompute_polled_samples(mock_get_section, prepared_mongo):
+    """New samples get their neighbors computed and are added to the neighbors of their neighbors"""
+    logger.info("===== test_precompute_polled_samples =====")
+
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, engine="numpy")
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE)
+    precomputer = NeighborPrecomputer(prepared_mongo)
+    await precomputer.run(first(polled_samples(prepared_mongo, "samples", PATHS, interval=0), 2))
+    assert precomputed(prepared_mongo) == {MOCK_INPUT_ID: [MOCK_NEIGHBOR_ID_1], MOCK_NEIGHBOR_ID_1: [MOCK_INPUT_ID]}
+
+    # The poll source continues with the last sample it has yielded, as it may not have been processed
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE_2)
+    await precomputer.run(first(polled_samples(prepared_mongo, "samples", PATHS, interval=0), 2))
+    logger.info(f"Precomputed: {precomputed(prepared_mongo)}")
+    assert precomputed(prepared_mongo) == {
+        MOCK_INPUT_ID: [MOCK_NEIGHBOR_ID_1],
+        MOCK_NEIGHBOR_ID_1: [MOCK_INPUT_ID, MOCK_NEIGHBOR_ID_2],
+        MOCK_NEIGHBOR_ID_2: [MOCK_NEIGHBOR_ID_1],
+    }
+
+    # A sample whose profile no longer passes the filters is removed
+    prepared_mongo["samples"].update_one({"_id": MOCK_NEIGHBOR_ID_2}, {"$set": {MOCK_MONGO_CONFIG["call_pct_path"]: 50}})
+    assert await precomputer.precompute(prepared_mongo["samples"].find_one({"_id": MOCK_NEIGHBOR_ID_2})) is None
+    assert precomputed(prepared_mongo) == {MOCK_INPUT_ID: [MOCK_NEIGHBOR_ID_1], MOCK_NEIGHBOR_ID_1: [MOCK_INPUT_ID]}
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_nn_request_uses_precomputed_neighbors(mock_get_section, prepared_mongo, test_client):
+    """A nearest neighbors request for a precomputed sample completes right away"""
+    logger.info("===== test_nn_request_uses_precomputed_neighbors =====")
+
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, engine="numpy")
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE)
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE_2)
+    await NeighborPrecomputer(prepared_mongo).precompute(prepared_mongo["samples"].find_one({"_id": MOCK_INPUT_ID}))
+
+    with patch("calculations.NearestNeighbors.run") as run:
+        response = await test_client.post("/v1/nearest_neighbors", json=NN_REQUEST_BODY)
+        logger.info(f"Response: {response.json()}")
+        assert response.json()["status"] == "completed"
+        run.assert_not_called()
+        response = await test_client.get(f"/v1/nearest_neighbors/{response.json()['job_id']}")
+        assert response.json()["result"] == [{"id": str(MOCK_NEIGHBOR_ID_1), "diff_count": 1}]
+
+        # A lower cutoff is answered from the precomputed neighbors, a higher one is not
+        response = await test_client.post("/v1/nearest_neighbors", json=dict(NN_REQUEST_BODY, cutoff=1))
+        assert response.json()["status"] == "completed"
+        response = await test_client.post("/v1/nearest_neighbors", json=dict(NN_REQUEST_BODY, cutoff=3))
+        assert response.json()["status"] == "init"
+        assert run.call_count == 1
+
+        # Neither is a profile that has changed since its neighbors were computed
+        prepared_mongo["samples"].update_one({"_id": MOCK_INPUT_ID}, {"$set": {MOCK_MONGO_CONFIG["allele_path"]: [1, 4]}})
+        response = await test_client.post("/v1/nearest_neighbors", json=NN_REQUEST_BODY)
+        assert response.json()["status"] == "init"
+        assert run.call_count == 2
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_lookup_without_cutoff(mock_get_section, prepared_mongo):
+    """Precomputed neighbors never answer a calculation without a cutoff, and neighbors without a cutoff answer none"""
+    logger.info("===== test_lookup_without_cutoff =====")
+
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, engine="numpy")
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE)
+    await NeighborPrecomputer(prepared_mongo).precompute(prepared_mongo["samples"].find_one({"_id": MOCK_INPUT_ID}))
+
+    calc = NearestNeighbors(input_mongo_id=str(MOCK_INPUT_ID))
+    calc.input_sequence = prepared_mongo["samples"].find_one({"_id": MOCK_INPUT_ID})
+    assert lookup(prepared_mongo, calc) == [{"_id": MOCK_NEIGHBOR_ID_1, "diff_count": 1}]
+    calc.cutoff = None
+    assert lookup(prepared_mongo, calc) is None
+    calc.cutoff = 2
+    prepared_mongo[PRECOMPUTED_COLLECTION].update_one({"_id": MOCK_INPUT_ID}, {"$set": {"cutoff": None}})
+    assert lookup(prepared_mongo, calc) is None
+
+
+@pytest.mark.asyncio
+async def test_lease(prepared_mongo):
+    """Only one instance holds the lease until it expires, and the holder stops when it loses the lease"""
+    logger.info("===== test_lease =====")
+
+    first_instance = Lease(prepared_mongo, seconds=0.3)
+    second_instance = Lease(prepared_mongo, seconds=0.3)
+    assert first_instance.acquire()
+    assert first_instance.acquire()
+    assert not second_instance.acquire()
+
+    # The first instance renews the lease while it works, and releases it when the work is done
+    async def work():
+        await asyncio.sleep(0.5)
+        return "done"
+    assert await first_instance.hold(work()) == "done"
+    assert prepared_mongo[STATE_COLLECTION].find_one({"_id": "lease"}) is None
+
+    # An instance that loses the lease stops its work
+    assert first_instance.acquire()
+    cancelled = asyncio.Event()
+    async def endless_work():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+    prepared_mongo[STATE_COLLECTION].update_one({"_id": "lease"}, {"$set": {"holder": second_instance.holder}})
+    assert await asyncio.wait_for(first_instance.hold(endless_work()), 5) is None
+    await asyncio.wait_for(cancelled.wait(), 5)
+    assert prepared_mongo[STATE_COLLECTION].find_one({"_id": "lease"})["holder"] == second_instance.holder
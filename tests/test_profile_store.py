@@ -0,0 +1,83 @@
+# test_profile_store.py
+
+import logging
+import time
+import numpy as np
+from profile_store import ProfileStore, SharedGenerations
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_NEIGHBOR_SEQUENCE,
+    MOCK_NEIGHBOR_SEQUENCE_2
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("profile_store_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+ALLELE_PATH = MOCK_MONGO_CONFIG["allele_path"]
+
+
+def refreshed(store, matrix, db):
+    "The matrix that replaces matrix once its background refresh has finished"
+    for _ in range(100):
+        current = store.get(db, "samples", 1, ALLELE_PATH, {})
+        if current is not matrix:
+            return current
+        time.sleep(0.05)
+    raise AssertionError("The matrix was not refreshed")
+
+
+def test_in_process_store_reuses_matrix(prepared_mongo):
+    store = ProfileStore(directory='')
+    first = store.get(prepared_mongo, "samples", 1, ALLELE_PATH, {})
+    assert first is store.get(prepared_mongo, "samples", 1, ALLELE_PATH, {})
+
+    # The cached matrix is served while a new one is built in the background
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE)
+    assert store.get(prepared_mongo, "samples", 1, ALLELE_PATH, {}) is first
+    second = refreshed(store, first, prepared_mongo)
+    assert len(second.ids) == 2
+
+    # A fresh matrix is built before it is returned
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE_2)
+    assert len(store.get(prepared_mongo, "samples", 1, ALLELE_PATH, {}, fresh=True).ids) == 3
+
+
+def test_shared_generations(prepared_mongo, tmp_path):
+    """One process publishes a generation, the others memory-map it, and updates swap generations"""
+    logger.info("===== test_shared_generations =====")
+
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE)
+    worker_1 = ProfileStore(directory=str(tmp_path))
+    worker_2 = ProfileStore(directory=str(tmp_path))
+
+    published = worker_1.get(prepared_mongo, "samples", 1, ALLELE_PATH, {})
+    attached = worker_2.get(prepared_mongo, "samples", 1, ALLELE_PATH, {})
+    logger.info(f"Generations: {published.generation}, {attached.generation}")
+    assert published.generation == attached.generation
+    assert isinstance(attached.codes, np.memmap)
+    assert isinstance(attached.bitslice.planes, np.memmap)
+    assert attached.ids == published.ids
+    assert (attached.bitslice.count_differences(attached.codes[0]) == [0, 1]).all()
+
+    # A new sample makes the next reader publish a new generation, which the others attach in the background
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE_2)
+    updated = worker_2.get(prepared_mongo, "samples", 1, ALLELE_PATH, {}, fresh=True)
+    assert updated.generation != published.generation
+    assert len(updated.ids) == 3
+    assert refreshed(worker_1, published, prepared_mongo).generation == updated.generation
+    [key_dir] = tmp_path.iterdir()
+    assert SharedGenerations(key_dir).current().name == updated.generation
+
+    # While another process holds the build lock, readers keep using the current generation
+    prepared_mongo["samples"].delete_one({"_id": MOCK_NEIGHBOR_SEQUENCE_2["_id"]})
+    assert SharedGenerations(key_dir).acquire()
+    stale = ProfileStore(directory=str(tmp_path)).get(prepared_mongo, "samples", 1, ALLELE_PATH, {})
+    assert stale.generation == updated.generation
@@ -0,0 +1,86 @@
+# test_progress.py
+
+import pytest
+import logging
+from unittest.mock import patch
+import calculations
+from calculations import DistanceCalculation
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_INPUT_ID,
+    MOCK_NEIGHBOR_SEQUENCE,
+    MOCK_NEIGHBOR_SEQUENCE_2
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("progress_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_progress_is_throttled(mock_get_section, prepared_mongo, test_client, tmp_path, monkeypatch):
+    """Progress is written to the job document at most once per PROGRESS_INTERVAL and exposed by the GET endpoint"""
+    logger.info("===== test_progress_is_throttled =====")
+
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    mock_get_section.return_value = MOCK_MONGO_CONFIG
+    calc = DistanceCalculation(seq_mongo_ids=None)
+    await calc.insert_document()
+
+    with patch.object(calc.mongo_api.db[calc.collection], "update_one", wraps=calc.mongo_api.db[calc.collection].update_one) as update_one:
+        for processed in range(1, 101):
+            calc.report_progress("fetching profiles", processed, 100)
+        assert update_one.call_count == 1
+
+    doc = prepared_mongo[calc.collection].find_one({"_id": calc._id})
+    assert doc["progress"]["stage"] == "fetching profiles"
+    assert doc["progress"]["processed"] == 1
+    assert doc["progress"]["total"] == 100
+
+    response = await test_client.get(f"/v1/distance_calculations/{calc._id}")
+    logger.info(f"Response: {response.json()}")
+    assert response.json()["progress"]["stage"] == "fetching profiles"
+
+    monkeypatch.setattr(calculations, "PROGRESS_INTERVAL", 0)
+    calc.report_progress("calculating distances", 50, 100)
+    doc = prepared_mongo[calc.collection].find_one({"_id": calc._id})
+    assert doc["progress"]["stage"] == "calculating distances"
+    assert doc["progress"]["eta_seconds"] is not None
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_progress_cleared_on_completion(mock_get_section, prepared_mongo, tmp_path, monkeypatch):
+    """A completed calculation has no progress"""
+    logger.info("===== test_progress_cleared_on_completion =====")
+
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    monkeypatch.setattr(calculations, "PROGRESS_INTERVAL", 0)
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine="numpy")
+    prepared_mongo["samples"].update_one({"_id": MOCK_INPUT_ID}, {"$set": {"sequence_id": "input"}})
+    prepared_mongo["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE, sequence_id="neighbor1"))
+    prepared_mongo["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE_2, sequence_id="neighbor2"))
+
+    calc = DistanceCalculation(seq_mongo_ids=None)
+    _count, cursor = await calc.query_mongodb_for_allele_profiles()
+    await calc.insert_document()
+    stages = list()
+    report_progress = calc.report_progress
+    def record(stage, *args):
+        stages.append(stage)
+        report_progress(stage, *args)
+    calc.report_progress = record
+    await calc.calculate(cursor)
+
+    assert "calculating distances" in stages
+    recalled = DistanceCalculation.recall(str(calc._id))
+    assert recalled.status == "completed"
+    assert recalled.progress is None
@@ -0,0 +1,94 @@
+# test_resource_estimator.py
+
+import pytest
+import logging
+from bson.objectid import ObjectId
+import resource_estimator
+from resource_estimator import ResourceEstimator, USAGE_COLLECTION, record_usage, snp_features, format_walltime
+from hpc_results import HPCResultConsumer
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("resource_estimator_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+DEFAULTS = {"cpus": 1, "memGB": 4, "walltime": "1:00:00", "group": "fvst_ssi"}
+
+
+def observe(db, samples, read_bytes=None, backend=None):
+    "A job that takes 10 CPU minutes and 2 GB per sample"
+    record_usage(db, [{
+        "hpc_call": str(ObjectId()),
+        "job_type": "snp_batch",
+        "features": {"samples": samples, "read_bytes": read_bytes, "reference_bytes": None},
+        "runtime_seconds": 600 * samples / 4,
+        "memory_gb": 2 * samples,
+        "cpus": 4,
+        "backend": backend,
+    }])
+
+
+def test_snp_features(tmp_path):
+    reads = [tmp_path / "a_R1.fq.gz", tmp_path / "a_R2.fq.gz"]
+    for read in reads:
+        read.write_bytes(b"x" * 100)
+    features = snp_features([[str(read) for read in reads]], str(tmp_path / "missing.fasta"))
+    assert features == {"samples": 1, "read_bytes": 200, "reference_bytes": None}
+    assert format_walltime(3725) == "1:02:05"
+
+
+def test_estimate(mock_db, monkeypatch):
+    """Resources follow the observed usage once there are enough observations"""
+    logger.info("===== test_estimate =====")
+
+    monkeypatch.setattr(resource_estimator, "MIN_OBSERVATIONS", 5)
+    estimator = ResourceEstimator(mock_db, {"margin": 1, "target_walltime_hours": 1})
+    features = {"samples": 30, "read_bytes": None, "reference_bytes": None}
+    for samples in range(1, 5):
+        observe(mock_db, samples)
+    # Jobs that ran on the API host do not count
+    observe(mock_db, 20, backend="local")
+    assert estimator.estimate("snp_batch", features, DEFAULTS) == DEFAULTS
+
+    observe(mock_db, 10)
+    estimate = estimator.estimate("snp_batch", features, DEFAULTS)
+    logger.info(f"Estimate: {estimate}")
+    # 30 samples take 300 CPU minutes and 60 GB
+    assert estimate["cpus"] == 5
+    assert estimate["memGB"] == 60
+    assert estimate["walltime"] == "1:00:00"
+    assert estimate["group"] == "fvst_ssi"
+    # Observations without the file sizes cannot be used to estimate from file sizes
+    assert estimator.estimate("snp_batch", dict(features, read_bytes=10**9), DEFAULTS) == DEFAULTS
+    assert estimator.estimate("snp", features, DEFAULTS) == DEFAULTS
+
+
+@pytest.mark.asyncio
+async def test_usage_recorded_from_results(mock_db):
+    """Finished jobs that report their usage are recorded once per HPC call"""
+    logger.info("===== test_usage_recorded_from_results =====")
+
+    call = str(ObjectId())
+    features = {"samples": 2, "read_bytes": None, "reference_bytes": None}
+    job_ids = mock_db["snp"].insert_many([
+        {"status": "init", "hpc_call": call, "hpc_job_type": "snp_batch", "hpc_features": features, "hpc_resources": {"cpus": 2}}
+        for _ in range(2)
+    ]).inserted_ids
+
+    async def messages():
+        for job_id in job_ids:
+            yield {"job_uuid": str(job_id), "job_type": "snp", "status": "success", "usage": {"runtime_seconds": 120, "memory_gb": 3.5}}
+
+    await HPCResultConsumer(mock_db).run(messages())
+    usages = list(mock_db[USAGE_COLLECTION].find())
+    logger.info(f"Usage: {usages}")
+    assert len(usages) == 1
+    assert usages[0]["job_type"] == "snp_batch"
+    assert usages[0]["features"] == features
+    assert usages[0]["cpus"] == 2
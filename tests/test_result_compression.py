@@ -0,0 +1,57 @@
+# test_result_compression.py
+
+import pytest
+import logging
+from unittest.mock import patch
+from bson import ObjectId
+from calculations import NearestNeighbors
+from result_compression import compress_result, decompress_result, is_compressed
+from .requirements import MOCK_MONGO_CONFIG, MOCK_INPUT_ID
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("result_compression_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+LARGE_RESULT = [{"_id": ObjectId(), "diff_count": i % 20} for i in range(2000)]
+
+
+def test_compression_roundtrip():
+    stored, stats = compress_result(LARGE_RESULT, min_bytes=1000)
+    logger.info(f"Stats: {stats}")
+    assert is_compressed(stored)
+    assert stats["stored_bytes"] < stats["raw_bytes"]
+    assert decompress_result(stored) == LARGE_RESULT
+
+    # Small results and disabled compression are stored as they are
+    assert compress_result("small", min_bytes=1000) == ("small", None)
+    assert compress_result(LARGE_RESULT, codec="none") == (LARGE_RESULT, None)
+    assert decompress_result("small") == "small"
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_store_result_compresses_transparently(mock_get_section, prepared_mongo):
+    """Large results are compressed in MongoDB and decompressed by recall() and get_result()"""
+    logger.info("===== test_store_result_compresses_transparently =====")
+
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, result_compression={"codec": "gzip", "min_bytes": 1000})
+    calc = NearestNeighbors(input_mongo_id=str(MOCK_INPUT_ID))
+    await calc.insert_document()
+    await calc.store_result(LARGE_RESULT)
+
+    doc = prepared_mongo[NearestNeighbors.collection].find_one({"_id": calc._id})
+    logger.info(f"Compression stats: {doc['result_compression']}")
+    assert is_compressed(doc["result"])
+    assert doc["result_compression"]["ratio"] > 1
+
+    assert await calc.get_result() == LARGE_RESULT
+    recalled = NearestNeighbors.recall(str(calc._id))
+    assert recalled.result == LARGE_RESULT
+    assert recalled.result_compression == doc["result_compression"]
@@ -0,0 +1,115 @@
+# test_snp_batch.py
+
+import pytest
+import logging
+from bson.objectid import ObjectId
+from unittest.mock import patch
+import calculations
+from .requirements import MOCK_SNP_CONFIG
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("snp_batch_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def insert_sample(db, name):
+    return str(db["samples"].insert_one({"reads": [f"{name}_R1.fq.gz", f"{name}_R2.fq.gz"], "contigs": f"{name}.fasta"}).inserted_id)
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_snp_batch(mock_get_section, prepared_mongo, test_client, mock_messenger, monkeypatch):
+    """SNP jobs with the same reference are submitted in one HPC call"""
+    logger.info("===== test_snp_batch =====")
+
+    mock_get_section.return_value = MOCK_SNP_CONFIG
+    monkeypatch.setattr(calculations, "get_messenger", lambda: mock_messenger)
+    send_hpc_call = mock_messenger.send_hpc_call
+    find = prepared_mongo["samples"].find
+    samples = [insert_sample(prepared_mongo, f"sample{i}") for i in range(4)]
+    reference, other_reference = samples[0], samples[1]
+
+    with patch.object(prepared_mongo["samples"], "find", wraps=find) as mongo_find:
+        response = await test_client.post("/v1/snp_calculations/batch", json={"calculations": [
+            {"seq_mongo_ids": samples[2:], "reference_mongo_id": reference},
+            {"seq_mongo_ids": samples[1:3], "reference_mongo_id": reference},
+            {"seq_mongo_ids": samples[2:], "reference_mongo_id": other_reference},
+            {"seq_mongo_ids": [str(ObjectId())], "reference_mongo_id": reference},
+        ]})
+        assert mongo_find.call_count == 1
+    logger.info(f"Response: {response.json()}")
+    assert response.status_code == 201
+    jobs = response.json()
+    assert [job["status"] for job in jobs] == ["init", "init", "init", "error"]
+
+    assert send_hpc_call.call_count == 2
+    calls = {call.kwargs["job_type"]: call.kwargs for call in send_hpc_call.call_args_list}
+    batch = calls["snp_batch"]
+    assert batch["args"]["reference"] == "sample0.fasta"
+    assert [job["uuid"] for job in batch["args"]["jobs"]] == [jobs[0]["job_id"], jobs[1]["job_id"]]
+    assert batch["args"]["jobs"][1]["input_files"] == [["sample1_R1.fq.gz", "sample1_R2.fq.gz"], ["sample2_R1.fq.gz", "sample2_R2.fq.gz"]]
+    assert batch["cpus"] == 1
+    assert calls["snp"]["uuid"] == jobs[2]["job_id"]
+    assert calls["snp"]["args"]["reference"] == "sample1.fasta"
+
+    first = calculations.SNPCalculation.recall(jobs[0]["job_id"])
+    second = calculations.SNPCalculation.recall(jobs[1]["job_id"])
+    assert first.hpc_call == second.hpc_call == batch["uuid"]
+    # Each calculation has its own input files
+    assert first.input_filenames != second.input_filenames
+
+    response = await test_client.get(f"/v1/snp_calculations/{jobs[3]['job_id']}")
+    assert response.json()["status"] == "error"
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_snp_missing_reference(mock_get_section, prepared_mongo, test_client, mock_messenger, monkeypatch):
+    """A single SNP calculation with an unknown reference is rejected"""
+    logger.info("===== test_snp_missing_reference =====")
+
+    mock_get_section.return_value = MOCK_SNP_CONFIG
+    monkeypatch.setattr(calculations, "get_messenger", lambda: mock_messenger)
+    sample = insert_sample(prepared_mongo, "sample")
+
+    response = await test_client.post("/v1/snp_calculations", json={"seq_mongo_ids": [sample], "reference_mongo_id": str(ObjectId())})
+    logger.info(f"Response: {response.json()}")
+    assert response.status_code == 404
+    mock_messenger.send_hpc_call.assert_not_called()
+
+    response = await test_client.post("/v1/snp_calculations", json={"seq_mongo_ids": [sample], "reference_mongo_id": sample})
+    assert response.status_code == 201
+    mock_messenger.send_hpc_call.assert_called_once()
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_snp_requested_resources(mock_get_section, prepared_mongo, test_client, mock_messenger, monkeypatch):
+    """A recalled job keeps only the explicitly requested resources ahead of the estimates"""
+    logger.info("===== test_snp_requested_resources =====")
+
+    mock_get_section.return_value = MOCK_SNP_CONFIG
+    monkeypatch.setattr(calculations, "get_messenger", lambda: mock_messenger)
+    samples = [insert_sample(prepared_mongo, f"sample{i}") for i in range(2)]
+
+    response = await test_client.post("/v1/snp_calculations/batch", json={"calculations": [
+        {"seq_mongo_ids": samples[1:], "reference_mongo_id": samples[0]},
+        {"seq_mongo_ids": samples[1:], "reference_mongo_id": samples[0], "hpc_resources": {"cpus": 3}},
+    ]})
+    assert response.status_code == 201
+    estimated, requested = response.json()
+    # The explicitly requested resources keep the jobs in separate calls
+    assert mock_messenger.send_hpc_call.call_count == 2
+
+    monkeypatch.setattr(calculations.ResourceEstimator, "estimate", lambda self, job_type, features, defaults: {"cpus": 8, "memGB": 16})
+    estimated = calculations.SNPCalculation.recall(estimated["job_id"])
+    requested = calculations.SNPCalculation.recall(requested["job_id"])
+    assert estimated.estimate_resources("snp", {}) == {"cpus": 8, "memGB": 16}
+    assert requested.estimate_resources("snp", {}) == {"cpus": 3, "memGB": 16}
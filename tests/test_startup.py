@@ -0,0 +1,28 @@
+# test_startup.py
+
+import subprocess
+import sys
+import logging
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("startup_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def test_heavy_modules_are_imported_lazily():
+    """Importing the API does not import the heavy modules of the calculations or connect to anything"""
+    logger.info("===== test_heavy_modules_are_imported_lazily =====")
+
+    code = "import sys, main, calculations; print(' '.join(sorted(m for m in ('pandas', 'scipy', 'pyarrow', 'tree_maker') if m in sys.modules))); print(calculations._messenger)"
+    completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    logger.info(f"Output: {completed.stdout}")
+    imported, messenger = completed.stdout.splitlines()
+    assert imported == ""
+    assert messenger == "None"
@@ -0,0 +1,119 @@
+# test_sub_matrix.py
+
+import json
+import pytest
+import logging
+from pathlib import Path
+from unittest.mock import patch
+import calculations
+from calculations import DistanceCalculation, TreeCalculation
+from job_registry import job_registry
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_INPUT_ID,
+    MOCK_NEIGHBOR_ID_2,
+    MOCK_NEIGHBOR_SEQUENCE,
+    MOCK_NEIGHBOR_SEQUENCE_2
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("sub_matrix_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+@pytest.fixture
+def dmx_job(prepared_mongo, tmp_path, monkeypatch):
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    prepared_mongo["samples"].update_one({"_id": MOCK_INPUT_ID}, {"$set": {"sequence_id": "input"}})
+    prepared_mongo["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE, sequence_id="neighbor1"))
+    prepared_mongo["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE_2, sequence_id="neighbor2"))
+    return prepared_mongo
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_slice_distance_matrix(mock_get_section, dmx_job, test_client):
+    """A slice of a completed distance matrix is a new distance matrix job that trees can use"""
+    logger.info("===== test_slice_distance_matrix =====")
+
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine="numpy")
+    source = DistanceCalculation(seq_mongo_ids=None)
+    _count, cursor = await source.query_mongodb_for_allele_profiles()
+    await source.insert_document()
+    await source.calculate(cursor)
+    assert not Path(source.dist_mx_filepath).exists()
+
+    response = await test_client.post("/v1/distance_calculations/slices", json={
+        "dmx_job": str(source._id),
+        "sequence_ids": ["neighbor2", "input"]
+    })
+    assert response.status_code == 201
+    job_id = response.json()["job_id"]
+
+    content = (await test_client.get(f"/v1/distance_calculations/{job_id}")).json()
+    logger.info(f"Slice: {content}")
+    assert content["status"] == "completed"
+    assert content["source_dmx_job"] == str(source._id)
+    assert content["seq_mongo_ids"] == [str(MOCK_NEIGHBOR_ID_2), str(MOCK_INPUT_ID)]
+    assert content["result"]["seq_to_mongo"] == {"neighbor2": str(MOCK_NEIGHBOR_ID_2), "input": str(MOCK_INPUT_ID)}
+    sliced = DistanceCalculation.recall(job_id)
+    sequence_ids, distances = await sliced.load_dmx_array()
+    assert sequence_ids == ["neighbor2", "input"]
+    assert distances.tolist() == [[0, 2], [2, 0]]
+    assert not Path(sliced.dist_mx_filepath).exists()
+
+    # Trees can be made directly from the slice
+    tree = TreeCalculation(job_id, "single")
+    await tree.insert_document()
+    await tree.calculate()
+    assert "neighbor2" in await tree.get_result()
+
+    # Unknown sequences are rejected
+    response = await test_client.post("/v1/distance_calculations/slices", json={
+        "dmx_job": str(source._id),
+        "seq_mongo_ids": [str(MOCK_INPUT_ID), "65f000abc123abc123abc999"]
+    })
+    assert response.status_code == 400
+
+    # Distance matrices from before the array file existed only have distance_matrix.json, and are converted once
+    Path(source.dist_mx_filepath).write_text(json.dumps(await source.load_dmx_dict()))
+    Path(source.dist_array_filepath).unlink()
+    response = await test_client.post("/v1/distance_calculations/slices", json={
+        "dmx_job": str(source._id),
+        "seq_mongo_ids": [str(MOCK_INPUT_ID), str(MOCK_NEIGHBOR_ID_2)]
+    })
+    assert DistanceCalculation.recall(response.json()["job_id"]).status == "completed"
+    assert Path(source.dist_array_filepath).exists()
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_failed_slice(mock_get_section, dmx_job, test_client, monkeypatch):
+    """A slice that fails unexpectedly gets the status 'error' and is no longer registered as running"""
+    logger.info("===== test_failed_slice =====")
+
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine="numpy")
+    source = DistanceCalculation(seq_mongo_ids=None)
+    _count, cursor = await source.query_mongodb_for_allele_profiles()
+    await source.insert_document()
+    await source.calculate(cursor)
+
+    def failing_write(self, sequence_ids, distances):
+        raise ValueError("unexpected")
+    monkeypatch.setattr(DistanceCalculation, "_write_dmx_array", failing_write)
+    with pytest.raises(ValueError):
+        await test_client.post("/v1/distance_calculations/slices", json={
+            "dmx_job": str(source._id),
+            "sequence_ids": ["neighbor2", "input"]
+        })
+    [sliced] = dmx_job[DistanceCalculation.collection].find({"source_dmx_job": str(source._id)})
+    assert sliced["status"] == "error"
+    assert "unexpected" in sliced["result"]
+    assert job_registry.get(str(sliced["_id"])) is None
@@ -0,0 +1,100 @@
+# test_threshold_graph.py
+
+import pytest
+import logging
+import numpy as np
+from bson import ObjectId
+from unittest.mock import patch
+import calculations
+from allele_encoding import FIRST_ALLELE_CODE
+from hamming import distance_matrix
+from threshold_graph import close_pairs, component_labels
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_INPUT_ID,
+    MOCK_NEIGHBOR_ID_1,
+    MOCK_NEIGHBOR_ID_2,
+    MOCK_NEIGHBOR_SEQUENCE,
+    MOCK_NEIGHBOR_SEQUENCE_2
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("threshold_graph_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def test_close_pairs_match_distance_matrix():
+    """The blocked search finds exactly the pairs of the full distance matrix within max_distance"""
+    rng = np.random.default_rng(0)
+    max_distance = 4
+    # Samples around a few founders, some with many unknown calls
+    founders = rng.integers(FIRST_ALLELE_CODE, FIRST_ALLELE_CODE + 20, size=(5, 120))
+    profiles = founders[rng.integers(0, 5, size=200)]
+    mutated = rng.random(profiles.shape) < rng.choice([0.0, 0.02, 0.2], size=(200, 1))
+    profiles[mutated] = rng.integers(FIRST_ALLELE_CODE, FIRST_ALLELE_CODE + 20, size=mutated.sum())
+    unknown = rng.random(profiles.shape) < rng.choice([0.0, 0.01, 0.2], size=(200, 1))
+    profiles[unknown] = rng.integers(0, FIRST_ALLELE_CODE, size=unknown.sum())
+    profiles = profiles.astype(np.uint8)
+
+    edges = close_pairs(profiles, max_distance)
+    distances = distance_matrix(profiles)
+    a, b = np.nonzero(np.triu(distances <= max_distance, 1))
+    logger.info(f"{len(edges)} edges")
+    assert edges["a"].tolist() == a.tolist()
+    assert edges["b"].tolist() == b.tolist()
+    assert edges["distance"].tolist() == distances[a, b].tolist()
+
+
+def test_component_labels():
+    edges = np.array([(0, 1, 1), (3, 4, 0), (4, 5, 2)], dtype=[("a", "<u4"), ("b", "<u4"), ("distance", "u1")])
+    assert component_labels(edges, 7).tolist() == [1, 1, -1, 0, 0, 0, -1]
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_threshold_graph_endpoints(mock_get_section, prepared_mongo, test_client, tmp_path, monkeypatch):
+    """A threshold graph job stores the close pairs, which are returned as components and neighborhoods"""
+    logger.info("===== test_threshold_graph_endpoints =====")
+
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, max_distance=1)
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE)
+    prepared_mongo["samples"].insert_one(MOCK_NEIGHBOR_SEQUENCE_2)
+    distant = prepared_mongo["samples"].insert_one(
+        {"categories": {"cgmlst": {"report": {"alleles": {"locus1": "7", "locus2": "7"}}}}}
+    ).inserted_id
+
+    response = await test_client.post("/v1/threshold_graphs", json={"seq_mongo_ids": None})
+    assert response.status_code == 201
+    job_id = response.json()["job_id"]
+
+    content = (await test_client.get(f"/v1/threshold_graphs/{job_id}")).json()
+    logger.info(f"Threshold graph: {content}")
+    assert content["status"] == "completed"
+    assert content["max_distance"] == 1
+    assert content["result"] == {"samples": 4, "edges": 2, "components": 1}
+
+    response = await test_client.get(f"/v1/threshold_graphs/{job_id}/components")
+    assert response.json() == {"components": [[str(MOCK_INPUT_ID), str(MOCK_NEIGHBOR_ID_1), str(MOCK_NEIGHBOR_ID_2)]]}
+
+    response = await test_client.get(f"/v1/threshold_graphs/{job_id}/samples/{MOCK_NEIGHBOR_ID_1}")
+    logger.info(f"Neighborhood: {response.json()}")
+    assert len(response.json()["component"]) == 3
+    assert response.json()["edges"] == [
+        {"a": str(MOCK_INPUT_ID), "b": str(MOCK_NEIGHBOR_ID_1), "distance": 1},
+        {"a": str(MOCK_NEIGHBOR_ID_1), "b": str(MOCK_NEIGHBOR_ID_2), "distance": 1},
+    ]
+    response = await test_client.get(f"/v1/threshold_graphs/{job_id}/samples/{distant}")
+    assert response.json() == {"component": [str(distant)], "edges": []}
+    response = await test_client.get(f"/v1/threshold_graphs/{job_id}/samples/{ObjectId()}")
+    assert response.status_code == 404
+
+    response = await test_client.post("/v1/threshold_graphs", json={"seq_mongo_ids": [str(ObjectId())]})
+    assert response.status_code == 404
@@ -0,0 +1,148 @@
+# test_tiled_dmx.py
+
+import pytest
+import logging
+import numpy as np
+from pathlib import Path
+from unittest.mock import patch
+import calculations
+import tiled_dmx
+from allele_encoding import FIRST_ALLELE_CODE
+from calculations import DistanceCalculation
+from hamming import distance_matrix
+from tiled_dmx import TiledDistanceMatrix
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_INPUT_ID,
+    MOCK_NEIGHBOR_SEQUENCE,
+    MOCK_NEIGHBOR_SEQUENCE_2
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("tiled_dmx_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+def random_profiles(sample_count, locus_count):
+    rng = np.random.default_rng(0)
+    return rng.integers(FIRST_ALLELE_CODE - 1, FIRST_ALLELE_CODE + 3, size=(sample_count, locus_count)).astype(np.uint8)
+
+
+def test_tiled_distance_matrix(tmp_path):
+    """The tiles make up the same matrix as hamming.distance_matrix, capped or not"""
+    profiles = random_profiles(45, 60)
+    distances = distance_matrix(profiles)
+
+    matrix = TiledDistanceMatrix(str(tmp_path / "dmx.npy"), str(tmp_path / "done.txt"), len(profiles), np.int32)
+    matrix.calculate(profiles, 16)
+    assert (np.load(tmp_path / "dmx.npy") == distances).all()
+    # 3 x 3 tiles, of which 6 are on or above the diagonal
+    assert len(matrix.done()) == 6
+
+    capped = TiledDistanceMatrix(str(tmp_path / "capped.npy"), str(tmp_path / "capped.txt"), len(profiles), np.uint8)
+    capped.calculate(profiles, 16, max_distance=30)
+    assert (np.load(tmp_path / "capped.npy") == np.minimum(distances, 31)).all()
+
+
+def test_tiled_distance_matrix_resume(tmp_path):
+    """An interrupted calculation continues with the first unfinished tile"""
+    profiles = random_profiles(45, 60)
+    matrix = TiledDistanceMatrix(str(tmp_path / "dmx.npy"), str(tmp_path / "done.txt"), len(profiles), np.int32)
+
+    def interrupt(done, total):
+        if done == 4:
+            raise RuntimeError("interrupted")
+    with pytest.raises(RuntimeError):
+        matrix.calculate(profiles, 16, on_progress=interrupt)
+    assert len(matrix.done()) == 4
+
+    progress = list()
+    matrix.calculate(profiles, 16, on_progress=lambda done, total: progress.append((done, total)))
+    assert progress == [(5, 6), (6, 6)]
+    assert (np.load(tmp_path / "dmx.npy") == distance_matrix(profiles)).all()
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_tiled_distance_calculation(mock_get_section, prepared_mongo, test_client, tmp_path, monkeypatch):
+    """A failed tiled calculation is recomputed from its finished tiles"""
+    logger.info("===== test_tiled_distance_calculation =====")
+
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine="tiled")
+    prepared_mongo["samples"].update_one({"_id": MOCK_INPUT_ID}, {"$set": {"sequence_id": "input"}})
+    prepared_mongo["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE, sequence_id="neighbor1"))
+    prepared_mongo["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE_2, sequence_id="neighbor2"))
+    # A tile per pair of sequences
+    monkeypatch.setattr(tiled_dmx, "tile_size", lambda *args: 1)
+    distance_tile = tiled_dmx.distance_tile
+    tiles = list()
+    def failing_distance_tile(*args, **kwargs):
+        tiles.append(args[1:3])
+        if len(tiles) == 3:
+            raise OSError("disk full")
+        return distance_tile(*args, **kwargs)
+    monkeypatch.setattr(tiled_dmx, "distance_tile", failing_distance_tile)
+
+    calc = DistanceCalculation(seq_mongo_ids=None)
+    _count, cursor = await calc.query_mongodb_for_allele_profiles()
+    await calc.insert_document()
+    with pytest.raises(OSError):
+        await calc.run(cursor)
+    assert DistanceCalculation.recall(str(calc._id)).status == "error"
+    assert Path(calc.profiles_filepath).exists()
+    assert len(Path(calc.tiles_done_filepath).read_text().splitlines()) == 2
+
+    monkeypatch.setattr(tiled_dmx, "distance_tile", distance_tile)
+    response = await test_client.get(f"/v1/distance_calculations/{calc._id}", params={"recompute": True})
+    logger.info(f"Recompute response: {response.json()}")
+    # 3 x 3 tiles, of which 6 are on or above the diagonal: the 2 finished ones were not calculated again
+    assert len(tiles) == 3
+
+    response = await test_client.get(f"/v1/distance_calculations/{calc._id}")
+    content = response.json()
+    logger.info(f"Response: {content}")
+    assert content["status"] == "completed"
+    assert content["result"]["seq_to_mongo"]["input"] == str(MOCK_INPUT_ID)
+    assert "input\t0\t1\t2" in content["result"]["distances"][0]
+    assert not Path(calc.folder, "distance_matrix.json").exists()
+    assert not Path(calc.profiles_filepath).exists()
+    assert not Path(calc.tiles_done_filepath).exists()
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_tiled_duplicate_sequence_ids(mock_get_section, prepared_mongo, tmp_path, monkeypatch):
+    """The tiled engine keeps the last profile of a duplicate sequence ID, like the numpy engine"""
+    logger.info("===== test_tiled_duplicate_sequence_ids =====")
+
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    # A batch per document, so that the profiles are written to profiles.npy in several batches
+    monkeypatch.setattr(calculations, "ENCODING_BATCH_SIZE", 1)
+    prepared_mongo["samples"].update_one({"_id": MOCK_INPUT_ID}, {"$set": {"sequence_id": "input"}})
+    prepared_mongo["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE, sequence_id="neighbor"))
+    prepared_mongo["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE_2, sequence_id="neighbor"))
+
+    results = dict()
+    for engine in ("numpy", "tiled"):
+        mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine=engine)
+        calc = DistanceCalculation(seq_mongo_ids=None)
+        _count, cursor = await calc.query_mongodb_for_allele_profiles()
+        await calc.insert_document()
+        await calc.run(cursor)
+        assert DistanceCalculation.recall(str(calc._id)).status == "completed"
+        results[engine] = await calc.load_dmx_array()
+        assert not Path(calc.profiles_filepath + ".staging").exists()
+
+    numpy_ids, numpy_distances = results["numpy"]
+    tiled_ids, tiled_distances = results["tiled"]
+    assert tiled_ids == numpy_ids == ["input", "neighbor"]
+    assert tiled_distances.shape == (2, 2)
+    assert (tiled_distances == numpy_distances).all()
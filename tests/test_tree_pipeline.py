@@ -0,0 +1,81 @@
+# test_tree_pipeline.py
+
+import pytest
+import logging
+from pathlib import Path
+from unittest.mock import patch
+import calculations
+from calculations import DistanceCalculation, TreeCalculation
+from .requirements import (
+    MOCK_MONGO_CONFIG,
+    MOCK_INPUT_ID,
+    MOCK_NEIGHBOR_SEQUENCE,
+    MOCK_NEIGHBOR_SEQUENCE_2
+)
+
+# --- Logging Setup ---
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+file_handler = logging.FileHandler("tree_pipeline_test.log", mode='w')
+file_handler.setLevel(logging.INFO)
+
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler.setFormatter(formatter)
+logger.addHandler(file_handler)
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_tree_pipeline(mock_get_section, prepared_mongo, test_client, tmp_path, monkeypatch):
+    """Trees are made from profiles in one job and the distance matrix is stored for reuse"""
+    logger.info("===== test_tree_pipeline =====")
+
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    # The configured cgmlst-dists engine is replaced by the in-process engine
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine="cgmlst-dists")
+    prepared_mongo["samples"].update_one({"_id": MOCK_INPUT_ID}, {"$set": {"sequence_id": "input"}})
+    prepared_mongo["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE, sequence_id="neighbor1"))
+    prepared_mongo["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE_2, sequence_id="neighbor2"))
+
+    response = await test_client.post("/v1/tree_pipelines", json={"seq_mongo_ids": None, "methods": ["single", "average"]})
+    assert response.status_code == 201
+    content = (await test_client.get(f"/v1/tree_pipelines/{response.json()['job_id']}")).json()
+    logger.info(f"Pipeline: {content}")
+    assert content["status"] == "completed"
+    assert set(content["result"]["trees"]) == {"single", "average"}
+
+    dc = DistanceCalculation.recall(content["dmx_job"])
+    assert dc.status == "completed"
+    assert Path(dc.dist_array_filepath).exists()
+    assert not Path(dc.dist_mx_filepath).exists()
+
+    tree = TreeCalculation(content["dmx_job"], "single")
+    await tree.insert_document()
+    await tree.calculate()
+    assert await tree.get_result() == content["result"]["trees"]["single"]
+
+
+@pytest.mark.asyncio
+@patch("calculations.Config.get_section")
+async def test_tree_pipeline_persist_failure(mock_get_section, prepared_mongo, test_client, tmp_path, monkeypatch):
+    """The trees of a pipeline are kept when its distance matrix cannot be saved, and the distance calculation fails"""
+    logger.info("===== test_tree_pipeline_persist_failure =====")
+
+    monkeypatch.setattr(calculations, "DMX_DIR", str(tmp_path))
+    mock_get_section.return_value = dict(MOCK_MONGO_CONFIG, seqid_field_path="sequence_id", engine="numpy")
+    prepared_mongo["samples"].update_one({"_id": MOCK_INPUT_ID}, {"$set": {"sequence_id": "input"}})
+    prepared_mongo["samples"].insert_one(dict(MOCK_NEIGHBOR_SEQUENCE, sequence_id="neighbor1"))
+    def failing_write(self, sequence_ids, distances):
+        raise OSError("disk full")
+    monkeypatch.setattr(DistanceCalculation, "_write_dmx_array", failing_write)
+
+    response = await test_client.post("/v1/tree_pipelines", json={"seq_mongo_ids": None, "methods": ["single"]})
+    content = (await test_client.get(f"/v1/tree_pipelines/{response.json()['job_id']}")).json()
+    logger.info(f"Pipeline: {content}")
+    assert content["status"] == "completed"
+    assert "single" in content["result"]["trees"]
+
+    dc = DistanceCalculation.recall(content["dmx_job"])
+    assert dc.status == "error"
+    assert "disk full" in dc.result
@@ -0,0 +1,168 @@
+import numpy as np
+
+from allele_encoding import compared_calls, smallest_uint_dtype
+from clustering import UnionFind
+from hamming import capped_count_differences
+
+# Number of candidate pairs to verify in one go. Bounds the size of the temporary arrays.
+VERIFY_CHUNK_PAIRS = 4096
+# Samples that share a block key in groups up to this size are paired all at once, larger groups row by row
+GROUP_PAIRS_AT_ONCE = 256
+
+
+def edge_dtype(max_distance: int):
+    "The dtype of an edge list: the row numbers of the two samples (a < b) and their distance"
+    return np.dtype([('a', '<u4'), ('b', '<u4'), ('distance', smallest_uint_dtype(max_distance))])
+
+
+def default_blocks(max_distance: int, locus_count: int):
+    "The number of blocks to split the loci in: 4 per allowed difference, so samples may have a few ignored calls"
+    return max(min(4 * (max_distance + 1), locus_count), 1)
+
+
+def block_keys(profiles: np.ndarray, blocks: int):
+    """
+    Split the loci in blocks and return an (samples, blocks) array with a key for the allele codes of each
+    sample in each block: samples with the same codes in a block have the same key. Blocks where a sample has
+    an ignored call (see allele_encoding.compared_calls) get the key -1.
+    """
+    sample_count, locus_count = profiles.shape
+    bounds = np.linspace(0, locus_count, blocks + 1).astype(int)
+    keys = np.full((sample_count, blocks), -1, dtype=np.int32)
+    for block in range(blocks):
+        codes = np.ascontiguousarray(profiles[:, bounds[block]:bounds[block + 1]])
+        known = compared_calls(codes).all(axis=1)
+        # View each row as a single opaque value, so that rows can be compared and sorted as a whole
+        rows = codes[known].view(np.dtype((np.void, codes.dtype.itemsize * codes.shape[1])))[:, 0]
+        _uniques, inverse = np.unique(rows, return_inverse=True)
+        keys[known, block] = inverse.ravel()
+    return keys
+
+
+def unindexed_samples(keys: np.ndarray, max_distance: int):
+    """
+    Return a mask of the samples with ignored calls in so many blocks that a pair with one of them may not
+    share any block, and which are compared with all samples instead.
+
+    Two samples within max_distance differ in at most max_distance blocks. If they have ignored calls in
+    u_a and u_b blocks, they have the same key in at least blocks - max_distance - u_a - u_b blocks, which is
+    at least one if both have ignored calls in at most (blocks - max_distance - 1) / 2 blocks.
+    """
+    unknown_blocks = (keys < 0).sum(axis=1)
+    return 2 * unknown_blocks > keys.shape[1] - max_distance - 1
+
+
+def candidate_pairs(keys: np.ndarray, block: int):
+    """
+    Yield arrays of pairs (a < b) of samples that have the same key in block and in none of the blocks before
+    it, so that each pair is a candidate in only one block.
+    """
+    key = keys[:, block]
+    rows = np.flatnonzero(key >= 0)
+    order = rows[np.argsort(key[rows], kind='stable')]
+    sorted_keys = key[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if len(order) else np.zeros(0, dtype=int)
+    sizes = np.diff(np.r_[starts, len(order)])
+    earlier = keys[:, :block]
+    for start, size in zip(starts[sizes > 1].tolist(), sizes[sizes > 1].tolist()):
+        # The members are in ascending order, as the sort is stable
+        members = order[start:start + size]
+        if size <= GROUP_PAIRS_AT_ONCE:
+            first, second = np.triu_indices(size, 1)
+            pairs = [(members[first], members[second])]
+        else:
+            pairs = ((np.full(size - i - 1, members[i]), members[i + 1:]) for i in range(size - 1))
+        for a, b in pairs:
+            if block:
+                shared = ((earlier[a] == earlier[b]) & (earlier[a] >= 0)).any(axis=1)
+                a, b = a[~shared], b[~shared]
+            if len(a):
+                yield a, b
+
+
+def count_pair_differences(profiles: np.ndarray, a: np.ndarray, b: np.ndarray):
+    "Count the differences between the profiles of each pair, with the semantics of hamming.count_differences"
+    diff_counts = np.empty(len(a), dtype=np.int64)
+    for start in range(0, len(a), VERIFY_CHUNK_PAIRS):
+        x = profiles[a[start:start + VERIFY_CHUNK_PAIRS]]
+        y = profiles[b[start:start + VERIFY_CHUNK_PAIRS]]
+        diff_counts[start:start + len(x)] = ((x != y) & compared_calls(x) & compared_calls(y)).sum(axis=1)
+    return diff_counts
+
+
+def close_pairs(profiles: np.ndarray, max_distance: int, blocks: int | None = None, on_progress=None):
+    """
+    Return the edge list (see edge_dtype) of all pairs of encoded profiles with at most max_distance
+    differences, sorted by a and b.
+
+    The loci are split in blocks, and only pairs that have exactly the same allele codes in at least one
+    block are compared (by the pigeonhole principle, pairs within max_distance do, see unindexed_samples), so
+    the work grows with the number of similar pairs instead of with the square of the number of samples.
+    Samples with ignored calls in too many blocks are compared with all samples.
+    on_progress(steps_done, step_count) is called after each block and each of those samples if given.
+    """
+    sample_count, locus_count = profiles.shape
+    blocks = min(blocks or default_blocks(max_distance, locus_count), max(locus_count, 1))
+    keys = block_keys(profiles, blocks)
+    unindexed = unindexed_samples(keys, max_distance)
+    keys[unindexed] = -1
+    unindexed_rows = np.flatnonzero(unindexed)
+    step_count = blocks + len(unindexed_rows)
+
+    found_a, found_b, found_distances = list(), list(), list()
+    def verify(a, b):
+        distances = count_pair_differences(profiles, a, b)
+        close = distances <= max_distance
+        found_a.append(a[close])
+        found_b.append(b[close])
+        found_distances.append(distances[close])
+
+    for block in range(blocks):
+        batch_a, batch_b, batch_size = list(), list(), 0
+        for a, b in candidate_pairs(keys, block):
+            batch_a.append(a)
+            batch_b.append(b)
+            batch_size += len(a)
+            if batch_size >= VERIFY_CHUNK_PAIRS:
+                verify(np.concatenate(batch_a), np.concatenate(batch_b))
+                batch_a, batch_b, batch_size = list(), list(), 0
+        if batch_size:
+            verify(np.concatenate(batch_a), np.concatenate(batch_b))
+        if on_progress is not None:
+            on_progress(block + 1, step_count)
+
+    for done, row in enumerate(unindexed_rows.tolist()):
+        distances = capped_count_differences(profiles[row], profiles, max_distance)
+        others = np.flatnonzero(distances <= max_distance)
+        # Pairs of two of these samples are found from the one with the lower row number
+        others = others[(others != row) & (~unindexed[others] | (others > row))]
+        found_a.append(np.minimum(others, row))
+        found_b.append(np.maximum(others, row))
+        found_distances.append(distances[others])
+        if on_progress is not None:
+            on_progress(blocks + done + 1, step_count)
+
+    edges = np.zeros(sum(len(a) for a in found_a), dtype=edge_dtype(max_distance))
+    if len(edges):
+        edges['a'] = np.concatenate(found_a)
+        edges['b'] = np.concatenate(found_b)
+        edges['distance'] = np.concatenate(found_distances)
+        edges.sort(order=['a', 'b'])
+    return edges
+
+
+def component_labels(edges: np.ndarray, sample_count: int):
+    """
+    Return the connected component of each sample: components are numbered from the largest (0) down, and
+    samples without edges get -1.
+    """
+    union_find = UnionFind()
+    for a, b in zip(edges['a'].tolist(), edges['b'].tolist()):
+        union_find.add(a)
+        union_find.add(b)
+        union_find.union(a, b)
+    labels = np.full(sample_count, -1, dtype=np.int32)
+    components = sorted(union_find.components().values(), key=lambda members: (-len(members), min(members)))
+    for label, members in enumerate(components):
+        labels[members] = label
+    return labels
@@ -0,0 +1,99 @@
+import math
+import os
+from pathlib import Path
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from hamming import CHUNK_ROWS, count_differences, capped_count_differences
+
+
+def tile_size(memory_bytes: int, locus_count: int, profile_itemsize: int, distance_itemsize: int):
+    """
+    Return the side of the square tiles that fit in memory_bytes: a tile of distances, the encoded profiles
+    of its columns and the temporary arrays of count_differences, which compares CHUNK_ROWS profiles at a time.
+    """
+    available = memory_bytes - 3 * CHUNK_ROWS * locus_count
+    # Solve distance_itemsize * size**2 + profile_itemsize * locus_count * size = available for size
+    a, b = distance_itemsize, profile_itemsize * locus_count
+    size = (-b + math.sqrt(b * b + 4 * a * max(available, 0))) / (2 * a)
+    return max(int(size), 16)
+
+
+def tile_starts(sample_count: int, size: int):
+    "Return the (first row, first column) of the tiles on and above the diagonal, row by row"
+    starts = range(0, sample_count, size)
+    return [(row, column) for row in starts for column in starts if column >= row]
+
+
+def distance_tile(profiles: np.ndarray, rows: slice, columns: slice, dtype, max_distance: int | None = None):
+    "Return the distances between the encoded profiles of a range of rows and a range of columns"
+    column_profiles = np.asarray(profiles[columns])
+    tile = np.empty((rows.stop - rows.start, len(column_profiles)), dtype=dtype)
+    for i, profile in enumerate(profiles[rows]):
+        if max_distance is None:
+            tile[i] = count_differences(profile, column_profiles)
+        else:
+            tile[i] = capped_count_differences(profile, column_profiles, max_distance)
+    return tile
+
+
+class TiledDistanceMatrix:
+    """
+    A distance matrix that is calculated in square tiles, each of which is written straight into a memory
+    mapped .npy file, so neither the matrix nor the profiles have to fit in memory.
+
+    Only the tiles on and above the diagonal are calculated; each is also written transposed below the
+    diagonal. Finished tiles are appended to a text file after they have been flushed to disk, so a
+    calculation that is interrupted continues with the first unfinished tile when it is run again with the
+    same tile size.
+    """
+    def __init__(self, path: str, done_path: str, sample_count: int, dtype):
+        self.path = path
+        self.done_path = done_path
+        self.sample_count = sample_count
+        self.dtype = np.dtype(dtype)
+
+    def done(self):
+        "Return the (first row, first column, size) of the finished tiles"
+        if not Path(self.done_path).exists():
+            return set()
+        with open(self.done_path) as f:
+            return {tuple(int(value) for value in line.split()) for line in f if line.strip()}
+
+    def open(self):
+        shape = (self.sample_count, self.sample_count)
+        if Path(self.path).exists():
+            distances = open_memmap(self.path, mode='r+')
+            if distances.shape == shape and distances.dtype == self.dtype:
+                return distances
+        # A new calculation, or one with different parameters: start from scratch
+        Path(self.done_path).unlink(missing_ok=True)
+        return open_memmap(self.path, mode='w+', dtype=self.dtype, shape=shape)
+
+    def calculate(self, profiles: np.ndarray, size: int, max_distance: int | None = None, on_progress=None):
+        """
+        Calculate the tiles that are not finished yet.
+        on_progress(tiles_done, tile_count) is called after each tile if given.
+        """
+        distances = self.open()
+        done = self.done()
+        starts = tile_starts(self.sample_count, size)
+        finished = sum((row, column, size) in done for row, column in starts)
+        with open(self.done_path, 'a') as done_file:
+            for row, column in starts:
+                if (row, column, size) in done:
+                    continue
+                rows = slice(row, min(row + size, self.sample_count))
+                columns = slice(column, min(column + size, self.sample_count))
+                tile = distance_tile(profiles, rows, columns, self.dtype, max_distance)
+                distances[rows, columns] = tile
+                distances[columns, rows] = tile.T
+                distances.flush()
+                done_file.write(f"{row} {column} {size}\n")
+                done_file.flush()
+                os.fsync(done_file.fileno())
+                finished += 1
+                if on_progress is not None:
+                    on_progress(finished, len(starts))
+        del distances
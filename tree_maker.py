@@ -34,22 +34,23 @@ def get_newick(node, parent_dist, leaf_names, newick='') -> str:
         newick = "(%s" % (newick)
         return newick
 
-def make_tree(df: pd.DataFrame, method: str):
-
-    m = df.values
-    M = ssd.squareform(np.array(m))
+def make_tree_from_array(distances: np.ndarray, leaf_names: list, method: str):
+    "Make a Newick tree from a square distance matrix array whose rows (and columns) are named by leaf_names"
+    M = ssd.squareform(np.asarray(distances))
 
-    # Perform single linkage
+    # Perform linkage
     Z = linkage(M, method)
 
-    # Get the list of leaf_names in the order they are in the distance matrix
-    leaf_names = list(df.index)
-
-    # Convert single linkage matrix to newick format
+    # Convert linkage matrix to newick format
     tree = scipy.cluster.hierarchy.to_tree(Z, False)
     nwk_tree = get_newick(tree, tree.dist, leaf_names)
     return nwk_tree
 
+def make_tree(df: pd.DataFrame, method: str):
+
+    # The leaf_names are in the order they are in the distance matrix
+    return make_tree_from_array(df.values, list(df.index), method)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('source_folder', type=Path)